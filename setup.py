@@ -13,6 +13,7 @@ setup(name='virtapi',
       install_requires=[
 	'libvirt-python',
 	'lxml==4.1.0',
+	'numpy',
 	'paramiko>=2.2.4',
 	'prettytable==0.7.2',
 	'xmltodict==0.10.1',
@@ -1,35 +1,264 @@
-import libvirt, xmltodict, json, random, uuid
 import logging
+from multiprocessing.pool import ThreadPool
+from time import time
 
-from libvirt import *
-from virtapi.controller.host_ctrl import VirtHost
-from virtapi.model.template import Templates
-from virtapi.model.plan import Plans
-from virtapi.model.host import Hosts
 from virtapi import settings
 from virtapi.utilities import create_config
 
+# controllers pull in libvirt, lxml, paramiko and numpy, they are imported on first use
+
+
+def load_configuration(configuration):
+    """
+    Loads configuration model( Templates, Plans, Hosts), creating default config files when missing.
+    """
+    try:
+        return configuration()
+    except Exception as e:
+        create_config()
+        return configuration()
+
+
+def collect_host_inventory(host):
+    """
+    Connects to a single host entry and collects its inventory, never raises.
+    """
+    from virtapi.controller.host_ctrl import VirtHost
+    started = time()
+    result = {'name': host['name'], 'inventory': None, 'error': None}
+    try:
+        virthost = VirtHost(host=host)
+        if virthost.connect() is False:
+            raise Exception('Connection to hypervisor failed.')
+        result['inventory'] = virthost.collect_inventory()
+    except Exception as e:
+        logging.error('Inventory of host {} failed: {}.'.format(host['name'], e))
+        result['error'] = str(e)
+    result['time'] = time() - started
+    return result
+
+
 class VirtAPI(object):
         def __init__(self, auth=None, memory_tresh=90):
             self.auth = auth
             self.max_memory_usage = memory_tresh
-            self.host = None
+            self.placement = None
+            self.samplers = {}
+            self.collectors = {}
             logging.basicConfig(filename='virtapi.log', level=logging.DEBUG)
-            
-            try:
-                self.load_configurations()
-            except Exception as e:
-                create_config()
-                self.load_configurations()
 
-            # virthost setup
-            self.host = self.Hosts.get_active()
-            if self.host is None:
-                self.VirtHost = VirtHost(host=None)
-            self.VirtHost = VirtHost(host=self.host)
+        def __getattr__(self, name):
+            # configurations and virthost are loaded on first access, so template list never reads hosts.yml
+            if name == 'Templates':
+                from virtapi.model.template import Templates
+                self.Templates = load_configuration(Templates)
+            elif name == 'Plans':
+                from virtapi.model.plan import Plans
+                self.Plans = load_configuration(Plans)
+            elif name == 'Hosts':
+                from virtapi.model.host import Hosts
+                self.Hosts = load_configuration(Hosts)
+            elif name in ('host', 'VirtHost'):
+                self.setup_host(self.Hosts.get_active())
+            else:
+                raise AttributeError(name)
+            return self.__dict__[name]
+
+        def setup_host(self, host):
+            from virtapi.controller.host_ctrl import VirtHost
+            self.host = host
+            self.VirtHost = VirtHost(host=host)
+            self.VirtHost.max_memory_usage = self.max_memory_usage
 
         def load_configurations(self):
-            self.Templates = Templates()
-            self.Plans = Plans()
-            self.Hosts = Hosts()
+            """
+            Drops loaded configurations, they are read again on next access.
+            """
+            for name in ('Templates', 'Plans', 'Hosts'):
+                self.__dict__.pop(name, None)
+
+        def reload(self):
+            """
+            Reloads configurations, VirtHost is replaced when active host changed.
+            """
+            self.load_configurations()
+            host = self.Hosts.get_active()
+            if 'VirtHost' in self.__dict__ and host != self.host:
+                self.setup_host(host)
+            if self.placement is not None:
+                self.placement.close()
+            self.placement = None
+
+        def get_inventory(self, all_hosts=True, workers=None):
+            """
+            Collects inventory from all hosts defined in hosts.yml( or just active one) in parallel.
+            Returns merged result with per host inventory, timing and error.
+            """
+            if all_hosts:
+                hosts = self.Hosts.get_hosts() or []
+            else:
+                hosts = [host for host in [self.Hosts.get_active()] if host is not None]
+
+            if workers is None:
+                workers = settings.SETTINGS['INVENTORY_WORKERS']
+
+            started = time()
+            results = []
+            if hosts:
+                pool = ThreadPool(max(1, min(workers, len(hosts))))
+                try:
+                    results = pool.map(collect_host_inventory, hosts)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            response = {'hosts': {}, 'totals': {'hosts': len(hosts), 'failed': 0, 'domains': 0, 'cpu_cores': 0, 'ram': 0}}
+            for result in results:
+                # hand edited hosts.yml can repeat a name, later entries get a numbered key instead of replacing
+                key = result['name']
+                index = 1
+                while key in response['hosts']:
+                    index += 1
+                    key = '{}#{}'.format(result['name'], index)
+                if key != result['name']:
+                    logging.warning('Duplicate host name {} in hosts file, reported as {}.'.format(result['name'], key))
+                response['hosts'][key] = result
+                if result['error'] is not None:
+                    response['totals']['failed'] += 1
+                    continue
+                inventory = result['inventory']
+                response['totals']['domains'] += len(inventory['domains'])
+                response['totals']['cpu_cores'] += inventory['info']['cpu_cores']
+                response['totals']['ram'] += inventory['info']['ram']
+            response['elapsed'] = time() - started
+            return response
+
+        def get_sampler(self, name=None, per_core=True, interval=None):
+            """
+            Returns CPU/memory sampler of the host( active one by default), samplers are kept between calls.
+            """
+            from virtapi.controller.metrics_ctrl import HostSampler
+            host = self.Hosts.get_host_by_name(name) if name is not None else self.Hosts.get_active()
+            if host is None:
+                return None
+            sampler = self.samplers.get(host['name'])
+            if sampler is None or sampler.per_core != per_core:
+                sampler = HostSampler(host, interval=interval, per_core=per_core)
+                self.samplers[host['name']] = sampler
+            return sampler
+
+        def get_collector(self, name=None, interval=None):
+            """
+            Returns domain metrics collector of the host( active one by default), collectors are kept between calls.
+            """
+            from virtapi.controller.metrics_ctrl import DomainCollector
+            host = self.Hosts.get_host_by_name(name) if name is not None else self.Hosts.get_active()
+            if host is None:
+                return None
+            if host['name'] not in self.collectors:
+                self.collectors[host['name']] = DomainCollector(host, interval=interval)
+            return self.collectors[host['name']]
+
+        def get_placement(self, policy=None):
+            """
+            Returns placement engine over all hosts from hosts.yml, snapshots are kept between calls.
+            """
+            from virtapi.controller.placement_ctrl import VirtPlacement
+            if self.placement is None or (policy is not None and policy != self.placement.policy):
+                if self.placement is not None:
+                    self.placement.close()
+                self.placement = VirtPlacement(self.Hosts.get_hosts() or [], policy=policy,
+                                               memory_threshold=self.max_memory_usage)
+            return self.placement
+
+        def place(self, plan, names, labels=None, anti_affinity=None, policy=None, reserve=True):
+            """
+            Chooses hosts for domains of the plan, returns {name: host name or None}.
+            Without reserve nothing is reserved, e.g. for previews.
+            """
+            from virtapi.controller.placement_ctrl import placement_request
+            request = placement_request(plan, labels=labels, anti_affinity=anti_affinity)
+            return self.get_placement(policy).place_many(request, names, reserve=reserve)
+
+        def create_placed(self, template, params, plan, labels=None, anti_affinity=None, policy=None, timeout=None):
+            """
+            Creates domain on the host chosen by placement engine. Returns (host name, domain object).
+            """
+            from virtapi.controller.host_ctrl import VirtHost
+            from virtapi.controller.placement_ctrl import placement_request
+            request = placement_request(plan, labels=labels, anti_affinity=anti_affinity)
+            host_name = self.get_placement(policy).place(request, name=params['name'])
+            if host_name is None:
+                return None, None
+
+            vm = None
+            try:
+                virthost = VirtHost(host=self.Hosts.get_host_by_name(host_name))
+                virthost.max_memory_usage = self.max_memory_usage
+                if virthost.connect() is not False:
+                    params['labels'] = labels
+                    vm = virthost.create_domain_from_template(template, params, timeout=timeout)
+            finally:
+                if vm is None:
+                    self.placement.release(host_name, params['name'])
+            return host_name, vm
+
+        def create_many_placed(self, template, plan, names=None, count=None, prefix=None, labels=None, anti_affinity=None,
+                               policy=None, concurrency=None, timeout=None):
+            """
+            Places batch of domains with place_many and creates them with create_many, hosts in parallel.
+            Returns create_many response merged over hosts, every domain carries its 'host'.
+            """
+            from virtapi.controller.host_ctrl import VirtHost
+            from virtapi.controller.placement_ctrl import placement_request
+            if names is None:
+                if prefix is None:
+                    prefix = template
+                names = ["{}-{}".format(prefix, index) for index in range(1, int(count or 0) + 1)]
+
+            started = time()
+            request = placement_request(plan, labels=labels, anti_affinity=anti_affinity)
+            placement = self.get_placement(policy)
+            hosts = {}
+            for name, host_name in placement.place_many(request, names).items():
+                hosts.setdefault(host_name, []).append(name)
+
+            def create_on_host(item):
+                host_name, host_names = item
+                try:
+                    virthost = VirtHost(host=self.Hosts.get_host_by_name(host_name))
+                    virthost.max_memory_usage = self.max_memory_usage
+                    if virthost.connect() is False:
+                        raise Exception('Host {} not reachable.'.format(host_name))
+                    return host_name, virthost.create_many(template, plan, names=host_names, concurrency=concurrency,
+                                                           timeout=timeout, labels=labels)
+                except Exception as e:
+                    logging.error('Batch creation on host {} failed: {}.'.format(host_name, e))
+                    return host_name, {'domains': dict((name, {'created': False, 'ip': None, 'error': str(e), 'time': None})
+                                                       for name in host_names)}
+
+            response = {'domains': {}, 'created': 0, 'failed': 0}
+            for name in hosts.pop(None, []):
+                response['domains'][name] = {'created': False, 'ip': None, 'error': 'No host has capacity.', 'time': None, 'host': None}
+
+            results = []
+            if hosts:
+                pool = ThreadPool(len(hosts))
+                try:
+                    results = pool.map(create_on_host, list(hosts.items()))
+                finally:
+                    pool.close()
+                    pool.join()
+
+            for host_name, result in results:
+                for name, domain in result['domains'].items():
+                    domain['host'] = host_name
+                    response['domains'][name] = domain
+                    if not domain['created']:
+                        placement.release(host_name, name)
 
+            response['created'] = len([domain for domain in response['domains'].values() if domain['created']])
+            response['failed'] = len(names) - response['created']
+            response['elapsed'] = time() - started
+            response['throughput'] = response['created'] / response['elapsed'] if response['elapsed'] > 0 else 0.0
+            return response
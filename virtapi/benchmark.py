@@ -0,0 +1,124 @@
+"""
+Startup benchmark, measures cold import time of every subsystem and cold start of common vatool commands.
+Every measurement runs in a fresh interpreter, heavy modules loaded on the way are recorded as well.
+Usage: python -m virtapi.benchmark [-r repeat] [-o results.json]
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from time import time
+
+from virtapi.settings import dir_path
+
+SUBSYSTEMS = [
+    ('settings', 'virtapi.settings'),
+    ('utilities', 'virtapi.utilities'),
+    ('daemon', 'virtapi.daemon'),
+    ('api', 'virtapi.api'),
+    ('model.plan', 'virtapi.model.plan'),
+    ('model.template', 'virtapi.model.template'),
+    ('model.host', 'virtapi.model.host'),
+    ('controller.domain', 'virtapi.controller.domain_ctrl'),
+    ('controller.host', 'virtapi.controller.host_ctrl'),
+    ('controller.placement', 'virtapi.controller.placement_ctrl'),
+    ('controller.metrics', 'virtapi.controller.metrics_ctrl'),
+]
+
+COMMANDS = [['--help'], ['template', 'list'], ['plan', 'list']]
+
+HEAVY_MODULES = ('libvirt', 'lxml', 'paramiko', 'cryptography', 'requests', 'tqdm', 'numpy', 'yaml', 'xmltodict')
+
+IMPORT_SNIPPET = """
+import sys, json
+from time import time
+started = time()
+error = None
+try:
+    __import__(sys.argv[1])
+except Exception as e:
+    error = str(e)
+print(json.dumps({'time': time() - started, 'error': error,
+                  'heavy': [name for name in sys.argv[2:] if name in sys.modules]}))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure_import(module, repeat=5):
+    """
+    Returns median import time of the module in fresh interpreters, heavy modules it loaded and error.
+    """
+    times = []
+    result = {}
+    for attempt in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SNIPPET, module] + list(HEAVY_MODULES))
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        times.append(result['time'])
+    return {'module': module, 'time': median(times), 'heavy': result['heavy'], 'error': result['error']}
+
+
+def measure_command(argv, repeat=5, vatool=None):
+    """
+    Returns median wall time of vatool command run locally( daemon bypassed), minus bare interpreter start.
+    """
+    vatool = vatool or os.path.join(os.path.dirname(dir_path), 'vatool')
+    env = dict(os.environ, VATOOL_NO_DAEMON='1')
+    with open(os.devnull, 'w') as devnull:
+        baseline = []
+        times = []
+        for attempt in range(repeat):
+            started = time()
+            subprocess.call([sys.executable, '-c', 'pass'])
+            baseline.append(time() - started)
+
+            started = time()
+            code = subprocess.call([sys.executable, vatool] + argv, stdout=devnull, stderr=devnull, env=env)
+            times.append(time() - started)
+    return {'command': ' '.join(argv), 'time': median(times), 'startup': median(times) - median(baseline), 'code': code}
+
+
+def run_benchmark(repeat=5, vatool=None):
+    return {
+        'python': sys.version.split()[0],
+        'imports': [dict(measure_import(module, repeat), name=name) for name, module in SUBSYSTEMS],
+        'commands': [measure_command(argv, repeat, vatool) for argv in COMMANDS],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VirtAPI startup benchmark.')
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=5, help='Runs per measurement.')
+    parser.add_argument('-o', '--output', action='store', type=str, help='Write results as JSON.')
+    parser.add_argument('--vatool', action='store', type=str, help='Path to vatool script.')
+    args = parser.parse_args()
+
+    from prettytable import PrettyTable
+    results = run_benchmark(args.repeat, args.vatool)
+
+    t = PrettyTable(['Subsystem', 'Import', 'Heavy modules loaded', 'Error'])
+    for result in results['imports']:
+        t.add_row([result['name'], "%.1f ms" % (result['time'] * 1000), ', '.join(result['heavy']), result['error'] or ''])
+    print(t)
+    t = PrettyTable(['Command', 'Wall time', 'Startup( minus interpreter)', 'Exit code'])
+    for result in results['commands']:
+        t.add_row(['vatool ' + result['command'], "%.1f ms" % (result['time'] * 1000),
+                   "%.1f ms" % (result['startup'] * 1000), result['code']])
+    print(t)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
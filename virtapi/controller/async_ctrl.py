@@ -0,0 +1,200 @@
+"""
+Asyncio methods and calls (Python 3 only)
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import asyncio
+import functools
+import json
+import libvirt
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from virtapi.settings import SETTINGS
+from virtapi.controller.host_ctrl import VirtHost
+from virtapi.controller.domain_ctrl import VirtDomain
+from virtapi.controller.event_ctrl import wait_for_domains
+
+
+class AsyncDomainEvents(object):
+    """
+    Async iterator over libvirt domain events of the connection.
+    Yields dicts with domain name, uuid, event id and event arguments, iteration ends after close().
+    """
+
+    CLOSED = object()
+
+    def __init__(self, conn, loop, event_ids=None, maxsize=None):
+        self.conn = conn
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize or SETTINGS['ASYNC_EVENT_QUEUE'])
+        self.callbacks = []
+        self.closed = False
+
+        if event_ids is None:
+            event_ids = [libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE]
+            if hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE'):
+                event_ids.append(libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE)
+
+        for event_id in event_ids:
+            callback = functools.partial(self._on_event, event_id)
+            self.callbacks.append(self.conn.domainEventRegisterAny(None, event_id, callback, None))
+
+    def _on_event(self, event_id, conn, domain, *args):
+        # called from libvirt event loop thread, last argument is opaque
+        event = {'name': domain.name(), 'uuid': domain.UUIDString(), 'event_id': event_id, 'args': args[:-1]}
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logging.warning('Event queue full, dropping event {} of {}.'.format(event['event_id'], event['name']))
+
+    def _put_closed(self):
+        try:
+            self.queue.put_nowait(self.CLOSED)
+        except asyncio.QueueFull:
+            # nobody waits on a full queue, consumer stops once it is drained
+            pass
+
+    def close(self):
+        for callback in self.callbacks:
+            try:
+                self.conn.domainEventDeregisterAny(callback)
+            except libvirt.libvirtError:
+                pass
+        self.callbacks = []
+        if not self.closed:
+            self.closed = True
+            # wakes consumer already waiting on the queue
+            self.loop.call_soon_threadsafe(self._put_closed)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self.queue.empty():
+            raise StopAsyncIteration
+        event = await self.queue.get()
+        if event is self.CLOSED:
+            raise StopAsyncIteration
+        return event
+
+
+class AsyncVirtHost(object):
+    """
+    Awaitable VirtHost. Blocking libvirt calls run on a dedicated executor,
+    at most concurrency of them run at once for this host.
+    """
+
+    def __init__(self, host=None, virthost=None, workers=None, concurrency=None):
+        self.virthost = virthost if virthost is not None else VirtHost(host=host)
+        self.executor = ThreadPoolExecutor(max_workers=workers or SETTINGS['ASYNC_WORKERS'])
+        self.concurrency = concurrency or SETTINGS['ASYNC_HOST_CONCURRENCY']
+        self.semaphore = None
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs blocking callable on the host executor.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def connect(self):
+        return await self.run(self.virthost.connect)
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def get_all_domains(self, long=False):
+        if long:
+            return json.loads(await self.run(self.virthost.get_all_domains_long))
+        return json.loads(await self.run(self.virthost.get_all_domains))
+
+    async def get_domain(self, name):
+        domain = await self.run(self.virthost.get_domain_object_by_name, name)
+        virtdomain = await self.run(VirtDomain, domain=domain)
+        return AsyncVirtDomain(self, virtdomain)
+
+    async def create_domain_from_template(self, template, params, cloudinit=True, start=True, timeout=None, warm=True):
+        return await self.run(self.virthost.create_domain_from_template, template, params,
+                              cloudinit=cloudinit, start=start, timeout=timeout, warm=warm)
+
+    async def create_many(self, template, plan, names=None, count=None, prefix=None, concurrency=None,
+                          cloudinit=True, start=True, timeout=None, seed=None, labels=None):
+        return await self.run(self.virthost.create_many, template, plan, names=names, count=count, prefix=prefix,
+                              concurrency=concurrency, cloudinit=cloudinit, start=start, timeout=timeout, seed=seed,
+                              labels=labels)
+
+    async def clone_domain(self, template, params, start=False, timeout=None):
+        return await self.run(self.virthost.clone_domain, template, params, start=start, timeout=timeout)
+
+    async def delete_domain(self, name):
+        return await self.run(self.virthost.delete_domain, name)
+
+    async def add_disk(self, name, size, pool=None, thin=True, template=None, shareable=False, existing=None):
+        return await self.run(self.virthost.add_disk, name, size, pool=pool, thin=thin, template=template,
+                              shareable=shareable, existing=existing)
+
+    async def delete_disk(self, name, diskname):
+        return await self.run(self.virthost.delete_disk, name, diskname)
+
+    async def add_nic(self, name, network):
+        return await self.run(self.virthost.add_nic, name, network)
+
+    async def delete_nic(self, name, interface):
+        return await self.run(self.virthost.delete_nic, name, interface)
+
+    def events(self, event_ids=None, maxsize=None):
+        """
+        Returns async iterator of domain events, call close() on it when done.
+        """
+        return AsyncDomainEvents(self.virthost.conn, asyncio.get_event_loop(), event_ids=event_ids, maxsize=maxsize)
+
+
+class AsyncVirtDomain(object):
+    """
+    Awaitable VirtDomain, shares executor and concurrency limit of its AsyncVirtHost.
+    """
+
+    def __init__(self, host, virtdomain):
+        self.host = host
+        self.virtdomain = virtdomain
+
+    async def get_info(self):
+        return json.loads(await self.host.run(self.virtdomain.get_info, self.host.virthost.conn))
+
+    async def get_ip(self):
+        return await self.host.run(self.virtdomain.get_ip, self.host.virthost.conn)
+
+    async def start(self):
+        return await self.host.run(self.virtdomain.start_domain)
+
+    async def stop(self):
+        return await self.host.run(self.virtdomain.stop_domain)
+
+    async def force_stop(self):
+        return await self.host.run(self.virtdomain.force_stop, None)
+
+    async def reboot(self):
+        return await self.host.run(self.virtdomain.reboot_domain)
+
+    async def suspend(self):
+        return await self.host.run(self.virtdomain.suspend, None)
+
+    async def resume(self):
+        return await self.host.run(self.virtdomain.resume, None)
+
+    async def set_autostart(self, state):
+        return await self.host.run(self.virtdomain.set_autostart_domain, state)
+
+    async def wait_reachable(self, timeout=None):
+        """
+        Waits until domain gets an IP address, returns list of addresses or None on timeout.
+        """
+        ips = await self.host.run(wait_for_domains, self.host.virthost.conn, [self.virtdomain.domain], timeout)
+        return ips[self.virtdomain.domain.name()]
@@ -0,0 +1,254 @@
+"""
+Connection pool methods and calls
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import libvirt
+import logging
+import threading
+import weakref
+from time import time
+
+from virtapi.settings import *
+from virtapi.controller.event_ctrl import start_event_loop
+
+
+def host_key(host):
+    """
+    Returns hashable key for a host entry from hosts.yml.
+    """
+    return (host.get('name'), host.get('connection'), host.get('protocol'),
+            host.get('username'), host.get('key'))
+
+
+def host_uri(host):
+    """
+    Builds libvirt URI for a host entry, same rules VirtHost.connect always used.
+    """
+    protocol = host.get('protocol')
+    url = host.get('connection')
+
+    if protocol == 'libssh2' and url:
+        return "{}://{}/?sshauth=password".format(VIRT_CONN_LIBSSH2, url)
+    elif protocol == 'ssh' and url:
+        return "{}://{}@{}/system?socket=/var/run/libvirt/libvirt-sock&keyfile={}".format(VIRT_CONN_SSH, host.get('username'),
+                                                                                               url,
+                                                                                               host.get('key'))
+    elif protocol in ('libssh2', 'ssh', 'qemu'):
+        return "qemu:///system"
+    return None
+
+
+def open_connection(host):
+    """
+    Opens a brand new libvirt connection for the host entry.
+    """
+    uri = host_uri(host)
+    if uri is None:
+        raise libvirt.libvirtError('Unsupported protocol {}.'.format(host.get('protocol')))
+
+    if host.get('protocol') == 'libssh2' and host.get('connection'):
+        def request_cred(credentials, user_data):
+            for credential in credentials:
+                if credential[0] == libvirt.VIR_CRED_AUTHNAME:
+                    credential[4] = host.get('username')
+                elif credential[0] == libvirt.VIR_CRED_PASSPHRASE:
+                    credential[4] = host.get('password')
+            return 0
+
+        auth = [[libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE], request_cred, None]
+        return libvirt.openAuth(uri, auth, 0)
+
+    return libvirt.open(uri)
+
+
+class VirtConnectionPool(object):
+    """
+    Keeps one live libvirt connection per host entry and hands it out on every connect.
+    Dead connections are detected with isAlive() and reopened transparently.
+    """
+
+    def __init__(self, keepalive_interval=None, keepalive_count=None):
+        self.keepalive_interval = keepalive_interval or SETTINGS['KEEPALIVE_INTERVAL']
+        self.keepalive_count = keepalive_count or SETTINGS['KEEPALIVE_COUNT']
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.host_locks = {}
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.connect_time = 0.0
+
+    def _host_lock(self, key):
+        with self.lock:
+            if key not in self.host_locks:
+                self.host_locks[key] = threading.Lock()
+            return self.host_locks[key]
+
+    def _is_alive(self, conn):
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    def _open(self, host):
+        start_event_loop()
+
+        started = time()
+        try:
+            conn = open_connection(host)
+        except libvirt.libvirtError as e:
+            logging.error('Connection to hypervisor {} failed: {}.'.format(host.get('name'), e))
+            conn = None
+        elapsed = time() - started
+
+        with self.lock:
+            self.connect_time += elapsed
+            if conn is None:
+                self.failures += 1
+
+        if conn is None:
+            return None
+
+        try:
+            conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        except libvirt.libvirtError as e:
+            logging.warning('Keepalive not enabled for {}: {}.'.format(host.get('name'), e))
+
+        logging.info('Connection to {} opened in {:.3f}s.'.format(host.get('name'), elapsed))
+        return conn
+
+    def get(self, host):
+        """
+        Returns live connection for the host entry, opening or reopening it if needed.
+        Returns None in case of failed connection.
+        """
+        key = host_key(host)
+
+        with self._host_lock(key):
+            conn = self.connections.get(key)
+            if conn is not None:
+                if self._is_alive(conn):
+                    with self.lock:
+                        self.hits += 1
+                    return conn
+
+                logging.warning('Connection to {} is dead, reconnecting.'.format(host.get('name')))
+                self._close(conn)
+                del self.connections[key]
+                with self.lock:
+                    self.reconnects += 1
+
+            with self.lock:
+                self.misses += 1
+            conn = self._open(host)
+            if conn is not None:
+                self.connections[key] = conn
+            return conn
+
+    def release(self, host):
+        """
+        Closes and forgets the connection of the host entry.
+        """
+        key = host_key(host)
+        with self._host_lock(key):
+            conn = self.connections.pop(key, None)
+            if conn is not None:
+                self._close(conn)
+
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+        for conn in connections:
+            self._close(conn)
+
+    def _close(self, conn):
+        # callbacks of caches hold them alive and would keep firing from the replaced connection
+        close_conn_caches(conn)
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def get_stats(self):
+        """
+        Returns pool counters. Saved time is estimated from average handshake time and number of hits.
+        """
+        with self.lock:
+            opened = self.misses - self.failures
+            average = self.connect_time / opened if opened > 0 else 0.0
+            return {
+                'connections': len(self.connections),
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'failures': self.failures,
+                'connect_time': self.connect_time,
+                'avg_connect_time': average,
+                'saved_time': average * self.hits,
+            }
+
+
+connection_pool = VirtConnectionPool()
+
+class VirtConnCache(object):
+    """
+    Base of per connection caches. Connection is held by weak reference, strong one would keep
+    the connection alive as a key of _conn_caches and leak every connection replaced on reconnect.
+    """
+
+    def __init__(self, conn):
+        self._conn = weakref.ref(conn)
+        # (deregister method name, callback id) of registered event callbacks
+        self.callbacks = []
+
+    @property
+    def conn(self):
+        return self._conn()
+
+    def close(self):
+        """
+        Deregisters event callbacks of the cache from its connection.
+        """
+        conn = self.conn
+        callbacks, self.callbacks = self.callbacks, []
+        if conn is None:
+            return
+        for deregister, callback in callbacks:
+            try:
+                getattr(conn, deregister)(callback)
+            except libvirt.libvirtError:
+                pass
+
+
+_conn_caches = weakref.WeakKeyDictionary()
+_conn_caches_lock = threading.Lock()
+
+
+def get_conn_cache(conn, name, factory):
+    """
+    Returns per connection cache object, created with factory(conn) on first use.
+    Caches live as long as the connection object itself.
+    """
+    with _conn_caches_lock:
+        caches = _conn_caches.get(conn)
+        if caches is None:
+            caches = {}
+            _conn_caches[conn] = caches
+        if name not in caches:
+            caches[name] = factory(conn)
+        return caches[name]
+
+
+def close_conn_caches(conn):
+    """
+    Closes and forgets all caches of the connection, called when the pool closes or replaces it.
+    """
+    with _conn_caches_lock:
+        caches = _conn_caches.pop(conn, None) or {}
+    for cache in caches.values():
+        cache.close()
@@ -5,7 +5,91 @@ __author__ = Strahinja Piperac <spiperac@denkei.org>
 from xml.etree import ElementTree
 import xml.etree.ElementTree as ET
 import xmltodict, json, random, uuid
+import libvirt, copy, logging, threading, os, re
+from time import time, sleep
 from virtapi import settings
+from virtapi.controller.connection_ctrl import get_conn_cache, VirtConnCache
+from virtapi.controller.network_ctrl import get_lease_cache
+from virtapi.controller.storage_ctrl import get_volume_index
+from virtapi.model.snapshot import Snapshots
+
+
+class VirtDomainXMLCache(VirtConnCache):
+    """
+    Parsed domain XML trees keyed by domain UUID, shared per connection.
+    Entries are dropped on libvirt device added/removed and lifecycle events, and after our own device edits.
+    """
+
+    def __init__(self, conn):
+        VirtConnCache.__init__(self, conn)
+        self.trees = {}
+        self.lock = threading.Lock()
+        self.fetches = 0
+        self.hits = 0
+        self.register()
+
+    def register(self):
+        events = [libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE]
+        for event in ('VIR_DOMAIN_EVENT_ID_DEVICE_ADDED', 'VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED',
+                      'VIR_DOMAIN_EVENT_ID_METADATA_CHANGE', 'VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2'):
+            if hasattr(libvirt, event):
+                events.append(getattr(libvirt, event))
+
+        for event_id in events:
+            try:
+                self.callbacks.append(('domainEventDeregisterAny',
+                                       self.conn.domainEventRegisterAny(None, event_id, self._on_event, None)))
+            except libvirt.libvirtError as e:
+                logging.warning('Domain XML cache event {} not registered: {}.'.format(event_id, e))
+
+    def _on_event(self, conn, domain, *args):
+        with self.lock:
+            self.trees.pop(domain.UUIDString(), None)
+
+    def get(self, domain, copy_tree=False):
+        """
+        Returns parsed XML of the domain, fetching it only on cache miss.
+        Use copy_tree=True when the tree is going to be modified.
+        """
+        uuid = domain.UUIDString()
+        with self.lock:
+            tree = self.trees.get(uuid)
+            if tree is not None:
+                self.hits += 1
+
+        if tree is None:
+            tree = ET.fromstring(domain.XMLDesc(0))
+            with self.lock:
+                self.trees[uuid] = tree
+                self.fetches += 1
+
+        if copy_tree:
+            with self.lock:
+                return copy.deepcopy(tree)
+        return tree
+
+    def invalidate(self, uuid=None):
+        with self.lock:
+            if uuid is None:
+                self.trees = {}
+            else:
+                self.trees.pop(uuid, None)
+
+
+def get_xml_cache(conn):
+    """
+    Returns shared domain XML cache for the connection.
+    """
+    return get_conn_cache(conn, 'domain_xml', VirtDomainXMLCache)
+
+def state_active(state, reason=None):
+    """
+    Returns True for domain state( and reason) from bulk stats or info in which isActive is true,
+    crashed domains are active only when their process was preserved after panic.
+    """
+    if state == libvirt.VIR_DOMAIN_CRASHED:
+        return reason == getattr(libvirt, 'VIR_DOMAIN_CRASHED_PANICKED', 1)
+    return state not in (libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_NOSTATE)
 
 class VirtDomain(object):
 
@@ -16,8 +100,8 @@ class VirtDomain(object):
         if name is not None:
             self.domain = None #TODO implement get by name
 
-        self.xml = ElementTree.fromstring(self.domain.XMLDesc(0))
-        self.conn = settings.SETTINGS['connection']
+        self.conn = self.domain.connect()
+        self.xml = get_xml_cache(self.conn).get(self.domain)
 
     def get_uuid(self):
         response = {}
@@ -53,15 +137,312 @@ class VirtDomain(object):
         """
         disks = [disk for disk in self.xml.iter('disk')]
         disk_objs = []
+        volumes = get_volume_index(self.conn)
         for disk in disks:
             source = disk.find('source')
             if source is None:
                 continue
             path = source.attrib['file']
-            diskobj = self.conn.storageVolLookupByPath(path)
-            disk_objs.append(diskobj)
+            diskobj = volumes.get_volume(path)
+            if diskobj is not None:
+                disk_objs.append(diskobj)
         return disk_objs
     
+    def _volume_chain(self, path):
+        """
+        Follows backing volumes of path through storage volume XML, used for inactive domains.
+        """
+        chain = [path]
+        volumes = get_volume_index(self.conn)
+        while len(chain) <= settings.SETTINGS['MAX_CHAIN_WALK']:
+            volume = volumes.get_volume(chain[-1])
+            if volume is None:
+                break
+            backing = ET.fromstring(volume.XMLDesc(0)).find('backingStore/path')
+            if backing is None or not backing.text:
+                break
+            chain.append(backing.text)
+        return chain
+
+    def get_backing_chains(self):
+        """
+        Returns {target dev: {'path', 'chain', 'depth'}} for file disks. Chain starts with the disk image
+        and ends with the base image, depth is number of backing layers( 0 for standalone image).
+        """
+        chains = {}
+        for disk in self.xml.iter('disk'):
+            source = disk.find('source')
+            target = disk.find('target')
+            if source is None or target is None or source.get('file') is None:
+                continue
+            chain = [source.get('file')]
+            backing = disk.find('backingStore')
+            while backing is not None:
+                backing_source = backing.find('source')
+                if backing_source is None or backing_source.get('file') is None:
+                    break
+                chain.append(backing_source.get('file'))
+                backing = backing.find('backingStore')
+            if len(chain) == 1 and not self.domain.isActive():
+                # inactive XML carries no backing chain
+                chain = self._volume_chain(chain[0])
+            chains[target.get('dev')] = {'path': chain[0], 'chain': chain, 'depth': len(chain) - 1}
+        return chains
+
+    def wait_block_job(self, dev, progress=None, interval=None):
+        """
+        Waits for block job on dev to finish, calling progress(dev, cur, end) on every poll.
+        """
+        interval = interval or settings.SETTINGS['BLOCK_JOB_POLL_INTERVAL']
+        while True:
+            info = self.domain.blockJobInfo(dev, 0)
+            if not info:
+                break
+            if progress is not None:
+                progress(dev, info['cur'], info['end'])
+            sleep(interval)
+        self.refresh()
+
+    def flatten_disk(self, dev, max_depth=0, bandwidth=None, wait=True, progress=None):
+        """
+        Shortens backing chain of dev to max_depth layers while the domain runs.
+        Layers above the kept base are pulled into the disk image( blockPull/blockRebase), shared base
+        images are never written to. Bandwidth is in MiB/s. Returns False if there was nothing to do.
+        """
+        chain = self.get_backing_chains()[dev]['chain']
+        depth = len(chain) - 1
+        if depth <= max_depth:
+            return False
+        if not self.domain.isActive():
+            raise libvirt.libvirtError('Domain {} must be running to flatten {}.'.format(self.domain.name(), dev))
+
+        if bandwidth is None:
+            bandwidth = settings.SETTINGS['BLOCK_JOB_BANDWIDTH']
+        if max_depth == 0:
+            self.domain.blockPull(dev, bandwidth, 0)
+        else:
+            base = chain[len(chain) - max_depth]
+            self.domain.blockRebase(dev, base, bandwidth, 0)
+        logging.info('Flattening {} of {} from depth {} to {}.'.format(dev, self.domain.name(), depth, max_depth))
+
+        if wait:
+            self.wait_block_job(dev, progress=progress)
+        return True
+
+    def wait_block_ready(self, dev, progress=None, interval=None):
+        """
+        Waits for active block commit on dev to copy everything and pivots disk to the commit base.
+        """
+        interval = interval or settings.SETTINGS['BLOCK_JOB_POLL_INTERVAL']
+        while True:
+            info = self.domain.blockJobInfo(dev, 0)
+            if not info:
+                raise libvirt.libvirtError('Block job on {} of {} ended before pivot.'.format(dev, self.domain.name()))
+            if progress is not None:
+                progress(dev, info['cur'], info['end'])
+            if info['cur'] == info['end']:
+                try:
+                    self.domain.blockJobAbort(dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                    break
+                except libvirt.libvirtError as e:
+                    # job not in ready state yet, guest keeps writing
+                    logging.debug('Pivot of {} not ready: {}.'.format(dev, e))
+            sleep(interval)
+        self.wait_block_job(dev, interval=interval)
+
+    @property
+    def snapshots(self):
+        if not hasattr(self, '_snapshots'):
+            self._snapshots = Snapshots()
+        return self._snapshots
+
+    def _overlay_path(self, path, dev, name):
+        return os.path.join(os.path.dirname(path), '{}-{}.{}.{}'.format(self.domain.name(), dev, name,
+                                                                      settings.SETTINGS['SNAPSHOT_FORMAT']))
+
+    def list_snapshots(self):
+        """
+        Returns snapshots of the domain from the snapshot index, oldest first.
+        """
+        return self.snapshots.get_domain_snapshots(self.domain.UUIDString())
+
+    def create_snapshot(self, name, quiesce=None, description=None, disks=None):
+        """
+        Creates external disk-only snapshot: current image of every disk( or disks listed) is frozen and new
+        overlay is put on top of it, atomically for all disks. No memory state is saved, so running guest is
+        stopped only for the overlay switch. With quiesce guest filesystems are frozen through guest agent.
+        Returns snapshot index entry.
+        """
+        if not re.match(r'^[A-Za-z0-9_.-]+$', name):
+            raise ValueError('Snapshot name {} may contain only letters, digits, ".", "_" and "-".'.format(name))
+        uuid = self.domain.UUIDString()
+        if self.snapshots.get_snapshot(uuid, name) is not None:
+            raise ValueError('Snapshot {} of {} already exists.'.format(name, self.domain.name()))
+        if quiesce is None:
+            quiesce = settings.SETTINGS['SNAPSHOT_QUIESCE'] and self.domain.isActive()
+        if quiesce and not self.domain.isActive():
+            raise libvirt.libvirtError('Domain {} must be running to quiesce snapshot.'.format(self.domain.name()))
+
+        chains = self.get_backing_chains()
+        root = ET.Element('domainsnapshot')
+        ET.SubElement(root, 'name').text = name
+        if description:
+            ET.SubElement(root, 'description').text = description
+        disks_xml = ET.SubElement(root, 'disks')
+        entry_disks = {}
+        for disk in self.xml.iter('disk'):
+            target = disk.find('target')
+            if target is None:
+                continue
+            dev = target.get('dev')
+            disk_xml = ET.SubElement(disks_xml, 'disk', name=dev)
+            if (disk.get('device', 'disk') != 'disk' or dev not in chains or disk.find('readonly') is not None
+                    or disk.find('shareable') is not None or (disks and dev not in disks)):
+                disk_xml.set('snapshot', 'no')
+                continue
+            overlay = self._overlay_path(chains[dev]['path'], dev, name)
+            disk_xml.set('snapshot', 'external')
+            ET.SubElement(disk_xml, 'driver', type=settings.SETTINGS['SNAPSHOT_FORMAT'])
+            ET.SubElement(disk_xml, 'source', file=overlay)
+            entry_disks[dev] = {'base': chains[dev]['path'], 'overlay': overlay}
+        if not entry_disks:
+            raise ValueError('Domain {} has no disks to snapshot.'.format(self.domain.name()))
+
+        flags = (libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC |
+                 libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+        if quiesce:
+            flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE
+        started = time()
+        self.domain.snapshotCreateXML(ET.tostring(root).decode('utf-8'), flags)
+        duration = time() - started
+        self.refresh()
+
+        # overlays were created by hypervisor, let storage pools see them
+        volumes = get_volume_index(self.conn)
+        for pool in set(entry['pool'] for entry in [volumes.get_by_path(disk['base']) for disk in entry_disks.values()] if entry):
+            volumes.refresh(pool=pool)
+
+        snapshot = {'name': name, 'domain': self.domain.name(), 'uuid': uuid, 'created': time(),
+                    'description': description, 'quiesced': bool(quiesce), 'duration': duration, 'disks': entry_disks}
+        self.snapshots.add_snapshot(snapshot)
+        logging.info('Snapshot {} of {} created in {:.3f}s.'.format(name, self.domain.name(), duration))
+        return snapshot
+
+    def _get_snapshot(self, name):
+        snapshot = self.snapshots.get_snapshot(self.domain.UUIDString(), name)
+        if snapshot is None:
+            raise ValueError('Snapshot {} of {} not found.'.format(name, self.domain.name()))
+        return snapshot
+
+    def _create_overlay(self, base, overlay):
+        """
+        Creates empty overlay volume backed by base image in the pool of the base.
+        """
+        volumes = get_volume_index(self.conn)
+        entry = volumes.get_by_path(base)
+        if entry is None:
+            raise ValueError('Snapshot image {} not found.'.format(base))
+        volumes.get_info(entry)
+        base_format = ET.fromstring(entry['volume'].XMLDesc(0)).find('target/format')
+        pool = entry['volume'].storagePoolLookupByVolume()
+        xml = """<volume type='file'>
+        <name>%s</name>
+        <capacity unit="bytes">%d</capacity>
+        <target>
+        <format type='%s'/>
+        </target>
+        <backingStore>
+        <path>%s</path>
+        <format type='%s'/>
+        </backingStore>
+        </volume>""" % (os.path.basename(overlay), entry['capacity'], settings.SETTINGS['SNAPSHOT_FORMAT'], base,
+                        base_format.get('type') if base_format is not None else 'raw')
+        volume = pool.createXML(xml, 0)
+        volumes.add(pool, volume)
+        return volume
+
+    def revert_snapshot(self, name):
+        """
+        Reverts disks of the snapshot on shut off domain. Their overlays from the snapshot and all later snapshots
+        are thrown away and they get new empty overlays on the frozen images, so the snapshot stays and can be
+        reverted to again. Later snapshots lose reverted disks, other disks are left as they are.
+        """
+        snapshot = self._get_snapshot(name)
+        if self.domain.isActive():
+            raise libvirt.libvirtError('Domain {} must be shut off to revert snapshot.'.format(self.domain.name()))
+        if self.domain.hasManagedSaveImage(0):
+            self.domain.managedSaveRemove(0)
+
+        later = [item for item in self.list_snapshots() if item['created'] > snapshot['created']]
+        volumes = get_volume_index(self.conn)
+        for item in reversed(later + [snapshot]):
+            for dev, disk in item['disks'].items():
+                if dev in snapshot['disks']:
+                    volumes.delete(disk['overlay'])
+        for disk in snapshot['disks'].values():
+            self._create_overlay(disk['base'], disk['overlay'])
+
+        root = ET.fromstring(self.domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE | libvirt.VIR_DOMAIN_XML_SECURE))
+        for disk in root.iter('disk'):
+            target = disk.find('target')
+            if target is None or target.get('dev') not in snapshot['disks']:
+                continue
+            disk.find('source').set('file', snapshot['disks'][target.get('dev')]['overlay'])
+            disk.find('driver').set('type', settings.SETTINGS['SNAPSHOT_FORMAT'])
+            for backing in disk.findall('backingStore'):
+                disk.remove(backing)
+        self.conn.defineXML(ET.tostring(root).decode('utf-8'))
+        self.refresh()
+
+        ids = set(item['id'] for item in later)
+        def change(snapshots):
+            for item in snapshots:
+                if item.get('id') in ids:
+                    item['disks'] = dict((dev, disk) for dev, disk in item['disks'].items() if dev not in snapshot['disks'])
+            snapshots[:] = [item for item in snapshots if item.get('id') not in ids or item['disks']]
+        self.snapshots.update_snapshots(change)
+        logging.info('Domain {} reverted to snapshot {}.'.format(self.domain.name(), name))
+        return snapshot
+
+    def delete_snapshot(self, name, bandwidth=None, progress=None):
+        """
+        Deletes snapshot of running domain by merging its overlay into the frozen image with live blockCommit,
+        overlay of the newest snapshot is committed as active layer and disk pivoted back to the image.
+        Bandwidth is in MiB/s. Snapshot taken after this one is rebased on the image.
+        """
+        snapshot = self._get_snapshot(name)
+        if not self.domain.isActive():
+            raise libvirt.libvirtError('Domain {} must be running to merge snapshot.'.format(self.domain.name()))
+        if bandwidth is None:
+            bandwidth = settings.SETTINGS['BLOCK_JOB_BANDWIDTH']
+
+        chains = self.get_backing_chains()
+        volumes = get_volume_index(self.conn)
+        for dev, disk in snapshot['disks'].items():
+            chain = chains.get(dev, {}).get('chain', [])
+            if disk['overlay'] not in chain or disk['base'] not in chain:
+                # layers were already merged, e.g. by flatten
+                logging.warning('Snapshot {} of {} is not in backing chain of {}, nothing to merge.'.format(name, self.domain.name(), dev))
+                continue
+            started = time()
+            if chain[0] == disk['overlay']:
+                self.domain.blockCommit(dev, disk['base'], None, bandwidth, libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+                self.wait_block_ready(dev, progress=progress)
+            else:
+                self.domain.blockCommit(dev, disk['base'], disk['overlay'], bandwidth, 0)
+                self.wait_block_job(dev, progress=progress)
+            volumes.delete(disk['overlay'])
+            logging.info('Snapshot {} of {} merged on {} in {:.3f}s.'.format(name, self.domain.name(), dev, time() - started))
+
+        def change(snapshots):
+            snapshots[:] = [item for item in snapshots if item.get('id') != snapshot['id']]
+            for item in snapshots:
+                for dev, disk in item.get('disks', {}).items():
+                    if item.get('uuid') == snapshot['uuid'] and dev in snapshot['disks'] and disk['base'] == snapshot['disks'][dev]['overlay']:
+                        disk['base'] = snapshot['disks'][dev]['base']
+        self.snapshots.update_snapshots(change)
+        return snapshot
+
     def get_domain_network_interfaces(self):
         """
         Returns a list of all network interfaces attached to the domain.
@@ -141,28 +522,94 @@ class VirtDomain(object):
         random.randint(0x00, 0xff) ]
         return str(':'.join(map(lambda x: "%02x" % x, mac)))
 
-    def get_ip(self, conn):
-        leases = {}
+    def refresh(self):
+        """
+        Drops cached XML of the domain and fetches it again.
+        """
+        xml_cache = get_xml_cache(self.conn)
+        xml_cache.invalidate(self.domain.UUIDString())
+        self.xml = xml_cache.get(self.domain)
+        return self.xml
+
+    def _metadata_flags(self):
+        flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if self.domain.isActive():
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+        return flags
+
+    def get_labels(self):
+        """
+        Returns virtapi labels( key/value pairs kept in domain metadata) from cached XML.
+        """
+        labels = {}
+        root = self.xml.find('metadata/{%s}labels' % settings.SETTINGS['METADATA_NS'])
+        if root is not None:
+            for label in root:
+                if label.tag.split('}')[-1] == 'label':
+                    labels[label.get('name')] = label.text or ''
+        return labels
+
+    def set_labels(self, labels, replace=False):
+        """
+        Merges labels into domain metadata( persistent and live), label with None value is removed.
+        Returns resulting labels.
+        """
+        current = {} if replace else self.get_labels()
+        current.update(labels)
+        current = dict((name, value) for name, value in current.items() if value is not None)
+
+        root = ET.Element('labels')
+        for name in sorted(current):
+            ET.SubElement(root, 'label', name=name).text = str(current[name])
+        self.domain.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, ET.tostring(root).decode('utf-8'), 'virtapi',
+                                settings.SETTINGS['METADATA_NS'], self._metadata_flags())
+        self.refresh()
+        return current
+
+    def get_title(self):
+        title = self.xml.find('title')
+        return title.text if title is not None else None
+
+    def set_title(self, title):
+        self.domain.setMetadata(libvirt.VIR_DOMAIN_METADATA_TITLE, title, None, None, self._metadata_flags())
+        self.refresh()
+
+    def get_macs(self):
+        """
+        Returns MAC addresses of all domain interfaces, in XML order.
+        """
+        macs = []
+        for nic in self.xml.iter('interface'):
+            mac = nic.find('mac')
+            if mac is not None:
+                macs.append(mac.get('address'))
+        return macs
+
+    def get_ips(self, conn=None, active=None):
+        """
+        Returns {mac: [ips]} for every interface of the domain, from shared lease cache.
+        Active state may be passed from bulk stats to save the isActive call.
+        """
         if conn == None:
-            pass
+            conn = self.conn
 
-        for network in conn.listAllNetworks():
-            for lease in network.DHCPLeases():
-                ip = lease['ipaddr']
-                mac = lease['mac']
-                leases[mac] = ip
-        try:
-            vm = self.domain
-            xml = vm.XMLDesc(0)
-            root = ET.fromstring(xml)
-        except:
-            return None
-        nic = root.getiterator('interface')[0]
-        mac = nic.find('mac').get('address')
-        if vm.isActive() and mac in leases:
-            return leases[mac]
-        else:
-            return None
+        macs = self.get_macs()
+        if not macs:
+            return {}
+
+        if active is None:
+            active = self.domain.isActive()
+        return get_lease_cache(conn).lookup(macs, active=active)
+
+    def get_ip(self, conn):
+        """
+        Returns first leased IP address of the domain, or None.
+        """
+        ips = self.get_ips(conn)
+        for mac in self.get_macs():
+            if ips.get(mac):
+                return ips[mac][0]
+        return None
 
     def get_volumes(self, conn, iso=False):
         isos = []
@@ -170,17 +617,10 @@ class VirtDomain(object):
         if conn == None:
             pass
 
-        for storage in conn.listStoragePools():
-            storage = conn.storagePoolLookupByName(storage)
-            storage.refresh(0)
-            storagexml = storage.XMLDesc(0)
-            root = ET.fromstring(storagexml)
-            for element in root.getiterator('path'):
-                storagepath = element.text
-                break
-            for volume in storage.listVolumes():
-                if volume.endswith('iso'):
-                    isos.append("%s/%s" % (storagepath, volume))
+        volumes = get_volume_index(conn).list_volumes()
+        for volume in volumes:
+            if volume.endswith('iso'):
+                isos.append(volumes[volume]['path'])
 
         if iso:
             return isos
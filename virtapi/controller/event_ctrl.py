@@ -0,0 +1,213 @@
+"""
+Libvirt event loop methods and calls
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import libvirt
+import logging
+import threading
+from time import time
+
+from virtapi.settings import SETTINGS
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+
+
+def _run_event_loop():
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except libvirt.libvirtError as e:
+            logging.error('Libvirt event loop iteration failed: {}.'.format(e))
+
+
+def start_event_loop():
+    """
+    Registers default libvirt event loop implementation and runs it in a daemon thread.
+    Must be called before opening connections, keepalive and domain events depend on it.
+    Safe to call multiple times, loop is started only once per process.
+    """
+    global _event_loop_thread
+
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return _event_loop_thread
+
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_thread = threading.Thread(target=_run_event_loop, name='virtapi-event-loop')
+        _event_loop_thread.daemon = True
+        _event_loop_thread.start()
+        logging.info('Libvirt event loop started.')
+        return _event_loop_thread
+
+
+def event_loop_running():
+    return _event_loop_thread is not None
+
+
+class VirtDomainWaiter(object):
+    """
+    Waits until domains become reachable( get an IP address).
+    Lifecycle and guest agent events of waited domains wake the waiter immediately. Addresses are looked up
+    in shared DHCP lease index on every wakeup, guest agent and ARP table of a domain are queried only when
+    an event of that domain arrived. Without events, lease checks back off up to max interval.
+    Callbacks are registered for given domains only, or for the whole connection when domains are not known
+    yet( batch creates), then events of other domains are ignored once wait starts.
+    """
+
+    def __init__(self, conn, timeout=None, domains=None):
+        self.conn = conn
+        self.timeout = timeout if timeout is not None else SETTINGS['DOMAIN_WAIT_TIMEOUT']
+        self.domains = domains
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.watched = None
+        self.events = set()
+        self.agents = set()
+        self.callbacks = []
+
+    def __enter__(self):
+        self.register()
+        return self
+
+    def __exit__(self, *args):
+        self.deregister()
+
+    def _wake(self, domain):
+        uuid = domain.UUIDString()
+        with self.cond:
+            if self.watched is not None and uuid not in self.watched:
+                return
+            self.events.add(uuid)
+            self.generation += 1
+            self.cond.notify_all()
+
+    def _on_lifecycle(self, conn, domain, event, detail, opaque):
+        self._wake(domain)
+
+    def _on_agent(self, conn, domain, state, reason, opaque):
+        if state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED:
+            self.agents.add(domain.UUIDString())
+        else:
+            self.agents.discard(domain.UUIDString())
+        self._wake(domain)
+
+    def register(self):
+        """
+        Registers domain event callbacks on the connection.
+        """
+        events = [(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle)]
+        if hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE'):
+            events.append((libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, self._on_agent))
+
+        for domain in self.domains or [None]:
+            for event_id, callback in events:
+                try:
+                    self.callbacks.append(self.conn.domainEventRegisterAny(domain, event_id, callback, None))
+                except libvirt.libvirtError as e:
+                    logging.warning('Domain event {} not registered: {}.'.format(event_id, e))
+
+    def deregister(self):
+        for callback in self.callbacks:
+            try:
+                self.conn.domainEventDeregisterAny(callback)
+            except libvirt.libvirtError:
+                pass
+        self.callbacks = []
+
+    def _interface_addresses(self, domain, source):
+        try:
+            interfaces = domain.interfaceAddresses(source, 0)
+        except libvirt.libvirtError:
+            return []
+        ips = []
+        for name, interface in (interfaces or {}).items():
+            for address in interface.get('addrs') or []:
+                if address['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4 and not address['addr'].startswith('127.'):
+                    ips.append(address['addr'])
+        return ips
+
+    def get_addresses(self, domains, probe=None):
+        """
+        Returns {name: [ips]} for domains which already have an address.
+        Leases are looked up in one sweep for all domains, agent and ARP only for the rest whose
+        UUID is in probe( all when probe is None).
+        """
+        from virtapi.controller.network_ctrl import get_lease_cache
+
+        found = {}
+        # one lookup for all MACs, so a miss costs at most one sweep
+        ips = get_lease_cache(self.conn).lookup([mac for domain, macs in domains for mac in macs])
+        for domain, macs in domains:
+            addresses = [ip for mac in macs for ip in ips.get(mac, [])]
+            if addresses:
+                found[domain.name()] = addresses
+
+        for domain, macs in domains:
+            if domain.name() in found or (probe is not None and domain.UUIDString() not in probe):
+                continue
+            addresses = []
+            if domain.UUIDString() in self.agents:
+                addresses = self._interface_addresses(domain, libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT)
+            if not addresses and hasattr(libvirt, 'VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP'):
+                addresses = self._interface_addresses(domain, libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP)
+            if addresses:
+                found[domain.name()] = addresses
+        return found
+
+    def wait(self, domains, timeout=None):
+        """
+        Waits for list of domain objects, returns {name: [ips]}, None for domains which timed out.
+        """
+        from virtapi.controller.domain_ctrl import VirtDomain
+
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time() + timeout
+        interval = SETTINGS['DOMAIN_WAIT_MIN_INTERVAL']
+
+        pending = [(domain, VirtDomain(domain=domain).get_macs()) for domain in domains]
+        result = dict((domain.name(), None) for domain in domains)
+        with self.cond:
+            self.watched = set(domain.UUIDString() for domain in domains)
+
+        # first check probes every domain, later ones only domains with new events
+        probe_all = True
+        while pending:
+            with self.cond:
+                generation = self.generation
+                events = self.events
+                self.events = set()
+
+            found = self.get_addresses(pending, probe=None if probe_all else events)
+            probe_all = False
+            for name in found:
+                result[name] = found[name]
+            pending = [(domain, macs) for domain, macs in pending if domain.name() not in found]
+
+            remaining = deadline - time()
+            if not pending or remaining <= 0:
+                break
+
+            with self.cond:
+                if self.generation == generation:
+                    self.cond.wait(min(interval, remaining))
+                woken = self.generation != generation
+
+            if woken:
+                interval = SETTINGS['DOMAIN_WAIT_MIN_INTERVAL']
+            else:
+                interval = min(interval * 2, SETTINGS['DOMAIN_WAIT_MAX_INTERVAL'])
+
+        for domain, macs in pending:
+            logging.warning('Domain {} not reachable after {}s.'.format(domain.name(), timeout))
+        return result
+
+
+def wait_for_domains(conn, domains, timeout=None):
+    """
+    Shortcut for waiting on already started domains.
+    """
+    with VirtDomainWaiter(conn, timeout=timeout, domains=domains) as waiter:
+        return waiter.wait(domains)
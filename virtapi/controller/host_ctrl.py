@@ -4,25 +4,47 @@ __author__ = Strahinja Piperac <spiperac@denkei.org>
 """
 
 import xml.etree.ElementTree as ET
-import xmltodict, json, random, uuid, requests
+import xmltodict, json, random, uuid
 import libvirt, os, string, re
 import shutil, logging
 from virtapi import utilities
 
-import subprocess
-from time import sleep
-from lxml import etree
-from lxml.builder import E, ElementMaker
+import subprocess, copy, hashlib, threading, fnmatch
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
 
 from virtapi.settings import *
 from virtapi.model.template import Templates
 from virtapi.model.host import Hosts
-from virtapi.controller.domain_ctrl import VirtDomain
+from virtapi.model.pool import WarmPool
+from virtapi.controller.domain_ctrl import VirtDomain, get_xml_cache, state_active
+from virtapi.controller.connection_ctrl import connection_pool
+from virtapi.controller.network_ctrl import get_lease_cache
+from virtapi.controller.storage_ctrl import get_volume_index, upload_file, upload_url, upload_bytes
+from virtapi.controller.event_ctrl import VirtDomainWaiter
 
 
 KB = 1024 * 1024
 MB = 1024 * KB
 
+# listAllDomains filters by state name, evaluated on the hypervisor side
+DOMAIN_LIST_FILTERS = {
+    'active': 'VIR_CONNECT_LIST_DOMAINS_ACTIVE',
+    'inactive': 'VIR_CONNECT_LIST_DOMAINS_INACTIVE',
+    'running': 'VIR_CONNECT_LIST_DOMAINS_RUNNING',
+    'paused': 'VIR_CONNECT_LIST_DOMAINS_PAUSED',
+    'shutoff': 'VIR_CONNECT_LIST_DOMAINS_SHUTOFF',
+    'other': 'VIR_CONNECT_LIST_DOMAINS_OTHER',
+    'persistent': 'VIR_CONNECT_LIST_DOMAINS_PERSISTENT',
+    'transient': 'VIR_CONNECT_LIST_DOMAINS_TRANSIENT',
+    'managedsave': 'VIR_CONNECT_LIST_DOMAINS_MANAGEDSAVE',
+    'autostart': 'VIR_CONNECT_LIST_DOMAINS_AUTOSTART',
+}
+
+# flags removing snapshot, checkpoint metadata, managed save image and NVRAM together with the domain
+UNDEFINE_FLAGS = ('VIR_DOMAIN_UNDEFINE_MANAGED_SAVE', 'VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA',
+                  'VIR_DOMAIN_UNDEFINE_CHECKPOINTS_METADATA', 'VIR_DOMAIN_UNDEFINE_NVRAM')
+
 class VirtHost(object):
 
     def __init__(self, host=None):
@@ -32,6 +54,11 @@ class VirtHost(object):
         self.host_manager = Hosts()
         self.template_manager = Templates()
         self.conn_status = False
+        self.last_upload = None
+        self.seed_lock = threading.Lock()
+        self.warm_pools = []
+        self.warm_lock = threading.Lock()
+        self.max_memory_usage = SETTINGS['MAX_MEMORY_USAGE']
 
         self.host = host
         if self.host is not None:
@@ -55,32 +82,13 @@ class VirtHost(object):
 
     def connect(self):
         """
-        Returns None in case of failed connection.
+        Returns False in case of failed connection.
+        Connections are reused from the connection pool, so calling it per operation is cheap.
         """
-        conn = None
         if self.conn_status is False:
             return False
-        
-
-        if self.host_protocol == 'libssh2':
-            self.auth = [[libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE], self.request_cred, None]
-            if self.host_url == None:
-                conn = libvirt.open("qemu:///system")
-            else:
-                url = "{}://{}/?sshauth=password".format(VIRT_CONN_LIBSSH2, self.host_url)
-                conn = libvirt.openAuth(url, self.auth, 0)
-
-        elif self.host_protocol == 'ssh':
-            if self.host_url == None:
-                conn = libvirt.open("qemu:///system")
-            else:
-                url = "{}://{}@{}/system?socket=/var/run/libvirt/libvirt-sock&keyfile={}".format(VIRT_CONN_SSH, self.host_username, 
-                                                                                                                    self.host_url, 
-                                                                                                                    self.host_key)
-                conn = libvirt.open(url)
 
-        elif self.host_protocol == 'qemu':
-            conn = libvirt.open("qemu:///system")
+        conn = connection_pool.get(self.host)
 
         if conn == None:
             logging.error('Connection to hypervisor failed!')
@@ -88,24 +96,91 @@ class VirtHost(object):
         else:
             logging.info('Connection succesfull.')
             self.conn = conn
-            SETTINGS['connection'] = self.conn
 
     def get_conn(self):
         return self.conn
 
+    def get_connection_stats(self):
+        """
+        Returns connection pool counters (hits, misses, reconnects, handshake time).
+        """
+        return json.dumps(connection_pool.get_stats())
+
     def get_all_domains(self):
         """
         Returns a list of domain names, with UUIDString for each.
+        States are fetched with a single bulk stats call, name and UUID are local to domain objects.
         """
-        all_domains_list = self.conn.listAllDomains()
+        all_domains_stats = self.get_domains_stats(stats=libvirt.VIR_DOMAIN_STATS_STATE)
         response = []
-        if all_domains_list == None:
+        if all_domains_stats == None:
             return False
         else:
-            for domain in all_domains_list:
-                    response.append( { "name": domain.name(), "uuid":  domain.UUIDString(), "state": domain.isActive() })
+            for domain, stats in all_domains_stats:
+                    response.append( { "name": domain.name(), "uuid":  domain.UUIDString(), "state": self._stats_active(stats) })
             return json.dumps(response)
-    
+
+    def get_all_domains_long(self):
+        """
+        Returns a list of domains with state, vCPU, balloon memory and block totals.
+        Everything is fetched in one bulk stats call, regardless of number of domains.
+        """
+        all_domains_stats = self.get_domains_stats()
+        response = []
+        if all_domains_stats == None:
+            return False
+        for domain, stats in all_domains_stats:
+            state = stats.get('state.state', libvirt.VIR_DOMAIN_NOSTATE)
+            capacity = 0
+            allocation = 0
+            for disk in range(stats.get('block.count', 0)):
+                capacity += stats.get('block.{}.capacity'.format(disk), 0)
+                allocation += stats.get('block.{}.allocation'.format(disk), 0)
+            response.append({
+                "name": domain.name(),
+                "uuid": domain.UUIDString(),
+                "state": self._stats_active(stats),
+                "state_name": DOMAIN_STATES.get(state, 'Unknown'),
+                "vcpu": stats.get('vcpu.current', 0),
+                "vcpu_max": stats.get('vcpu.maximum', 0),
+                "ram": stats.get('balloon.current', 0),
+                "ram_max": stats.get('balloon.maximum', 0),
+                "disks": stats.get('block.count', 0),
+                "capacity": capacity,
+                "allocation": allocation,
+            })
+        return json.dumps(response)
+
+    def get_domains_stats(self, domains=None, stats=None, flags=0):
+        """
+        Returns a list of (domain object, stats dict) tuples in one round trip.
+        Uses getAllDomainStats for all domains, or domainListGetStats for given domain objects.
+        """
+        if stats is None:
+            stats = (libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU |
+                     libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_BLOCK)
+        if domains is None:
+            return self.conn.getAllDomainStats(stats, flags)
+        if not domains:
+            return []
+        return self.conn.domainListGetStats(domains, stats, flags)
+
+    def get_domains_ips(self, domains=None):
+        """
+        Returns {name: {mac: [ips]}} for all( or given) domains. State comes from one bulk stats call and
+        leases from one sweep, inactive domains are skipped without lookup.
+        """
+        response = {}
+        for domain, stats in self.get_domains_stats(domains, stats=libvirt.VIR_DOMAIN_STATS_STATE):
+            response[domain.name()] = VirtDomain(domain=domain).get_ips(self.conn, active=self._stats_active(stats))
+        return response
+
+    def _stats_active(self, stats):
+        """
+        Returns 1 if domain state from bulk stats is active, 0 otherwise( same int isActive returns).
+        """
+        return int(state_active(stats.get('state.state', libvirt.VIR_DOMAIN_NOSTATE), stats.get('state.reason')))
+
     def get_all_domains_objects(self):
         """
         Returns a list of domain objects.
@@ -124,13 +199,16 @@ class VirtHost(object):
 
     def get_domain_object_by_name(self, name):
         """
-        Return domain object.
+        Return domain object. Domains handed over by a warm pool keep name of the spare, they are
+        found by their warm_name label as well.
         """
-        domain = self.conn.lookupByName(name)
-        if domain is not None:
-            return domain
-        else:
-            return None
+        try:
+            return self.conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            for domain in self.conn.listAllDomains(0):
+                if domain.name().startswith('warm-') and VirtDomain(domain=domain).get_labels().get('warm_name') == name:
+                    return domain
+            raise e
 
     def get_host_info(self):
         """
@@ -150,14 +228,43 @@ class VirtHost(object):
         memory = self.conn.getMemoryStats(0)
         return json.dumps(memory)
 
+    def collect_inventory(self):
+        """
+        Returns dict with host info, memory stats, domains, pools and networks.
+        """
+        info = self.conn.getInfo()
+        inventory = {}
+        inventory['info'] = {'arch': info[0], 'ram': info[1], 'cpu_cores': info[2], 'cpu_mhz': info[3]}
+        inventory['memory'] = self.conn.getMemoryStats(libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS)
+        inventory['domains'] = json.loads(self.get_all_domains())
+
+        inventory['pools'] = []
+        for pool in self.get_all_storage_pools_objects():
+            pool_info = pool.info()
+            inventory['pools'].append({'name': pool.name(), 'capacity': pool_info[1],
+                                       'allocation': pool_info[2], 'available': pool_info[3]})
+
+        inventory['networks'] = []
+        for network in self.conn.listAllNetworks():
+            inventory['networks'].append({'name': network.name(), 'uuid': network.UUIDString(),
+                                          'active': network.isActive()})
+        return inventory
+
+    def get_host_inventory(self):
+        """
+        Returns inventory of the host (info, memory, domains, pools, networks).
+        """
+        return json.dumps(self.collect_inventory())
+
     def get_host_cpu_stats(self):
         """
-        Returns stats for CPU cores.
+        Returns stats for online CPU cores.
         Format is { cpu_core_number: stats }
         """
-        cores = self.conn.getInfo()[2]
+        online = self.conn.getCPUMap()[1]
         stats = []
-        for core in range(1,cores):
+        for core, active in enumerate(online):
+            if active:
                 stats.append({core: self.conn.getCPUStats(core)})
         return json.dumps(stats)
 
@@ -200,9 +307,9 @@ class VirtHost(object):
         """
         Gets pool object based on the name parameter.
         """
-        for pool in  self.get_all_storage_pools_objects():
-            if pool.name() == name:
-                return pool
+        pool = get_volume_index(self.conn).get_pool(name)
+        if pool is not None:
+            return pool['pool']
     
     def get_pool_state(self, name):
         '''
@@ -223,7 +330,9 @@ class VirtHost(object):
             </target>
         </pool>
         """.format(name, name)
-        self.host_manager.ssh_exec('mkdir /var/lib/libvirt/{}'.format(name))
+        result = self.host_manager.ssh_exec('mkdir -p /var/lib/libvirt/{}'.format(name))
+        if result['status'] != 0:
+            logging.error('Creating pool directory for {} failed: {}'.format(name, result['error'] or result['stderr']))
         pool = self.conn.storagePoolDefineXML(xmlDesc, 0)
         pool.create(0)
         pool.setAutostart(1)
@@ -263,8 +372,11 @@ class VirtHost(object):
         return pool_stoped
     
   
-    def create_domain_from_template(self, template, params, cloudinit=True, start=True):
-        
+    def get_template_tree(self, template):
+        """
+        Returns parsed XML of the template domain, creating template domain first if it is missing.
+        Returns None if template is not defined in templates list.
+        """
         # Checking if templates exists in template list file
         if self.template_manager.exists(template) is False:
             logging.info('Template selected does not exist.')
@@ -281,9 +393,64 @@ class VirtHost(object):
             self.create_template(temp)
             template_vm = self.conn.lookupByName(template)
 
-        template_xml = template_vm.XMLDesc(0)
-        tree = ET.fromstring(template_xml)
-        
+        return get_xml_cache(self.conn).get(template_vm, copy_tree=True)
+
+    def add_warm_pool(self, template, plan, size=None, mode=None, reseed=None, background=True):
+        """
+        Registers warm pool of spares for template and plan, create_domain_from_template hands them out.
+        Pool already registered for the same template and plan is returned instead of adding another one.
+        """
+        with self.warm_lock:
+            for pool in self.warm_pools:
+                if pool.template == template and pool.plan['name'] == plan['name']:
+                    return pool
+            pool = WarmPool(self, template, plan, size=size, mode=mode, reseed=reseed)
+            self.warm_pools.append(pool)
+        if background:
+            pool.start()
+        return pool
+
+    def get_warm_pool(self, template, params):
+        for pool in self.warm_pools:
+            if pool.matches(template, params):
+                return pool
+        return None
+
+    def create_domain_from_template(self, template, params, cloudinit=True, start=True, timeout=None, warm=True):
+        if warm and start:
+            pool = self.get_warm_pool(template, params)
+            if pool is not None:
+                vm = pool.acquire(params['name'], seed=params.get('seed'), labels=params.get('labels'), timeout=timeout)
+                if vm is not None:
+                    return vm
+
+        tree = self.get_template_tree(template)
+        if tree is None:
+            return None
+
+        # setting up cloud init
+        cloudinit_image_path = None
+        if cloudinit:
+            seed = {'hostname': params['name']}
+            seed.update(params.get('seed') or {})
+            cloudinit_image_path = self._seed_volume(seed)
+
+        vm = self._define_from_tree(tree, params, cloudinit_image_path)
+        if vm is None:
+            return None
+
+        if start:
+            if self._start_and_wait(vm, timeout) is None:
+                logging.warning('Domain {} started, but it is not reachable yet.'.format(params['name']))
+            self._auto_flatten(vm)
+        logging.info('Domain {} created!'.format(params['name']))
+        return vm
+
+    def _define_from_tree(self, tree, params, cloudinit_image_path=None):
+        """
+        Creates overlay volumes and defines a new domain from parsed template XML.
+        Tree is modified in place. Returns domain object, or None if define failed.
+        """
         # check hw params
         if 'ram' in params:
             if params['ram'] == None:
@@ -335,22 +502,10 @@ class VirtHost(object):
         for vcpu in tree.getiterator('vcpu'):
             vcpu.text= str(params['vcpu'])
         
-        # setting up cloud init
-        cloudinit_disk = "{}-ds.iso".format(params['name'])
-        if cloudinit:
-            utilities.cloudinit(cloudinit_disk)
-            cloudinit_image_path = self._uploadimage(cloudinit_disk,cloudinit_disk)
-        
-        cloudinit_volume = ET.Element("disk", type = 'file', device = 'disk')
-        ET.SubElement(cloudinit_volume, "driver", name = 'qemu', type = 'raw')
-        ET.SubElement(cloudinit_volume, "source", file = "{}".format(cloudinit_image_path))
-        ET.SubElement(cloudinit_volume, "target", dev = 'vdb', bus = 'virtio')
-        
         # disk/volume creation
         firstdisk = True
         full=False
         volumes = []
-        volumes.append(cloudinit_image_path)
 
         for disk in tree.getiterator('disk'):
             if firstdisk or full:
@@ -368,13 +523,13 @@ class VirtHost(object):
                 old_name = os.path.basename(oldpath)
                 newpath = oldpath.replace(old_name, params['name'])
                 source.set('file', newpath)
-                oldvolume = self.conn.storageVolLookupByPath(oldpath)
-                oldinfo = oldvolume.info()
-                oldvolumesize = (float(oldinfo[1]) / MB)
+                volume_index = get_volume_index(self.conn)
+                oldvolume = volume_index.get_info(volume_index.get_by_path(oldpath))
+                oldvolumesize = (float(oldvolume['capacity']) / MB)
                 newvolumesize = float(params['diskSize'])
                 newvolumexml = self._xmlvolume(newpath, newvolumesize, backing=oldpath)
-                pool = oldvolume.storagePoolLookupByVolume()
-                pool.createXML(newvolumexml, 0)
+                pool = volume_index.get_pool(oldvolume['pool'])['pool']
+                volume_index.add(pool, pool.createXML(newvolumexml, 0))
                 
                 volumes.append(newpath)
                 firstdisk = False
@@ -382,34 +537,111 @@ class VirtHost(object):
                 devices = tree.getiterator('devices')[0]
                 devices.remove(disk)
 
-        for element in tree.getiterator('devices'):
-            element.append(cloudinit_volume)
+        if cloudinit_image_path is not None:
+            cloudinit_volume = ET.Element("disk", type = 'file', device = 'disk')
+            ET.SubElement(cloudinit_volume, "driver", name = 'qemu', type = 'raw')
+            ET.SubElement(cloudinit_volume, "source", file = "{}".format(cloudinit_image_path))
+            ET.SubElement(cloudinit_volume, "target", dev = 'vdb', bus = 'virtio')
+            ET.SubElement(cloudinit_volume, "readonly")
+            for element in tree.getiterator('devices'):
+                element.append(cloudinit_volume)
 
         for interface in tree.getiterator('interface'):
             mac = interface.find('mac')
             interface.remove(mac)
         newxml = ET.tostring(tree)
         try:
-            self.conn.defineXML(newxml)
+            vm = self.conn.defineXML(newxml)
         except Exception as e:
             logging.error('Domain creation failed: {}.'.format(e))
             print("Creation failed, cleaning up resources.")
             for volume in volumes:
-                vol = self.conn.storageVolLookupByPath(volume)
-                vol.delete(0)
+                get_volume_index(self.conn).delete(volume)
             return None
 
-        vm = self.conn.lookupByName(params['name'])
-        new_domain = VirtDomain(domain=vm)
-        if start:
-            vm.setAutostart(1)
-            vm.create()
-            while new_domain.get_ip(self.conn) == None:
-                sleep(1)
-        logging.info('Domain {} created!'.format(params['name']))
+        if params.get('labels'):
+            VirtDomain(domain=vm).set_labels(params['labels'])
         return vm
 
-    def clone_domain(self, template, params, start=False):
+    def create_many(self, template, plan, names=None, count=None, prefix=None, concurrency=None,
+                    cloudinit=True, start=True, timeout=None, seed=None, labels=None):
+        """
+        Creates many domains from one template and plan.
+        Template XML is parsed once, every domain gets cloud init seed with its own hostname( seed context is
+        merged in), volume creation, defines and boots run concurrently( at most concurrency at once) and all
+        domains are awaited together.
+        Returns per domain result and aggregate throughput.
+        """
+        if names is None:
+            if prefix is None:
+                prefix = template
+            names = ["{}-{}".format(prefix, index) for index in range(1, int(count or 0) + 1)]
+        if concurrency is None:
+            concurrency = SETTINGS['BATCH_CONCURRENCY']
+
+        started = time()
+        response = {'domains': {}, 'created': 0, 'failed': 0}
+        for name in names:
+            response['domains'][name] = {'created': False, 'ip': None, 'error': None, 'time': None}
+
+        tree = self.get_template_tree(template)
+        if tree is None or not names:
+            response['failed'] = len(names)
+            response['elapsed'] = time() - started
+            response['throughput'] = 0.0
+            return response
+
+        def create_one(name):
+            domain_started = time()
+            try:
+                cloudinit_image_path = None
+                if cloudinit:
+                    domain_seed = {'hostname': name}
+                    domain_seed.update(seed or {})
+                    cloudinit_image_path = self._seed_volume(domain_seed)
+                params = {'name': name, 'ram': plan.get('ram'), 'vcpu': plan.get('vcpu'), 'diskSize': plan.get('diskSize'),
+                          'labels': labels}
+                vm = self._define_from_tree(copy.deepcopy(tree), params, cloudinit_image_path)
+                if vm is None:
+                    raise Exception('Domain define failed.')
+                if start:
+                    vm.setAutostart(1)
+                    vm.create()
+                return name, vm, None, time() - domain_started
+            except Exception as e:
+                logging.error('Batch creation of domain {} failed: {}.'.format(name, e))
+                return name, None, str(e), time() - domain_started
+
+        with VirtDomainWaiter(self.conn, timeout=timeout) as waiter:
+            pool = ThreadPool(max(1, min(concurrency, len(names))))
+            try:
+                results = pool.map(create_one, names)
+            finally:
+                pool.close()
+                pool.join()
+
+            created = []
+            for name, vm, error, elapsed in results:
+                response['domains'][name]['error'] = error
+                response['domains'][name]['time'] = elapsed
+                if vm is not None:
+                    response['domains'][name]['created'] = True
+                    created.append(vm)
+
+            if start and created:
+                ips = waiter.wait(created)
+                for name in ips:
+                    response['domains'][name]['ip'] = ips[name]
+                    response['domains'][name]['time'] = time() - started
+
+        response['created'] = len(created)
+        response['failed'] = len(names) - len(created)
+        response['elapsed'] = time() - started
+        response['throughput'] = len(created) / response['elapsed'] if response['elapsed'] > 0 else 0.0
+        logging.info('Batch created {} domains from {} in {:.2f}s.'.format(len(created), template, response['elapsed']))
+        return response
+
+    def clone_domain(self, template, params, start=False, timeout=None):
 
         try:
             template_vm = self.conn.lookupByName(template)
@@ -420,8 +652,7 @@ class VirtHost(object):
 
         
         template_info = json.loads(VirtDomain(domain=template_vm).get_info(self.conn))
-        template_xml = template_vm.XMLDesc(0)
-        tree = ET.fromstring(template_xml)
+        tree = get_xml_cache(self.conn).get(template_vm, copy_tree=True)
         
         # disk/volume creation
         firstdisk = True
@@ -442,13 +673,13 @@ class VirtHost(object):
                 old_name = os.path.basename(oldpath)
                 newpath = oldpath.replace(old_name, params['name'])
                 source.set('file', newpath)
-                oldvolume = self.conn.storageVolLookupByPath(oldpath)
-                oldinfo = oldvolume.info()
-                oldvolumesize = (float(oldinfo[1]) / MB)
+                volume_index = get_volume_index(self.conn)
+                oldvolume = volume_index.get_info(volume_index.get_by_path(oldpath))
+                oldvolumesize = (float(oldvolume['capacity']) / MB)
                 newvolumesize = oldvolumesize
                 newvolumexml = self._xmlvolume(newpath, newvolumesize, backing=oldpath)
-                pool = oldvolume.storagePoolLookupByVolume()
-                pool.createXML(newvolumexml, 0)
+                pool = volume_index.get_pool(oldvolume['pool'])['pool']
+                volume_index.add(pool, pool.createXML(newvolumexml, 0))
                 firstdisk = False
             else:
                 devices = tree.getiterator('devices')[0]
@@ -483,54 +714,174 @@ class VirtHost(object):
             logging.error('Cloning domain failed: {}.'.format(e))
             return None
         vm = self.conn.lookupByName(params['name'])
-        new_domain = VirtDomain(domain=vm)
         if start:
-            vm.setAutostart(1)
-            vm.create()
-            while new_domain.get_ip(self.conn) == None:
-                sleep(1)
+            if self._start_and_wait(vm, timeout) is None:
+                logging.warning('Domain {} started, but it is not reachable yet.'.format(params['name']))
+            self._auto_flatten(vm)
         logging.info('Domain {} cloned!'.format(params['name']))
         return vm
 
+    def _auto_flatten(self, vm):
+        """
+        Flattens disks of new running domain in background when its backing chain is over MAX_CHAIN_DEPTH.
+        """
+        if not SETTINGS['AUTO_FLATTEN']:
+            return None
+        thread = threading.Thread(target=self.enforce_chain_depth, args=(vm.name(),), name='virtapi-flatten')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def enforce_chain_depth(self, name=None, max_depth=None, bandwidth=None, wait=True, progress=None):
+        """
+        Flattens disks of running domain( or all running domains) whose backing chain is deeper than max_depth.
+        Returns {domain name: [flattened devs]}.
+        """
+        if max_depth is None:
+            max_depth = SETTINGS['MAX_CHAIN_DEPTH']
+        if name is not None:
+            domains = [self.get_domain_object_by_name(name)]
+        else:
+            domains = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+
+        flattened = {}
+        for domain in domains:
+            if not domain.isActive():
+                continue
+            virtdomain = VirtDomain(domain=domain)
+            for dev, chain in virtdomain.get_backing_chains().items():
+                if chain['depth'] <= max_depth:
+                    continue
+                try:
+                    if virtdomain.flatten_disk(dev, max_depth=max_depth, bandwidth=bandwidth, wait=wait, progress=progress):
+                        flattened.setdefault(domain.name(), []).append(dev)
+                except libvirt.libvirtError as e:
+                    logging.error('Flattening {} of {} failed: {}.'.format(dev, domain.name(), e))
+        return flattened
+
+    def _start_and_wait(self, vm, timeout=None):
+        """
+        Starts domain and waits until it is reachable, at most timeout seconds.
+        Returns list of IP addresses, or None on timeout.
+        """
+        with VirtDomainWaiter(self.conn, timeout=timeout, domains=[vm]) as waiter:
+            vm.setAutostart(1)
+            vm.create()
+            return waiter.wait([vm])[vm.name()]
+
 
 
+    def _create_image_volume(self, newname, pool='default'):
+        """
+        Creates empty raw volume for image upload, returns its path and volume object.
+        """
+        volume_index = get_volume_index(self.conn)
+        _pool = volume_index.get_pool(pool)
+        imagepath = "%s/%s" % (_pool['path'], newname)
+        imagexml = self._xmlvolume(path=imagepath, size=0, diskformat='raw')
+        imagevolume = _pool['pool'].createXML(imagexml, 0)
+        volume_index.add(_pool['pool'], imagevolume)
+        return imagepath, imagevolume
+
+    def _seed_volume(self, context=None, pool='default'):
+        """
+        Returns path of cloud init seed volume for the context. Seeds are named by content hash, so
+        identical seeds share one read only volume instead of uploading a new ISO for every domain.
+        """
+        data = utilities.cloudinit_seed(context)
+        name = "{}{}.iso".format(SETTINGS['SEED_VOLUME_PREFIX'], hashlib.sha256(data).hexdigest()[:16])
+        volume_index = get_volume_index(self.conn)
+
+        with self.seed_lock:
+            entry = volume_index.get_by_name(name)
+            if entry is not None:
+                return entry['path']
+
+            try:
+                imagepath, imagevolume = self._create_image_volume(name, pool=pool)
+            except libvirt.libvirtError:
+                # created meanwhile by another client
+                volume_index.refresh(pool, rescan=True)
+                entry = volume_index.get_by_name(name)
+                if entry is None:
+                    raise
+                return entry['path']
+
+            try:
+                upload_bytes(self.conn, imagevolume, data)
+            except Exception:
+                volume_index.delete(imagepath)
+                raise
+            logging.info('Seed volume {} created.'.format(name))
+            return imagepath
+
+    def _used_volume_paths(self):
+        """
+        Returns set of file paths referenced by any defined domain.
+        """
+        used = set()
+        xml_cache = get_xml_cache(self.conn)
+        for domain in self.conn.listAllDomains(0):
+            try:
+                root = xml_cache.get(domain)
+            except libvirt.libvirtError as e:
+                # undefined meanwhile by a concurrent delete
+                logging.debug('Domain vanished while collecting volume paths: {}.'.format(e))
+                continue
+            for source in root.getiterator('source'):
+                if source.get('file'):
+                    used.add(source.get('file'))
+        return used
+
+    def _delete_unused_seeds(self, paths):
+        """
+        Deletes seed volumes from paths which no domain references any more, returns deleted paths.
+        """
+        used = self._used_volume_paths()
+        volume_index = get_volume_index(self.conn)
+        deleted = []
+        for path in paths:
+            if path in used:
+                continue
+            try:
+                if volume_index.delete(path):
+                    deleted.append(path)
+            except libvirt.libvirtError as e:
+                # deleted meanwhile by another domain delete
+                logging.warning('Seed volume {} not deleted: {}.'.format(path, e))
+        return deleted
+
+    def prune_seed_volumes(self):
+        """
+        Deletes seed volumes not used by any domain, returns list of deleted paths.
+        """
+        used = self._used_volume_paths()
+        volume_index = get_volume_index(self.conn)
+        deleted = []
+        for name, volume in volume_index.list_volumes().items():
+            if name.startswith(SETTINGS['SEED_VOLUME_PREFIX']) and volume['path'] not in used:
+                volume_index.delete(volume['path'])
+                deleted.append(volume['path'])
+        logging.info('Pruned {} unused seed volumes.'.format(len(deleted)))
+        return deleted
+
     def _uploadimage(self, name, newname, pool='default', origin='/tmp', suffix='.iso'):
         name = "%s" % (name)
-        _pool = self.conn.storagePoolLookupByName(pool)
-        poolxml = _pool.XMLDesc(0)
-        root = ET.fromstring(poolxml)
-        for element in root.getiterator('path'):
-            poolpath = element.text
-            break
-        imagepath = "%s/%s" % (poolpath, newname)
-        imagexml = self._xmlvolume(path=imagepath, size=0, diskformat='raw')
-        _pool.createXML(imagexml, 0)
-        imagevolume = self.conn.storageVolLookupByPath(imagepath)
-        stream = self.conn.newStream(0)
-        imagevolume.upload(stream, 0, 0)
-        with open("%s/%s" % (origin, name)) as ori:
-            stream.sendAll(self.handler, ori)
-            stream.finish()
+        imagepath, imagevolume = self._create_image_volume(newname, pool=pool)
+        self.last_upload = upload_file(self.conn, imagevolume, "%s/%s" % (origin, name))
         return imagepath
 
-    def fetch_image(self, url, newname, pool='default', origin='/tmp', suffix='.iso'):
-        _pool = self.conn.storagePoolLookupByName(pool)
-        poolxml = _pool.XMLDesc(0)
-        root = ET.fromstring(poolxml)
-        for element in root.getiterator('path'):
-            poolpath = element.text
-            break
-        imagepath = "%s/%s" % (poolpath, newname)
-        imagexml = self._xmlvolume(path=imagepath, size=0, diskformat='raw')
-        _pool.createXML(imagexml, 0)
-        imagevolume = self.conn.storageVolLookupByPath(imagepath)
-        stream = self.conn.newStream(0)
-        imagevolume.upload(stream, 0, 0)
-        http_image = urlopen(url)
-        print("Fetching image from stream.")
-        #for chunk in http_image.iter_content(chunk_size=1024): 
-        stream.sendAll(self.handler, http_image)
-        stream.finish()
+    def fetch_image(self, url, newname, pool='default', checksum=None, tee=None):
+        """
+        Streams image from url directly into a new volume, download and upload overlap.
+        Downloaded data is copied to tee file if set. Volume is removed if the transfer fails.
+        """
+        imagepath, imagevolume = self._create_image_volume(newname, pool=pool)
+        try:
+            self.last_upload = upload_url(self.conn, imagevolume, url, checksum=checksum, tee=tee)
+        except Exception:
+            get_volume_index(self.conn).delete(imagepath)
+            raise
         return imagepath
 
     def _xmldisk(self, diskpath, diskdev, diskbus='virtio', diskformat='qcow2', shareable=False):
@@ -585,15 +936,39 @@ class VirtHost(object):
         </volume>""" % (name, size, path, diskformat, backingstore)
         return volume
 
-    def create_template(self, template):
-        template_dl = self.template_manager.fetch_template(template['os'], template['version'])
-        if template_dl is not None:
-            name = str(template['os']) + str(template['version'])
-            domain_iso = self._uploadimage(template_dl, name)
+    def create_template(self, template, stream=None):
+        """
+        Imports template image into the pool and defines template domain. Cached images are uploaded
+        from template cache, others are streamed from url( stream=True forces streaming) and, with
+        TEMPLATE_CACHE_FILL, copied into template cache on the way.
+        """
+        name = str(template['os']) + str(template['version'])
+        cache = self.template_manager.cache
+        if stream is None:
+            stream = cache.lookup(template['iso'], checksum=template.get('checksum')) is None
+
+        if stream:
+            target = None
+            if SETTINGS['TEMPLATE_CACHE_FILL']:
+                try:
+                    target = cache.prepare(template['iso'], checksum=template.get('checksum'))
+                except Exception as e:
+                    logging.warning('Template {} will not be cached: {}.'.format(name, e))
+            try:
+                domain_iso = self.fetch_image(template['iso'], name, checksum=template.get('checksum'),
+                                              tee=target['path'] if target else None)
+                if target is not None and self.last_upload['teed']:
+                    try:
+                        cache.add_stream(target)
+                    except (IOError, OSError) as e:
+                        logging.warning('Template {} not added to cache: {}.'.format(name, e))
+            finally:
+                if target is not None:
+                    cache.discard(target)
+        else:
+            template_dl = self.template_manager.fetch_template(template['os'], template['version'])
+            domain_iso = self._uploadimage(template_dl, name, origin=cache.directory)
 
-#        template_dl = self.fetch_image(template['iso'], template['name'])
-#        domain_iso_path = SETTINGS['DEFAULTPOOLPATH'] + template['name']
- 
         params = {}
         params['ram'] = 1
         params['vcpu'] = 1
@@ -677,35 +1052,29 @@ class VirtHost(object):
             return
         if not thin:
             diskformat = 'raw'
+        volume_index = get_volume_index(self.conn)
+        pool_entry = None
         if pool is not None:
-            pool = self.conn.storagePoolLookupByName(pool)
-            poolxml = pool.XMLDesc(0)
-            poolroot = ET.fromstring(poolxml)
-            pooltype = poolroot.getiterator('pool')[0].get('type')
-            for element in poolroot.getiterator('path'):
-                poolpath = element.text
-                break
-        else:
+            pool_entry = volume_index.get_pool(pool)
+        if pool_entry is None:
             logging.error('Attempted creating a new disk on non existing pool, failed!')
             print("Pool not found. Leaving....")
             return
+        pool = pool_entry['pool']
+        pooltype = pool_entry['type']
+        poolpath = pool_entry['path']
         if template is not None:
-            volumes = {}
-            for p in self.get_all_storage_pools_objects():
-                poo = self.conn.storagePoolLookupByName(p)
-                for vol in poo.listAllVolumes():
-                    volumes[vol.name()] = vol.path()
-            if template not in volumes and template not in volumes.values():
+            template_volume = volume_index.get_by_name(template) or volume_index.get_by_path(template)
+            if template_volume is None:
                 print("Invalid template %s.Leaving..." % template)
-            if template in volumes:
-                template = volumes[template]
-        pool.refresh(0)
+            else:
+                template = template_volume['path']
         diskpath = "%s/%s" % (poolpath, name)
         if pooltype == 'logical':
             diskformat = 'raw'
         volxml = self._xmlvolume(path=diskpath, size=size, pooltype=pooltype,
                                  diskformat=diskformat, backing=template)
-        pool.createXML(volxml, 0)
+        volume_index.add(pool, pool.createXML(volxml, 0))
         return diskpath
 
     def add_disk(self, name, size, pool=None, thin=True, template=None, shareable=False, existing=None):
@@ -717,9 +1086,8 @@ class VirtHost(object):
         if not thin:
             diskformat = 'raw'
         try:
-            vm = self.conn.lookupByName(name)
-            xml = vm.XMLDesc(0)
-            root = ET.fromstring(xml)
+            vm = self.get_domain_object_by_name(name)
+            root = get_xml_cache(self.conn).get(vm)
         except:
             print("[-] VM {} not found [-]".format(name))
             return
@@ -737,19 +1105,39 @@ class VirtHost(object):
         else:
             diskpath = existing
         diskxml = self._xmldisk(diskpath=diskpath, diskdev=diskdev, diskbus=diskbus, diskformat=diskformat, shareable=shareable)
-        vm.attachDevice(diskxml)
-        vm = self.conn.lookupByName(name)
-        vmxml = vm.XMLDesc(0)
-        self.conn.defineXML(vmxml)
+        self._attach_device(vm, root, diskxml)
         logging.info('New disk added to the {} domain!'.format(name))
-        print('[+] New disk of size {) added to the {} domain, in {} pool! [+]'.format(name, size, pool))
+        print('[+] New disk of size {} added to the {} domain, in {} pool! [+]'.format(size, name, pool))
+
+    def _device_flags(self, vm, root):
+        """
+        Returns flags for device edits, live domains (XML with id) are changed both live and in config.
+        """
+        flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if root.get('id') is not None:
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+        return flags
+
+    def _attach_device(self, vm, root, devicexml):
+        """
+        Attaches device persistently, without refetching and redefining the whole domain XML.
+        """
+        vm.attachDeviceFlags(devicexml, self._device_flags(vm, root))
+        get_xml_cache(self.conn).invalidate(vm.UUIDString())
+
+    def _detach_device(self, vm, root, devicexml):
+        """
+        Detaches device persistently. Live detach completes asynchronously, so cached domain XML is
+        dropped instead of patched.
+        """
+        vm.detachDeviceFlags(devicexml, self._device_flags(vm, root))
+        get_xml_cache(self.conn).invalidate(vm.UUIDString())
 
     def delete_disk(self, name, diskname):
         conn = self.conn
         try:
-            vm = conn.lookupByName(name)
-            xml = vm.XMLDesc(0)
-            root = ET.fromstring(xml)
+            vm = self.get_domain_object_by_name(name)
+            root = get_xml_cache(conn).get(vm)
         except:
             print("VM %s not found" % name)
             return 1
@@ -761,24 +1149,24 @@ class VirtHost(object):
             if disktype == 'cdrom':
                 continue
             diskpath = element.find('source').get('file')
-            volume = self.conn.storageVolLookupByPath(diskpath)
-            if volume.name() == diskname or volume.path() == diskname:
+            volume = get_volume_index(conn).get_by_path(diskpath)
+            if volume is None:
+                continue
+            if volume['name'] == diskname or volume['path'] == diskname:
                 diskxml = self._xmldisk(diskpath=diskpath, diskdev=diskdev, diskbus=diskbus, diskformat=diskformat)
-                vm.detachDevice(diskxml)
-                volume.delete(0)
-                vm = conn.lookupByName(name)
-                vmxml = vm.XMLDesc(0)
-                conn.defineXML(vmxml)
+                self._detach_device(vm, root, diskxml)
+                get_volume_index(conn).delete(diskpath)
                 return
         print("[-] Disk {} not found in {} domain [-]".format(diskname, name))
 
     def list_disks(self):
-        volumes = {}
-        for p in self.get_all_storage_pools_objects():
-            poo = self.conn.storagePoolLookupByName(p)
-            for volume in poo.listAllVolumes():
-                volumes[volume.name()] = {'pool': poo.name(), 'path': volume.path()}
-        return volumes
+        return get_volume_index(self.conn).list_volumes()
+
+    def refresh_storage(self, pool=None):
+        """
+        Rescans one or all storage pools on disk and rebuilds volume index.
+        """
+        get_volume_index(self.conn).refresh(pool=pool, rescan=True)
 
     def create_network(self, name, cidr, dhcp=True, nat=True):
         conn = self.conn
@@ -826,7 +1214,8 @@ class VirtHost(object):
         for net in self.conn.listAllNetworks():
             networks[net.name()] = 'network'
         try:
-            vm = self.conn.lookupByName(name)
+            vm = self.get_domain_object_by_name(name)
+            root = get_xml_cache(self.conn).get(vm)
         except:
             print("VM %s not found" % name)
             return
@@ -837,13 +1226,11 @@ class VirtHost(object):
             networktype = networks[network]
             source = "<source %s='%s'/>" % (networktype, network)
         nicxml = """<interface type='%s'>
+                    <mac address='%s'/>
                     %s
                     <model type='virtio'/>
-                    </interface>""" % (networktype, source)
-        vm.attachDevice(nicxml)
-        vm = self.conn.lookupByName(name)
-        vmxml = vm.XMLDesc(0)
-        self.conn.defineXML(vmxml)
+                    </interface>""" % (networktype, self.randomMAC(), source)
+        self._attach_device(vm, root, nicxml)
 
     def delete_nic(self, name, interface):
         conn = self.conn
@@ -854,9 +1241,8 @@ class VirtHost(object):
         for n in self.conn.listAllNetworks():
             networks[n.name()] = 'network'
         try:
-            vm = self.conn.lookupByName(name)
-            xml = vm.XMLDesc(0)
-            root = ET.fromstring(xml)
+            vm = self.get_domain_object_by_name(name)
+            root = get_xml_cache(self.conn).get(vm)
         except:
             print("VM %s not found" % name)
             return 1
@@ -880,10 +1266,7 @@ class VirtHost(object):
                     <model type='virtio'/>
                     </interface>""" % (networktype, mac, source)
         print(nicxml)
-        vm.detachDevice(nicxml)
-        vm = conn.lookupByName(name)
-        vmxml = vm.XMLDesc(0)
-        conn.defineXML(vmxml)
+        self._detach_device(vm, root, nicxml)
 
 
 
@@ -895,7 +1278,6 @@ class VirtHost(object):
         memory = conn.getInfo()[1]
         print("Host:%s Cpu:%s Memory:%sMB\n" % (hostname, cpus, memory))
         for pool in self.get_all_storage_pools_objects():
-            pool = conn.storagePoolLookupByName(pool.name())
             poolxml = pool.XMLDesc(0)
             root = ET.fromstring(poolxml)
             pooltype = root.getiterator('pool')[0].get('type')
@@ -941,12 +1323,32 @@ class VirtHost(object):
                 dhcp = False
             print("Network:%s Type:routed Cidr:%s Dhcp:%s" % (networkname, cidr, dhcp))
 
-    def delete_domain(self, name):
+        stats = connection_pool.get_stats()
+        print("Connections:%s Hits:%s Misses:%s Reconnects:%s Connect time:%.3fs Saved:%.3fs" % (stats['connections'], stats['hits'],
+                                                                                              stats['misses'], stats['reconnects'],
+                                                                                              stats['connect_time'], stats['saved_time']))
+
+    def _undefine_flags(self):
+        flags = 0
+        for name in UNDEFINE_FLAGS:
+            flags |= getattr(libvirt, name, 0)
+        return flags
+
+    def _delete_volume(self, disk):
+        path = disk.path()
+        disk.delete(0)
+        get_volume_index(self.conn).remove(path)
+        return path
+
+    def delete_domain(self, name, concurrency=None, seeds=None):
         """
         Deleting domain and all of it's parts ( disks, volumes, #TODO: networks).
+        Domain is undefined in one call together with snapshot metadata, managed save and NVRAM,
+        volumes are deleted concurrently afterwards. When seeds list is given, seed volume paths are
+        appended to it instead of being deleted, so bulk deletes can check them once for all domains.
         """
         try:
-            domain = self.conn.lookupByName(name)
+            domain = self.get_domain_object_by_name(name)
             virtual_domain = VirtDomain(domain)
         except:
             print("Domain not found")
@@ -955,23 +1357,133 @@ class VirtHost(object):
         if domain.isActive():
             domain.destroy()
 
-        # cleaning snapshots if exists
-        if domain.snapshotListNames():
-            for snapshot in domain.snapshotListNames():
-                snap = domain.snapshotLookupByName(snapshot)
-                snap.delete()
-        
-        # Deleting disks and volumes
-        domain_xml = domain.XMLDesc(0)
-        root = ET.fromstring(domain_xml)
         disks = virtual_domain.get_disks()
+        uuid = domain.UUIDString()
+
+        # frozen images and overlays of external snapshots are not in the domain XML
+        paths = set(disk.path() for disk in disks)
+        for snapshot in virtual_domain.list_snapshots():
+            for snapshot_disk in snapshot['disks'].values():
+                for path in (snapshot_disk['base'], snapshot_disk['overlay']):
+                    volume = get_volume_index(self.conn).get_volume(path) if path not in paths else None
+                    if volume is not None:
+                        disks.append(volume)
+                        paths.add(path)
+
+        # seed volumes may be shared between domains, they are deleted only when unused after undefine
+        seed_paths = [disk.path() for disk in disks if disk.name().startswith(SETTINGS['SEED_VOLUME_PREFIX'])]
+        disks = [disk for disk in disks if not disk.name().startswith(SETTINGS['SEED_VOLUME_PREFIX'])]
 
-        for disk in disks:
-            disk.delete(0)
+        try:
+            domain.undefineFlags(self._undefine_flags())
+        except libvirt.libvirtError as e:
+            # older hypervisors reject unknown flags, fall back to deleting snapshots one by one
+            logging.warning('Undefine with flags of {} failed, deleting snapshots separately: {}.'.format(name, e))
+            for snapshot in domain.listAllSnapshots(0):
+                snapshot.delete(0)
+            if domain.hasManagedSaveImage(0):
+                domain.managedSaveRemove(0)
+            domain.undefine()
 
-        domain.undefine()
+        # Deleting disks and volumes
+        if len(disks) > 1:
+            pool = ThreadPool(min(len(disks), concurrency or SETTINGS['BULK_CONCURRENCY']))
+            try:
+                pool.map(self._delete_volume, disks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for disk in disks:
+                self._delete_volume(disk)
+
+        get_xml_cache(self.conn).invalidate(uuid)
+        virtual_domain.snapshots.delete_domain_snapshots(uuid)
+        get_lease_cache(self.conn).invalidate()
+
+        if seeds is not None:
+            seeds.extend(seed_paths)
+        elif seed_paths:
+            self._delete_unused_seeds(seed_paths)
         logging.info('Domain {} deleted!'.format(name))
 
+    def select_domains(self, pattern=None, state=None, labels=None):
+        """
+        Returns domain objects selected by glob pattern on name, state( running, paused, shutoff, active,
+        inactive, managedsave, autostart...) and metadata labels {key: value}. State is filtered by hypervisor,
+        labels are read only for domains which passed the other filters.
+        """
+        flags = 0
+        for name in (state or '').split(','):
+            if not name:
+                continue
+            if name not in DOMAIN_LIST_FILTERS:
+                raise ValueError('Unknown domain state {}, use one of: {}.'.format(name, ', '.join(sorted(DOMAIN_LIST_FILTERS))))
+            flags |= getattr(libvirt, DOMAIN_LIST_FILTERS[name])
+
+        domains = self.conn.listAllDomains(flags)
+        if pattern is not None:
+            domains = [domain for domain in domains if fnmatch.fnmatchcase(domain.name(), pattern)]
+        if labels:
+            wanted = dict((key, str(value)) for key, value in labels.items())
+            selected = []
+            for domain in domains:
+                domain_labels = VirtDomain(domain=domain).get_labels()
+                if all(domain_labels.get(key) == value for key, value in wanted.items()):
+                    selected.append(domain)
+            domains = selected
+        return sorted(domains, key=lambda domain: domain.name())
+
+    def bulk_action(self, action, domains, concurrency=None):
+        """
+        Runs action( start, stop, destroy, reboot, suspend, resume, delete) on domain objects in parallel,
+        at most concurrency at once. Returns per domain result and totals.
+        """
+        actions = {
+            'start': lambda domain: domain.create(),
+            'stop': lambda domain: domain.shutdown(),
+            'destroy': lambda domain: domain.destroy(),
+            'reboot': lambda domain: domain.reboot(),
+            'suspend': lambda domain: domain.suspend(),
+            'resume': lambda domain: domain.resume(),
+            'delete': lambda domain: self.delete_domain(domain.name(), seeds=seeds),
+        }
+        # seeds of deleted domains are checked against remaining domains once, after all deletes
+        seeds = []
+        if action not in actions:
+            raise ValueError('Unknown action {}.'.format(action))
+        concurrency = concurrency or SETTINGS['BULK_CONCURRENCY']
+
+        def run(domain):
+            started = time()
+            name = domain.name()
+            try:
+                actions[action](domain)
+                return name, None, time() - started
+            except Exception as e:
+                logging.error('Action {} on domain {} failed: {}.'.format(action, name, e))
+                return name, str(e), time() - started
+
+        started = time()
+        response = {'action': action, 'domains': {}, 'succeeded': 0, 'failed': 0}
+        if domains:
+            pool = ThreadPool(max(1, min(concurrency, len(domains))))
+            try:
+                results = pool.map(run, domains)
+            finally:
+                pool.close()
+                pool.join()
+            if seeds:
+                self._delete_unused_seeds(sorted(set(seeds)))
+            for name, error, elapsed in results:
+                response['domains'][name] = {'ok': error is None, 'error': error, 'time': elapsed}
+                if error is None:
+                    response['succeeded'] += 1
+                else:
+                    response['failed'] += 1
+        response['elapsed'] = time() - started
+        return response
+
     def randomMAC(self):
         mac = [ 0x00, 0x16, 0x3e,
         random.randint(0x00, 0x7f),
@@ -0,0 +1,418 @@
+"""
+Metrics methods and calls
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import libvirt
+import logging
+import threading
+import numpy
+from time import time
+
+from virtapi.settings import SETTINGS
+from virtapi.controller.connection_ctrl import connection_pool, host_uri
+
+CPU_FIELDS = ('user', 'kernel', 'idle', 'iowait', 'steal')
+MEMORY_FIELDS = ('total', 'free', 'buffers', 'cached')
+POOL_FIELDS = ('capacity', 'allocation', 'available')
+
+
+class RingBuffer(object):
+    """
+    Fixed size ring of samples, every sample is a numpy array of given shape with its timestamp.
+    Memory use is constant, oldest samples are overwritten.
+    """
+
+    def __init__(self, size, shape, dtype=numpy.float64):
+        self.size = size
+        self.shape = tuple(shape)
+        self.data = numpy.zeros((size,) + self.shape, dtype=dtype)
+        self.times = numpy.zeros(size, dtype=numpy.float64)
+        self.index = 0
+        self.count = 0
+
+    def append(self, timestamp, sample):
+        self.data[self.index] = sample
+        self.times[self.index] = timestamp
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def get(self, last=None):
+        """
+        Returns (times, samples) of last samples( all kept by default), oldest first.
+        """
+        count = self.count if last is None else min(last, self.count)
+        indexes = (self.index - count + numpy.arange(count)) % self.size
+        return self.times[indexes], self.data[indexes]
+
+    def latest(self):
+        if not self.count:
+            return None
+        return self.data[(self.index - 1) % self.size]
+
+
+def counter_rates(samples):
+    """
+    Turns cumulative CPU counters( samples x rows x CPU_FIELDS) into fractions of elapsed CPU time
+    per interval. Intervals with counter reset( host reboot, core hotplug) are NaN.
+    """
+    delta = numpy.diff(samples, axis=0)
+    total = delta.sum(axis=-1)
+    invalid = (delta < 0).any(axis=-1) | (total <= 0)
+    total[invalid] = numpy.nan
+    return delta / total[..., numpy.newaxis]
+
+
+class HostSampler(object):
+    """
+    Polls host CPU counters, memory and storage pools on an interval into ring buffers.
+    Local hosts read all cores from /proc/stat at once( steal included), remote hosts use getCPUStats,
+    per core or for all CPUs together.
+    """
+
+    def __init__(self, host, interval=None, history=None, per_core=True):
+        self.host = host
+        self.name = host['name']
+        self.interval = interval or SETTINGS['SAMPLER_INTERVAL']
+        self.history = history or SETTINGS['SAMPLER_HISTORY']
+        self.per_core = per_core
+        self.local = host_uri(host) == 'qemu:///system'
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.cores = None
+        self.cpu = None
+        self.memory = RingBuffer(self.history, (len(MEMORY_FIELDS),))
+        self.pools = {}
+        self.samples = 0
+        self.errors = 0
+
+    def _connect(self):
+        conn = connection_pool.get(self.host)
+        if conn is None:
+            raise libvirt.libvirtError('Connection to hypervisor {} failed.'.format(self.name))
+        return conn
+
+    def _read_proc_stat(self):
+        cores = []
+        with open('/proc/stat') as f:
+            for line in f:
+                if not line.startswith('cpu'):
+                    break
+                fields = line.split()
+                if (fields[0] == 'cpu') == self.per_core:
+                    continue
+                values = [int(value) for value in fields[1:9]]
+                values += [0] * (8 - len(values))
+                user, nice, system, idle, iowait, irq, softirq, steal = values
+                cores.append((fields[0], [user + nice, system + irq + softirq, idle, iowait, steal]))
+        return cores
+
+    def _read_cpu_stats(self, conn):
+        if not self.per_core:
+            stats = conn.getCPUStats(libvirt.VIR_NODE_CPU_STATS_ALL_CPUS)
+            return [('cpu', [stats.get(field, 0) for field in CPU_FIELDS])]
+
+        cores = []
+        online = conn.getCPUMap()[1]
+        for core, active in enumerate(online):
+            if active:
+                stats = conn.getCPUStats(core)
+                cores.append(('cpu{}'.format(core), [stats.get(field, 0) for field in CPU_FIELDS]))
+        return cores
+
+    def sample(self):
+        """
+        Takes one sample of CPU counters, memory and pools.
+        """
+        conn = self._connect()
+        now = time()
+        if self.local:
+            cores = self._read_proc_stat()
+        else:
+            cores = self._read_cpu_stats(conn)
+        memory = conn.getMemoryStats(libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS)
+        pools = {}
+        for pool in conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+            pools[pool.name()] = pool.info()[1:4]
+
+        with self.lock:
+            names = [name for name, values in cores]
+            if self.cores != names:
+                # core set changed, old counters are not comparable anymore
+                self.cores = names
+                self.cpu = RingBuffer(self.history, (len(names), len(CPU_FIELDS)))
+            self.cpu.append(now, [values for name, values in cores])
+            self.memory.append(now, [memory.get(field, 0) for field in MEMORY_FIELDS])
+            for name, info in pools.items():
+                if name not in self.pools:
+                    self.pools[name] = RingBuffer(self.history, (len(POOL_FIELDS),))
+                self.pools[name].append(now, info)
+            for name in list(self.pools):
+                if name not in pools:
+                    del self.pools[name]
+            self.samples += 1
+
+    def get_cpu_rates(self, last=None):
+        """
+        Returns per core and total utilisation, user, kernel, iowait and steal fractions for every
+        interval of last samples, or None with less than two samples.
+        """
+        with self.lock:
+            if self.cpu is None or self.cpu.count < 2:
+                return None
+            times, samples = self.cpu.get(last)
+            cores = list(self.cores)
+
+        rates = counter_rates(samples)
+        totals = counter_rates(samples.sum(axis=1))
+        response = {'times': times[1:], 'cores': cores}
+        for prefix, values in (('', rates), ('total_', totals)):
+            for index, field in enumerate(CPU_FIELDS):
+                response[prefix + field] = values[..., index]
+            response[prefix + 'utilisation'] = 1 - values[..., CPU_FIELDS.index('idle')] - values[..., CPU_FIELDS.index('iowait')]
+        return response
+
+    def get_summary(self, window=None):
+        """
+        Returns latest and window average of CPU rates, latest memory and pools usage as plain types.
+        """
+        summary = {'name': self.name, 'samples': self.samples, 'errors': self.errors, 'cpu': None,
+                   'memory': None, 'pools': {}}
+        rates = self.get_cpu_rates(last=None if window is None else window + 1)
+        if rates is not None:
+            cpu = {'cores': rates['cores']}
+            for field in ('utilisation', 'user', 'kernel', 'iowait', 'steal'):
+                cpu[field] = rates[field][-1].tolist()
+                cpu['avg_' + field] = numpy.nanmean(rates[field], axis=0).tolist()
+                cpu['total_' + field] = float(rates['total_' + field][-1])
+                cpu['avg_total_' + field] = float(numpy.nanmean(rates['total_' + field]))
+            summary['cpu'] = cpu
+
+        with self.lock:
+            memory = self.memory.latest()
+            if memory is not None:
+                summary['memory'] = dict(zip(MEMORY_FIELDS, memory.tolist()))
+                used = memory[0] - memory[1] - memory[2] - memory[3]
+                summary['memory']['used'] = float(used)
+                summary['memory']['used_percent'] = float(used * 100 / memory[0]) if memory[0] else 0.0
+            for name, ring in self.pools.items():
+                summary['pools'][name] = dict(zip(POOL_FIELDS, ring.latest().tolist()))
+        return summary
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                logging.error('Sampling host {} failed: {}.'.format(self.name, e))
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        """
+        Starts background sampling thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='virtapi-sampler-{}'.format(self.name))
+            self.thread.daemon = True
+            self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+
+
+# cumulative counters and gauges kept per domain, in column order
+DOMAIN_COUNTERS = ('cpu_time', 'rd_reqs', 'wr_reqs', 'rd_bytes', 'wr_bytes',
+                   'rx_pkts', 'tx_pkts', 'rx_bytes', 'tx_bytes')
+DOMAIN_GAUGES = ('vcpu', 'memory', 'memory_rss')
+DOMAIN_METRICS = ('cpu', 'cpu_vcpu', 'disk_iops', 'disk_read_iops', 'disk_write_iops', 'disk_bytes',
+                  'disk_read_bytes', 'disk_write_bytes', 'net_pps', 'net_rx_pps', 'net_tx_pps',
+                  'net_bytes', 'net_rx_bytes', 'net_tx_bytes', 'memory', 'memory_rss')
+
+
+def _sum_devices(stats, group, fields):
+    values = [0] * len(fields)
+    for device in range(stats.get('{}.count'.format(group), 0)):
+        for index, field in enumerate(fields):
+            values[index] += stats.get('{}.{}.{}'.format(group, device, field), 0)
+    return values
+
+
+class DomainCollector(object):
+    """
+    Collects performance counters of all running domains of a host with one getAllDomainStats call per
+    interval. Counters are kept in columnar arrays( one row per domain), rates between the last two
+    collections are computed for all domains at once.
+    """
+
+    STATS = ('VIR_DOMAIN_STATS_CPU_TOTAL', 'VIR_DOMAIN_STATS_BALLOON', 'VIR_DOMAIN_STATS_VCPU',
+             'VIR_DOMAIN_STATS_INTERFACE', 'VIR_DOMAIN_STATS_BLOCK')
+
+    def __init__(self, host, interval=None):
+        self.host = host
+        self.name = host['name']
+        self.interval = interval or SETTINGS['SAMPLER_INTERVAL']
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.uuids = []
+        self.names = []
+        self.rows = {}
+        self.counters = numpy.zeros((0, len(DOMAIN_COUNTERS)))
+        self.gauges = numpy.zeros((0, len(DOMAIN_GAUGES)))
+        self.updated = None
+        self.rates = numpy.zeros((0, len(DOMAIN_METRICS)))
+        self.collections = 0
+        self.errors = 0
+        self.rpc_time = 0.0
+
+    def _connect(self):
+        conn = connection_pool.get(self.host)
+        if conn is None:
+            raise libvirt.libvirtError('Connection to hypervisor {} failed.'.format(self.name))
+        return conn
+
+    def _stats_flags(self):
+        stats = 0
+        for name in self.STATS:
+            stats |= getattr(libvirt, name, 0)
+        return stats
+
+    def collect(self):
+        """
+        Fetches counters of all running domains and recomputes rates, returns number of domains.
+        """
+        conn = self._connect()
+        started = time()
+        records = conn.getAllDomainStats(self._stats_flags(), libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        now = time()
+
+        uuids = []
+        names = []
+        counters = []
+        gauges = []
+        for domain, stats in records:
+            uuids.append(domain.UUIDString())
+            names.append(domain.name())
+            row = [stats.get('cpu.time', 0)]
+            row += _sum_devices(stats, 'block', ('rd.reqs', 'wr.reqs', 'rd.bytes', 'wr.bytes'))
+            row += _sum_devices(stats, 'net', ('rx.pkts', 'tx.pkts', 'rx.bytes', 'tx.bytes'))
+            counters.append(row)
+            gauges.append([stats.get('vcpu.current', 0), stats.get('balloon.current', 0), stats.get('balloon.rss', 0)])
+        counters = numpy.array(counters, dtype=numpy.float64).reshape(len(uuids), len(DOMAIN_COUNTERS))
+        gauges = numpy.array(gauges, dtype=numpy.float64).reshape(len(uuids), len(DOMAIN_GAUGES))
+
+        with self.lock:
+            # align previous counters with current domain order, new domains have no previous row
+            previous = numpy.full(counters.shape, numpy.nan)
+            known = numpy.array([self.rows.get(uuid, -1) for uuid in uuids], dtype=numpy.int64)
+            if len(known) and self.updated is not None:
+                mask = known >= 0
+                previous[mask] = self.counters[known[mask]]
+            elapsed = now - self.updated if self.updated is not None else numpy.nan
+
+            self.rates = self._rates(counters, previous, gauges, elapsed)
+            self.uuids = uuids
+            self.names = names
+            self.rows = dict((uuid, index) for index, uuid in enumerate(uuids))
+            self.counters = counters
+            self.gauges = gauges
+            self.updated = now
+            self.collections += 1
+            self.rpc_time += now - started
+        return len(uuids)
+
+    def _rates(self, counters, previous, gauges, elapsed):
+        column = dict((name, index) for index, name in enumerate(DOMAIN_COUNTERS))
+        delta = counters - previous
+        # restarted domain resets its counters
+        delta[delta < 0] = numpy.nan
+        per_second = delta / elapsed if elapsed else delta * numpy.nan
+
+        def counter(name):
+            return per_second[:, column[name]]
+
+        vcpus = gauges[:, DOMAIN_GAUGES.index('vcpu')]
+        vcpus = numpy.where(vcpus > 0, vcpus, numpy.nan)
+        cpu = counter('cpu_time') / 1e7
+        metrics = {
+            'cpu': cpu,
+            'cpu_vcpu': cpu / vcpus,
+            'disk_read_iops': counter('rd_reqs'),
+            'disk_write_iops': counter('wr_reqs'),
+            'disk_iops': counter('rd_reqs') + counter('wr_reqs'),
+            'disk_read_bytes': counter('rd_bytes'),
+            'disk_write_bytes': counter('wr_bytes'),
+            'disk_bytes': counter('rd_bytes') + counter('wr_bytes'),
+            'net_rx_pps': counter('rx_pkts'),
+            'net_tx_pps': counter('tx_pkts'),
+            'net_pps': counter('rx_pkts') + counter('tx_pkts'),
+            'net_rx_bytes': counter('rx_bytes'),
+            'net_tx_bytes': counter('tx_bytes'),
+            'net_bytes': counter('rx_bytes') + counter('tx_bytes'),
+            'memory': gauges[:, DOMAIN_GAUGES.index('memory')],
+            'memory_rss': gauges[:, DOMAIN_GAUGES.index('memory_rss')],
+        }
+        return numpy.column_stack([metrics[name] for name in DOMAIN_METRICS]).reshape(len(counters), len(DOMAIN_METRICS))
+
+    def _row(self, index):
+        row = {'name': self.names[index], 'uuid': self.uuids[index]}
+        for column, metric in enumerate(DOMAIN_METRICS):
+            value = self.rates[index, column]
+            row[metric] = None if numpy.isnan(value) else float(value)
+        return row
+
+    def get_metrics(self, name=None):
+        """
+        Returns list of rates of all domains( or of the named one), cpu is in percent of one host CPU,
+        cpu_vcpu in percent of domain vCPUs, memory in KiB and the rest per second.
+        """
+        with self.lock:
+            if name is not None:
+                return [self._row(index) for index, domain in enumerate(self.names) if domain == name]
+            return [self._row(index) for index in range(len(self.names))]
+
+    def top(self, metric='cpu', limit=10):
+        """
+        Returns limit domains with highest metric, e.g. top('disk_iops') for noisiest disk users.
+        Domains without rate yet are ordered last.
+        """
+        if metric not in DOMAIN_METRICS:
+            raise ValueError('Unknown metric {}.'.format(metric))
+        with self.lock:
+            values = self.rates[:, DOMAIN_METRICS.index(metric)]
+            values = numpy.where(numpy.isnan(values), -1.0, values)
+            order = numpy.argsort(-values, kind='mergesort')[:limit]
+            return [self._row(index) for index in order]
+
+    def get_stats(self):
+        with self.lock:
+            return {'name': self.name, 'domains': len(self.uuids), 'collections': self.collections,
+                    'errors': self.errors, 'updated': self.updated,
+                    'avg_rpc_time': self.rpc_time / self.collections if self.collections else 0.0}
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.collect()
+            except Exception as e:
+                self.errors += 1
+                logging.error('Collecting domain stats on {} failed: {}.'.format(self.name, e))
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        """
+        Starts background collector thread.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='virtapi-collector-{}'.format(self.name))
+            self.thread.daemon = True
+            self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
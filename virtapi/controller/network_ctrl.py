@@ -4,6 +4,11 @@ __author__ = Strahinja Piperac <spiperac@denkei.org>
 """
 
 import xmltodict, json, random, uuid
+import libvirt, threading
+from time import time
+
+from virtapi.settings import SETTINGS
+from virtapi.controller.connection_ctrl import get_conn_cache, VirtConnCache
 
 def get_network_object(self, network_uuid):
     """
@@ -35,3 +40,74 @@ def set_autostart_network(self, network_uuid, state):
         network.setAutostart(int(state))
     else:
         return False
+
+
+class VirtLeaseCache(VirtConnCache):
+    """
+    MAC -> IP index built from DHCP leases of all networks on the connection.
+    One sweep serves lookups for any number of domains until TTL expires or invalidate() is called.
+    """
+
+    def __init__(self, conn, ttl=None, miss_interval=None):
+        VirtConnCache.__init__(self, conn)
+        self.ttl = ttl if ttl is not None else SETTINGS['LEASE_CACHE_TTL']
+        self.miss_interval = miss_interval if miss_interval is not None else SETTINGS['LEASE_CACHE_MISS_INTERVAL']
+        self.leases = {}
+        self.updated = 0
+        self.sweeps = 0
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def refresh(self, max_age=None):
+        """
+        Sweeps DHCP leases of all networks and rebuilds the index. Sweeps are serialized, with max_age
+        the sweep is skipped when another thread refreshed the index meanwhile.
+        """
+        with self.refresh_lock:
+            if max_age is not None and time() - self.updated < max_age:
+                return
+            leases = {}
+            for network in self.conn.listAllNetworks():
+                try:
+                    network_leases = network.DHCPLeases()
+                except libvirt.libvirtError:
+                    continue
+                for lease in network_leases:
+                    leases.setdefault(lease['mac'].lower(), []).append(lease['ipaddr'])
+
+            with self.lock:
+                self.leases = leases
+                self.updated = time()
+                self.sweeps += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.updated = 0
+
+    def expired(self):
+        return time() - self.updated > self.ttl
+
+    def lookup(self, macs, refresh_on_miss=True, active=True):
+        """
+        Returns {mac: [ips]} for given MAC addresses.
+        Missing MACs trigger a new sweep, but not more often than miss interval.
+        MACs of inactive domains hold no lease, they are returned empty without a sweep.
+        """
+        if not active:
+            return dict((mac, []) for mac in macs)
+        if self.expired():
+            self.refresh(max_age=self.ttl)
+
+        result = dict((mac, self.leases.get(mac.lower(), [])) for mac in macs)
+        missing = [mac for mac in result if not result[mac]]
+        if missing and refresh_on_miss and time() - self.updated >= self.miss_interval:
+            self.refresh(max_age=self.miss_interval)
+            result = dict((mac, self.leases.get(mac.lower(), [])) for mac in macs)
+        return result
+
+
+def get_lease_cache(conn):
+    """
+    Returns shared lease cache for the connection.
+    """
+    return get_conn_cache(conn, 'leases', VirtLeaseCache)
@@ -0,0 +1,364 @@
+"""
+Placement methods and calls
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import libvirt
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from time import time
+
+from virtapi.settings import SETTINGS
+from virtapi.controller.connection_ctrl import connection_pool
+from virtapi.controller.domain_ctrl import VirtDomain, state_active
+
+GB = 1024 * 1024 * 1024
+
+
+def placement_request(plan, labels=None, anti_affinity=None, pool=None):
+    """
+    Builds placement request from a plan( ram and diskSize in GB).
+    """
+    return {
+        'ram': int(float(plan.get('ram') or SETTINGS['DEFAULT_RAM']) * 1024 * 1024),
+        'vcpu': int(plan.get('vcpu') or SETTINGS['DEFAULT_VCPU']),
+        'disk': int(float(plan.get('diskSize') or SETTINGS['DEFAULT_DISKSIZE']) * GB),
+        'labels': dict((key, str(value)) for key, value in (labels or {}).items()),
+        'anti_affinity': anti_affinity or [],
+        'pool': pool or SETTINGS['DEFAULTPOOL'],
+    }
+
+
+class VirtHostSnapshot(object):
+    """
+    Capacity snapshot of one host: CPU, memory, pool free space and domain allocations.
+    Host totals are refreshed on TTL, single domains are refreshed on their lifecycle events.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.name = host['name']
+        self.conn = None
+        self.lock = threading.Lock()
+        self.callback = None
+        self.updated = 0
+        self.error = None
+
+        self.cpus = 0
+        self.memory = 0
+        self.free_memory = 0
+        self.pools = {}
+        self.domains = {}
+        self.dirty = set()
+        self.reserved = []
+
+    def _connect(self):
+        conn = connection_pool.get(self.host)
+        if conn is None:
+            raise libvirt.libvirtError('Connection to hypervisor {} failed.'.format(self.name))
+        if conn is not self.conn:
+            self.close()
+            self.conn = conn
+            try:
+                self.callback = conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_event, None)
+            except libvirt.libvirtError as e:
+                logging.warning('Placement events for {} not registered: {}.'.format(self.name, e))
+        return conn
+
+    def close(self):
+        """
+        Deregisters lifecycle callback, it would keep the snapshot alive and firing from replaced connection.
+        """
+        if self.callback is not None:
+            try:
+                self.conn.domainEventDeregisterAny(self.callback)
+            except libvirt.libvirtError:
+                pass
+            self.callback = None
+
+    def _on_event(self, conn, domain, event, detail, opaque):
+        with self.lock:
+            self.dirty.add(domain.UUIDString())
+
+    def _domain_entry(self, domain, stats):
+        state = stats.get('state.state', libvirt.VIR_DOMAIN_NOSTATE)
+        return {
+            'name': domain.name(),
+            'active': state_active(state, stats.get('state.reason')),
+            'vcpu': stats.get('vcpu.maximum', stats.get('vcpu.current', 0)),
+            'ram': stats.get('balloon.maximum', 0),
+            'labels': VirtDomain(domain=domain).get_labels(),
+        }
+
+    def refresh(self):
+        """
+        Full refresh of host totals, pools and all domains.
+        """
+        conn = self._connect()
+        info = conn.getInfo()
+        memory = conn.getMemoryStats(libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS)
+        pools = {}
+        for pool in conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+            pools[pool.name()] = pool.info()[3]
+
+        stats = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON
+        domains = {}
+        for domain, domain_stats in conn.getAllDomainStats(stats, 0):
+            domains[domain.UUIDString()] = self._domain_entry(domain, domain_stats)
+
+        with self.lock:
+            self.cpus = info[2]
+            self.memory = info[1] * 1024
+            self.free_memory = memory.get('free', 0) + memory.get('cached', 0) + memory.get('buffers', 0)
+            self.pools = pools
+            self.domains = domains
+            self.dirty = set()
+            self._expire(domains)
+            self.updated = time()
+            self.error = None
+
+    def refresh_dirty(self):
+        """
+        Refreshes only domains which changed since last refresh.
+        """
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+        if not dirty or self.conn is None:
+            return 0
+
+        objects = []
+        for uuid in dirty:
+            try:
+                objects.append(self.conn.lookupByUUIDString(uuid))
+            except libvirt.libvirtError:
+                with self.lock:
+                    self.domains.pop(uuid, None)
+
+        stats = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON
+        entries = {}
+        if objects:
+            for domain, domain_stats in self.conn.domainListGetStats(objects, stats, 0):
+                entries[domain.UUIDString()] = self._domain_entry(domain, domain_stats)
+        with self.lock:
+            self.domains.update(entries)
+            self._expire(self.domains)
+        return len(dirty)
+
+    def _expire(self, domains):
+        # reservations end when the domain shows up on the host, or after TTL
+        names = set(domain['name'] for domain in domains.values())
+        now = time()
+        self.reserved = [reservation for reservation in self.reserved
+                         if reservation['name'] not in names and reservation['expires'] > now]
+
+    def reserve(self, request, name=None):
+        with self.lock:
+            reservation = dict(request)
+            reservation['name'] = name
+            reservation['expires'] = time() + SETTINGS['PLACEMENT_RESERVATION_TTL']
+            self.reserved.append(reservation)
+            return reservation
+
+    def release(self, name):
+        """
+        Drops reservation of the domain, e.g. when its creation failed.
+        """
+        with self.lock:
+            self.reserved = [reservation for reservation in self.reserved if reservation['name'] != name]
+
+    def cancel(self, reservation):
+        """
+        Drops exactly this reservation, used by dry run placements.
+        """
+        with self.lock:
+            self.reserved = [reserved for reserved in self.reserved if reserved is not reservation]
+
+    def get_usage(self):
+        """
+        Returns allocated vCPU, memory( KiB) and disk of active domains and pending reservations.
+        """
+        with self.lock:
+            usage = {'vcpu': 0, 'ram': 0, 'reserved_ram': 0, 'disk': {}}
+            for domain in self.domains.values():
+                if domain['active']:
+                    usage['vcpu'] += domain['vcpu']
+                    usage['ram'] += domain['ram']
+            for reservation in self.reserved:
+                usage['vcpu'] += reservation['vcpu']
+                usage['ram'] += reservation['ram']
+                usage['reserved_ram'] += reservation['ram']
+                usage['disk'][reservation['pool']] = usage['disk'].get(reservation['pool'], 0) + reservation['disk']
+            return usage
+
+    def conflicts(self, request):
+        """
+        Returns True if a domain( or reservation) on the host shares an anti-affinity label with request.
+        """
+        keys = [key for key in request['anti_affinity'] if key in request['labels']]
+        if not keys:
+            return False
+        with self.lock:
+            entries = [domain['labels'] for domain in self.domains.values()]
+            entries += [reservation['labels'] for reservation in self.reserved]
+        for labels in entries:
+            for key in keys:
+                if labels.get(key) == request['labels'][key]:
+                    return True
+        return False
+
+    def to_dict(self):
+        usage = self.get_usage()
+        with self.lock:
+            return {'name': self.name, 'cpus': self.cpus, 'memory': self.memory, 'free_memory': self.free_memory,
+                    'pools': dict(self.pools), 'domains': len(self.domains), 'reserved': len(self.reserved),
+                    'vcpu_allocated': usage['vcpu'], 'ram_allocated': usage['ram'],
+                    'updated': self.updated, 'error': self.error}
+
+
+class VirtPlacement(object):
+    """
+    Chooses host for new domains from cached capacity snapshots of all hosts.
+    Policy 'pack' fills the fullest host that still fits( bin packing), 'spread' picks the emptiest one.
+    vCPU and memory can be overcommitted with ratios, anti-affinity keeps domains with equal label
+    values on different hosts.
+    """
+
+    POLICIES = ('pack', 'spread')
+
+    def __init__(self, hosts, policy=None, cpu_ratio=None, ram_ratio=None, memory_threshold=None, ttl=None, workers=None):
+        self.snapshots = dict((host['name'], VirtHostSnapshot(host)) for host in hosts)
+        self.policy = policy or SETTINGS['PLACEMENT_POLICY']
+        if self.policy not in self.POLICIES:
+            raise ValueError('Unknown placement policy {}.'.format(self.policy))
+        self.cpu_ratio = cpu_ratio or SETTINGS['CPU_OVERCOMMIT']
+        self.ram_ratio = ram_ratio or SETTINGS['RAM_OVERCOMMIT']
+        self.memory_threshold = memory_threshold or SETTINGS['MAX_MEMORY_USAGE']
+        self.ttl = ttl if ttl is not None else SETTINGS['PLACEMENT_SNAPSHOT_TTL']
+        self.workers = workers or SETTINGS['INVENTORY_WORKERS']
+        self.lock = threading.Lock()
+
+    def _refresh_one(self, snapshot):
+        started = time()
+        try:
+            snapshot.refresh()
+        except Exception as e:
+            logging.error('Capacity snapshot of {} failed: {}.'.format(snapshot.name, e))
+            snapshot.error = str(e)
+            snapshot.updated = time()
+        return time() - started
+
+    def refresh(self, force=False):
+        """
+        Refreshes stale snapshots in parallel( all with force), and changed domains of the rest.
+        """
+        now = time()
+        stale = [snapshot for snapshot in self.snapshots.values() if force or now - snapshot.updated > self.ttl]
+        if stale:
+            pool = ThreadPool(max(1, min(self.workers, len(stale))))
+            try:
+                pool.map(self._refresh_one, stale)
+            finally:
+                pool.close()
+                pool.join()
+        for snapshot in self.snapshots.values():
+            if snapshot not in stale and snapshot.error is None:
+                try:
+                    snapshot.refresh_dirty()
+                except libvirt.libvirtError as e:
+                    logging.warning('Domain refresh on {} failed: {}.'.format(snapshot.name, e))
+                    snapshot.updated = 0
+        return len(stale)
+
+    def _score(self, snapshot, request):
+        """
+        Returns free capacity fraction left after placing request, or None when request does not fit.
+        """
+        if snapshot.error is not None or not snapshot.cpus:
+            return None
+        usage = snapshot.get_usage()
+
+        cpu_capacity = snapshot.cpus * self.cpu_ratio
+        ram_capacity = snapshot.memory * self.ram_ratio * self.memory_threshold / 100.0
+        cpu_left = cpu_capacity - usage['vcpu'] - request['vcpu']
+        ram_left = ram_capacity - usage['ram'] - request['ram']
+        if cpu_left < 0 or ram_left < 0:
+            return None
+
+        # without memory overcommit, real free memory has to fit as well
+        if self.ram_ratio <= 1 and snapshot.free_memory - usage['reserved_ram'] - request['ram'] < 0:
+            return None
+
+        disk_free = snapshot.pools.get(request['pool'])
+        if disk_free is None or disk_free - usage['disk'].get(request['pool'], 0) < request['disk']:
+            return None
+        if snapshot.conflicts(request):
+            return None
+        return min(cpu_left / cpu_capacity, ram_left / ram_capacity)
+
+    def _choose(self, request):
+        scores = []
+        for snapshot in self.snapshots.values():
+            score = self._score(snapshot, request)
+            if score is not None:
+                scores.append((score, snapshot.name))
+        if not scores:
+            logging.warning('No host fits placement request {}.'.format(request))
+            return None
+        if self.policy == 'pack':
+            score, host = min(scores)
+        else:
+            score, host = max(scores)
+        return host
+
+    def place(self, request, name=None, refresh=True):
+        """
+        Returns name of the chosen host, or None when no host fits. Choice is reserved in the snapshot
+        until the domain shows up on the host, so following placements take it into account.
+        """
+        if refresh:
+            self.refresh()
+        with self.lock:
+            host = self._choose(request)
+            if host is not None:
+                self.snapshots[host].reserve(request, name=name)
+            return host
+
+    def place_many(self, request, names, reserve=True):
+        """
+        Places many equal domains, returns {name: host or None}. Without reserve it is a dry run,
+        placements see each other but all reservations are dropped before returning.
+        """
+        self.refresh()
+        if reserve:
+            return dict((name, self.place(request, name=name, refresh=False)) for name in names)
+
+        placement = {}
+        reservations = []
+        with self.lock:
+            try:
+                for name in names:
+                    host = self._choose(request)
+                    if host is not None:
+                        reservations.append((self.snapshots[host], self.snapshots[host].reserve(request, name=name)))
+                    placement[name] = host
+            finally:
+                for snapshot, reservation in reservations:
+                    snapshot.cancel(reservation)
+        return placement
+
+    def release(self, host, name):
+        """
+        Releases reservation made by place for domain which was not created.
+        """
+        snapshot = self.snapshots.get(host)
+        if snapshot is not None:
+            snapshot.release(name)
+
+    def close(self):
+        for snapshot in self.snapshots.values():
+            snapshot.close()
+
+    def get_snapshots(self):
+        return [snapshot.to_dict() for snapshot in self.snapshots.values()]
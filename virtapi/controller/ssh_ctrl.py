@@ -0,0 +1,271 @@
+"""
+SSH methods and calls
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import os
+import select
+import socket
+import logging
+import threading
+import subprocess
+from getpass import getpass
+from multiprocessing.pool import ThreadPool
+from time import time
+
+from virtapi.settings import SETTINGS
+
+
+def session_key(host):
+    """
+    Returns hashable key of SSH session for a host entry( or ad hoc host dict).
+    """
+    return (host.get('connection'), host.get('username'), host.get('key'))
+
+
+def run_local(command):
+    """
+    Runs command on this machine, used for hosts without remote connection( qemu:///system).
+    """
+    started = time()
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return {'command': command, 'status': process.returncode, 'stdout': stdout.decode('utf-8', 'replace'),
+            'stderr': stderr.decode('utf-8', 'replace'), 'time': time() - started, 'error': None}
+
+
+class SSHSessionPool(object):
+    """
+    Keeps one authenticated SSH transport per host with keepalive. Every command runs in its own
+    channel multiplexed on that transport, so only the first command pays for handshake and auth.
+    Dead transports are reopened transparently.
+    """
+
+    def __init__(self, keepalive_interval=None, connect_timeout=None):
+        self.keepalive_interval = keepalive_interval or SETTINGS['SSH_KEEPALIVE_INTERVAL']
+        self.connect_timeout = connect_timeout or SETTINGS['SSH_CONNECT_TIMEOUT']
+        self.clients = {}
+        self.passphrases = {}
+        self.lock = threading.Lock()
+        self.host_locks = {}
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.commands = 0
+        self.connect_time = 0.0
+
+    def _host_lock(self, key):
+        with self.lock:
+            if key not in self.host_locks:
+                self.host_locks[key] = threading.Lock()
+            return self.host_locks[key]
+
+    def _is_alive(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _open(self, host, key):
+        import paramiko
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        kwargs = {'username': host.get('username'), 'timeout': self.connect_timeout}
+        if host.get('key'):
+            kwargs['key_filename'] = os.path.expanduser(host['key'])
+            kwargs['allow_agent'] = host['key'] != SETTINGS['DEFAULTKEYFILE']
+            if key in self.passphrases:
+                kwargs['password'] = self.passphrases[key]
+        elif host.get('password'):
+            kwargs['password'] = host['password']
+
+        started = time()
+        try:
+            try:
+                client.connect(host['connection'], **kwargs)
+            except paramiko.ssh_exception.PasswordRequiredException:
+                passphrase = host.get('key_password') or getpass('Enter SSH key password: ')
+                kwargs['password'] = passphrase
+                client.connect(host['connection'], **kwargs)
+                self.passphrases[key] = passphrase
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            raise
+        finally:
+            with self.lock:
+                self.connect_time += time() - started
+
+        client.get_transport().set_keepalive(self.keepalive_interval)
+        logging.info('SSH session to {} opened in {:.3f}s.'.format(host['connection'], time() - started))
+        return client
+
+    def get(self, host):
+        """
+        Returns connected paramiko SSHClient for the host, opening or reopening it if needed.
+        """
+        key = session_key(host)
+        with self._host_lock(key):
+            client = self.clients.get(key)
+            if client is not None:
+                if self._is_alive(client):
+                    with self.lock:
+                        self.hits += 1
+                    return client
+
+                logging.warning('SSH session to {} is dead, reconnecting.'.format(host.get('connection')))
+                self._close(client)
+                del self.clients[key]
+                with self.lock:
+                    self.reconnects += 1
+
+            with self.lock:
+                self.misses += 1
+            client = self._open(host, key)
+            self.clients[key] = client
+            return client
+
+    def _read(self, channel, timeout):
+        stdout = []
+        stderr = []
+        deadline = time() + timeout if timeout else None
+        while True:
+            if channel.recv_ready():
+                stdout.append(channel.recv(32768))
+            elif channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(32768))
+            elif channel.exit_status_ready():
+                break
+            else:
+                if deadline is not None and time() > deadline:
+                    raise socket.timeout('Command timed out after {}s.'.format(timeout))
+                select.select([channel], [], [], 0.1)
+        # data may still arrive after exit status
+        while channel.recv_ready():
+            stdout.append(channel.recv(32768))
+        while channel.recv_stderr_ready():
+            stderr.append(channel.recv_stderr(32768))
+        return b''.join(stdout), b''.join(stderr)
+
+    def exec_command(self, host, command, timeout=None):
+        """
+        Runs command on the host in a new channel of the pooled session.
+        Returns {'command', 'status', 'stdout', 'stderr', 'time', 'error'}, status is None on failure.
+        """
+        timeout = timeout or SETTINGS['SSH_COMMAND_TIMEOUT']
+        if not host.get('connection'):
+            return run_local(command)
+
+        import paramiko
+
+        started = time()
+        result = {'command': command, 'status': None, 'stdout': '', 'stderr': '', 'error': None}
+        for attempt in range(2):
+            sent = False
+            try:
+                channel = self.get(host).get_transport().open_session()
+                try:
+                    channel.exec_command(command)
+                    sent = True
+                    stdout, stderr = self._read(channel, timeout)
+                    result['status'] = channel.recv_exit_status()
+                    result['stdout'] = stdout.decode('utf-8', 'replace')
+                    result['stderr'] = stderr.decode('utf-8', 'replace')
+                finally:
+                    channel.close()
+                break
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                # stale transport, reopen it once unless command already started
+                if attempt == 0 and not sent:
+                    self.release(host)
+                    continue
+                logging.error('SSH command on {} failed: {}.'.format(host.get('connection'), e))
+                result['error'] = str(e)
+                break
+        with self.lock:
+            self.commands += 1
+        result['time'] = time() - started
+        return result
+
+    def run_batch(self, host, commands, stop_on_error=True, timeout=None):
+        """
+        Runs commands in order on one session, stops at first failed command unless stop_on_error
+        is False. Returns list of results of executed commands.
+        """
+        results = []
+        for command in commands:
+            result = self.exec_command(host, command, timeout=timeout)
+            results.append(result)
+            if stop_on_error and result['status'] != 0:
+                break
+        return results
+
+    def run_many(self, hosts, command, workers=None, timeout=None):
+        """
+        Runs command( or list of commands as a batch) on many hosts in parallel.
+        Returns {host name: result or list of results}.
+        """
+        workers = workers or SETTINGS['SSH_WORKERS']
+
+        def run(host):
+            try:
+                if isinstance(command, list):
+                    return host['name'], self.run_batch(host, command, timeout=timeout)
+                return host['name'], self.exec_command(host, command, timeout=timeout)
+            except Exception as e:
+                logging.error('SSH on host {} failed: {}.'.format(host['name'], e))
+                return host['name'], {'command': command, 'status': None, 'stdout': '', 'stderr': '',
+                                      'time': 0.0, 'error': str(e)}
+
+        if not hosts:
+            return {}
+        pool = ThreadPool(max(1, min(workers, len(hosts))))
+        try:
+            return dict(pool.map(run, hosts))
+        finally:
+            pool.close()
+            pool.join()
+
+    def release(self, host):
+        """
+        Closes and forgets the session of the host.
+        """
+        key = session_key(host)
+        with self._host_lock(key):
+            client = self.clients.pop(key, None)
+            if client is not None:
+                self._close(client)
+
+    def close_all(self):
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients = {}
+        for client in clients:
+            self._close(client)
+
+    def _close(self, client):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def get_stats(self):
+        with self.lock:
+            opened = self.misses - self.failures
+            average = self.connect_time / self.misses if self.misses else 0.0
+            return {
+                'sessions': len(self.clients),
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'failures': self.failures,
+                'commands': self.commands,
+                'connect_time': self.connect_time,
+                'avg_connect_time': average,
+                'saved_time': average * self.hits if opened > 0 else 0.0,
+            }
+
+
+ssh_pool = SSHSessionPool()
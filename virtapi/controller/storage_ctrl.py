@@ -0,0 +1,500 @@
+"""
+Storage methods and calls
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import xml.etree.ElementTree as ET
+import libvirt
+import logging
+import threading
+import os, sys, mmap, errno
+import hashlib
+from time import time
+
+if sys.version_info[0] < 3:
+    from Queue import Queue
+else:
+    from queue import Queue
+
+from virtapi.settings import SETTINGS
+from virtapi.utilities import parse_checksum, ChecksumError
+from virtapi.controller.connection_ctrl import get_conn_cache, VirtConnCache
+
+
+class VirtVolumeIndex(VirtConnCache):
+    """
+    Index of storage volumes (name -> path -> pool) for all pools of the connection.
+    Pools are re-listed only when stale( TTL, storage pool events, explicit refresh), and rescanned on
+    disk( pool.refresh) only on demand. Volume capacity and allocation are fetched on first use.
+    """
+
+    def __init__(self, conn, ttl=None):
+        VirtConnCache.__init__(self, conn)
+        self.ttl = ttl if ttl is not None else SETTINGS['VOLUME_INDEX_TTL']
+        self.lock = threading.RLock()
+        self.pools = None
+        self.by_path = {}
+        self.by_name = {}
+        self.loads = 0
+        self.rescans = 0
+        self.register()
+
+    def register(self):
+        events = []
+        for event in ('VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE', 'VIR_STORAGE_POOL_EVENT_ID_REFRESH'):
+            if hasattr(libvirt, event):
+                events.append(getattr(libvirt, event))
+
+        for event_id in events:
+            try:
+                self.callbacks.append(('storagePoolEventDeregisterAny',
+                                       self.conn.storagePoolEventRegisterAny(None, event_id, self._on_event, None)))
+            except libvirt.libvirtError as e:
+                logging.warning('Storage pool event {} not registered: {}.'.format(event_id, e))
+
+    def _on_event(self, conn, pool, *args):
+        with self.lock:
+            if self.pools is None:
+                return
+            if pool.name() in self.pools:
+                self.pools[pool.name()]['stale'] = True
+            else:
+                self.pools = None
+
+    def _pool_entry(self, pool):
+        root = ET.fromstring(pool.XMLDesc(0))
+        path = None
+        for element in root.getiterator('path'):
+            path = element.text
+            break
+        return {'pool': pool, 'name': pool.name(), 'type': root.get('type'), 'path': path,
+                'volumes': {}, 'updated': 0, 'stale': True}
+
+    def _load_pools(self):
+        if self.pools is not None:
+            return
+        pools = {}
+        for pool in self.conn.listAllStoragePools(0):
+            pools[pool.name()] = self._pool_entry(pool)
+        self.pools = pools
+        self.by_path = {}
+        self.by_name = {}
+
+    def _load_pool(self, entry, rescan=False):
+        pool = entry['pool']
+        if rescan:
+            pool.refresh(0)
+            self.rescans += 1
+
+        for path in list(entry['volumes']):
+            self._forget(path)
+
+        if pool.isActive():
+            for volume in pool.listAllVolumes(0):
+                self._remember(entry, volume)
+        entry['updated'] = time()
+        entry['stale'] = False
+        self.loads += 1
+
+    def _remember(self, pool_entry, volume, path=None):
+        path = path or volume.path()
+        entry = {'volume': volume, 'name': volume.name(), 'path': path, 'pool': pool_entry['name'],
+                 'capacity': None, 'allocation': None}
+        pool_entry['volumes'][path] = entry
+        self.by_path[path] = entry
+        self.by_name[entry['name']] = entry
+        return entry
+
+    def _forget(self, path):
+        entry = self.by_path.pop(path, None)
+        if entry is None:
+            return None
+        if self.by_name.get(entry['name']) is entry:
+            del self.by_name[entry['name']]
+        pool_entry = self.pools.get(entry['pool']) if self.pools else None
+        if pool_entry is not None:
+            pool_entry['volumes'].pop(path, None)
+        return entry
+
+    def _ensure(self):
+        self._load_pools()
+        now = time()
+        for entry in self.pools.values():
+            if entry['stale'] or now - entry['updated'] > self.ttl:
+                self._load_pool(entry)
+
+    def refresh(self, pool=None, rescan=True):
+        """
+        Reloads one or all pools, rescanning pool storage on disk if rescan is set.
+        """
+        with self.lock:
+            if pool is None:
+                self.pools = None
+            self._load_pools()
+            for entry in self.pools.values():
+                if pool is None or entry['name'] == pool:
+                    self._load_pool(entry, rescan=rescan)
+
+    def get_pool(self, name):
+        """
+        Returns pool entry dict( pool object, name, type, target path) or None.
+        """
+        with self.lock:
+            self._load_pools()
+            entry = self.pools.get(name)
+            if entry is None:
+                self.pools = None
+                self._load_pools()
+                entry = self.pools.get(name)
+            return entry
+
+    def get_by_path(self, path):
+        """
+        Returns volume entry for the path. Volumes unknown to the index are looked up once and remembered.
+        """
+        with self.lock:
+            self._ensure()
+            entry = self.by_path.get(path)
+            if entry is not None:
+                return entry
+            try:
+                volume = self.conn.storageVolLookupByPath(path)
+            except libvirt.libvirtError:
+                return None
+            pool_entry = self.get_pool(volume.storagePoolLookupByVolume().name())
+            if pool_entry is None:
+                # pool is unknown to the index, e.g. undefined meanwhile
+                return None
+            return self._remember(pool_entry, volume, path=path)
+
+    def get_by_name(self, name):
+        with self.lock:
+            self._ensure()
+            return self.by_name.get(name)
+
+    def get_volume(self, path):
+        entry = self.get_by_path(path)
+        if entry is None:
+            return None
+        return entry['volume']
+
+    def get_info(self, entry):
+        """
+        Fills and returns capacity and allocation of volume entry.
+        """
+        if entry['capacity'] is None:
+            info = entry['volume'].info()
+            entry['capacity'] = info[1]
+            entry['allocation'] = info[2]
+        return entry
+
+    def list_volumes(self):
+        """
+        Returns {name: {'pool': pool, 'path': path}} for all volumes.
+        """
+        with self.lock:
+            self._ensure()
+            return dict((entry['name'], {'pool': entry['pool'], 'path': entry['path']}) for entry in self.by_path.values())
+
+    def add(self, pool, volume):
+        """
+        Adds volume we just created to the index.
+        """
+        with self.lock:
+            pool_entry = self.get_pool(pool.name() if hasattr(pool, 'name') else pool)
+            if pool_entry is None:
+                return None
+            return self._remember(pool_entry, volume)
+
+    def remove(self, path):
+        """
+        Removes volume we just deleted from the index.
+        """
+        with self.lock:
+            if self.pools is not None:
+                return self._forget(path)
+
+    def delete(self, path):
+        """
+        Deletes volume and removes it from the index.
+        """
+        volume = self.get_volume(path)
+        if volume is None:
+            return False
+        volume.delete(0)
+        self.remove(path)
+        return True
+
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+
+class VirtUploadSource(object):
+    """
+    Memory mapped file source for volume upload streams.
+    Data and hole sections are found with SEEK_DATA/SEEK_HOLE, so holes are skipped instead of sent.
+    Filesystems without hole support are sent as one data section.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+        if self.size > 0:
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        self.position = 0
+        self.section_end = 0
+        self.in_data = True
+        self.sent = 0
+        self.skipped = 0
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+    def _next_section(self):
+        position = self.position
+        try:
+            data = os.lseek(self.fd, position, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # trailing hole
+                data = self.size
+            elif e.errno == errno.EINVAL:
+                # no hole support
+                data = position
+                self.in_data = True
+                self.section_end = self.size
+                return
+            else:
+                raise
+
+        if data > position:
+            self.in_data = False
+            self.section_end = min(data, self.size)
+        else:
+            try:
+                hole = os.lseek(self.fd, position, SEEK_HOLE)
+            except OSError:
+                hole = self.size
+            self.in_data = True
+            self.section_end = min(hole, self.size)
+
+    def hole(self, stream, opaque):
+        if self.position >= self.size:
+            return [True, 0]
+        if self.position >= self.section_end:
+            self._next_section()
+        return [self.in_data, self.section_end - self.position]
+
+    def skip(self, stream, length, opaque):
+        self.position += length
+        self.skipped += length
+        return self.position
+
+    def read(self, stream, nbytes, opaque):
+        if self.map is None:
+            return b''
+        end = min(self.position + nbytes, self.size)
+        data = self.map[self.position:end]
+        self.position = end
+        self.sent += len(data)
+        return data
+
+
+def upload_file(conn, volume, path, sparse=True):
+    """
+    Uploads local file into volume. Uses sparse stream when libvirt supports it, so only data sections
+    go over the wire. Returns upload stats( size, sent, skipped bytes, time, throughput).
+    """
+    source = VirtUploadSource(path)
+    sparse = sparse and hasattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM')
+    started = time()
+    stream = conn.newStream(0)
+    try:
+        if sparse:
+            volume.upload(stream, 0, 0, libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+            stream.sparseSendAll(source.read, source.hole, source.skip, None)
+        else:
+            volume.upload(stream, 0, 0, 0)
+            stream.sendAll(source.read, None)
+        stream.finish()
+    except Exception:
+        try:
+            stream.abort()
+        except libvirt.libvirtError:
+            pass
+        raise
+    finally:
+        source.close()
+
+    elapsed = time() - started
+    stats = {'size': source.size, 'sent': source.sent, 'skipped': source.skipped, 'time': elapsed,
+             'throughput': source.sent / elapsed if elapsed > 0 else 0.0, 'sparse': sparse}
+    logging.info('Uploaded {} ({} bytes sent, {} bytes of holes skipped) in {:.2f}s, {:.2f} MB/s.'.format(
+        path, stats['sent'], stats['skipped'], elapsed, stats['throughput'] / (1024.0 * 1024.0)))
+    return stats
+
+
+def _send(stream, data):
+    while data:
+        sent = stream.send(data)
+        if sent == -2:
+            raise IOError('Cannot write to volume stream, nonblocking stream.')
+        data = data[sent:]
+
+
+def upload_bytes(conn, volume, data, chunk_size=256 * 1024):
+    """
+    Uploads in memory data( seed images and alike) into volume.
+    """
+    stream = conn.newStream(0)
+    try:
+        volume.upload(stream, 0, len(data), 0)
+        for offset in range(0, len(data), chunk_size):
+            _send(stream, data[offset:offset + chunk_size])
+        stream.finish()
+    except Exception:
+        try:
+            stream.abort()
+        except libvirt.libvirtError:
+            pass
+        raise
+    return len(data)
+
+
+def upload_url(conn, volume, url, checksum=None, queue_size=None, chunk_size=None, tee=None):
+    """
+    Streams url straight into volume without temporary file. Download runs in a producer thread and hands
+    chunks over through a bounded queue, so download and upload overlap and memory stays bounded.
+    Optional checksum is verified before the stream is finished, mismatch aborts the upload.
+    With tee downloaded data is written to that file as well( e.g. to fill template cache), failure to write
+    it only stops the copy. Returns stats for both sides( bytes, time, throughput, waits on full/empty queue)
+    and 'teed' set when tee file is complete.
+    """
+    import requests
+    from tqdm import tqdm
+
+    chunks = Queue(maxsize=queue_size or SETTINGS['STREAM_QUEUE_SIZE'])
+    chunk_size = chunk_size or SETTINGS['DOWNLOAD_CHUNK_SIZE']
+    algorithm, digest = parse_checksum(checksum)
+    hasher = hashlib.new(algorithm) if algorithm else None
+    state = {'size': None, 'downloaded': 0, 'download_time': 0.0, 'download_waits': 0,
+             'error': None, 'aborted': False, 'teed': False}
+    bars = {}
+    ready = threading.Event()
+
+    def producer():
+        started = time()
+        tee_file = None
+        if tee is not None:
+            try:
+                tee_file = open(tee, 'wb')
+            except IOError as e:
+                logging.warning('Copy of {} not written to {}: {}.'.format(url, tee, e))
+        try:
+            response = requests.get(url, stream=True, timeout=SETTINGS['DOWNLOAD_TIMEOUT'])
+            response.raise_for_status()
+            size = response.headers.get('Content-Length')
+            state['size'] = int(size) if size is not None else None
+            ready.set()
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if state['aborted']:
+                    break
+                if not chunk:
+                    continue
+                if hasher is not None:
+                    hasher.update(chunk)
+                if tee_file is not None:
+                    try:
+                        tee_file.write(chunk)
+                    except IOError as e:
+                        logging.warning('Copy of {} not written to {}: {}.'.format(url, tee, e))
+                        tee_file.close()
+                        tee_file = None
+                state['downloaded'] += len(chunk)
+                if 'download' in bars:
+                    bars['download'].update(len(chunk))
+                if chunks.full():
+                    state['download_waits'] += 1
+                chunks.put(chunk)
+            if tee_file is not None and not state['aborted']:
+                tee_file.flush()
+                os.fsync(tee_file.fileno())
+                state['teed'] = True
+        except Exception as e:
+            state['error'] = e
+        finally:
+            if tee_file is not None:
+                tee_file.close()
+            state['download_time'] = time() - started
+            ready.set()
+            chunks.put(None)
+
+    stream = conn.newStream(0)
+    volume.upload(stream, 0, 0, 0)
+    thread = threading.Thread(target=producer, name='virtapi-fetch')
+    thread.daemon = True
+    started = time()
+    thread.start()
+
+    uploaded = 0
+    upload_waits = 0
+    finished = False
+    ready.wait()
+    print("Streaming %s" % os.path.basename(url))
+    bars['download'] = tqdm(unit="B", unit_scale=True, total=state['size'], desc='download', position=0)
+    bars['upload'] = tqdm(unit="B", unit_scale=True, total=state['size'], desc='upload', position=1)
+    try:
+        while True:
+            if chunks.empty():
+                upload_waits += 1
+            chunk = chunks.get()
+            if chunk is None:
+                finished = True
+                break
+            _send(stream, chunk)
+            uploaded += len(chunk)
+            bars['upload'].update(len(chunk))
+
+        if state['error'] is not None:
+            raise state['error']
+        if hasher is not None and hasher.hexdigest() != digest:
+            raise ChecksumError('Checksum mismatch for {}, expected {}:{} got {}.'.format(
+                url, algorithm, digest, hasher.hexdigest()))
+        stream.finish()
+    except Exception:
+        state['aborted'] = True
+        while not finished:
+            finished = chunks.get() is None
+        try:
+            stream.abort()
+        except libvirt.libvirtError:
+            pass
+        raise
+    finally:
+        for bar in bars.values():
+            bar.close()
+        thread.join()
+
+    elapsed = time() - started
+    stats = {'size': state['size'], 'downloaded': state['downloaded'], 'sent': uploaded,
+             'download_time': state['download_time'], 'time': elapsed,
+             'download_throughput': state['downloaded'] / state['download_time'] if state['download_time'] > 0 else 0.0,
+             'throughput': uploaded / elapsed if elapsed > 0 else 0.0,
+             'download_waits': state['download_waits'], 'upload_waits': upload_waits, 'teed': state['teed']}
+    logging.info('Streamed {} into volume ({} bytes) in {:.2f}s, download {:.2f} MB/s, upload {:.2f} MB/s, '
+                 'queue full {} times, empty {} times.'.format(url, uploaded, elapsed,
+                                                              stats['download_throughput'] / (1024.0 * 1024.0),
+                                                              stats['throughput'] / (1024.0 * 1024.0),
+                                                              stats['download_waits'], upload_waits))
+    return stats
+
+
+def get_volume_index(conn):
+    """
+    Returns shared volume index for the connection.
+    """
+    return get_conn_cache(conn, 'volumes', VirtVolumeIndex)
@@ -0,0 +1,442 @@
+"""
+VirtAPI daemon, keeps one VirtAPI instance( configs, libvirt connections and caches) warm and serves it
+over local HTTP/JSON API, on Unix socket or TCP port. Every request must carry the token the daemon writes
+into the resources dir( readable only by its owner). Client part only needs the standard library.
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import os
+import sys
+import hmac
+import json
+import socket
+import binascii
+import logging
+import threading
+from time import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from StringIO import StringIO
+    import httplib
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from io import StringIO
+    import http.client as httplib
+
+from virtapi.settings import SETTINGS
+
+
+class DaemonError(Exception):
+    pass
+
+
+TOKEN_HEADER = 'X-VirtAPI-Token'
+
+
+def write_token(path=None):
+    """
+    Generates new daemon token and writes it to token file with 0600 permissions, returns the token.
+    """
+    path = path or SETTINGS['DAEMON_TOKEN_FILE']
+    token = binascii.hexlify(os.urandom(32)).decode('ascii')
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+
+def read_token(path=None):
+    """
+    Returns token of running daemon, None if there is no token file.
+    """
+    try:
+        with open(path or SETTINGS['DAEMON_TOKEN_FILE']) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class ThreadStream(object):
+    """
+    Replaces sys.stdin/stdout/stderr in the daemon. Threads running a CLI command set their own buffer,
+    everything else goes to the original stream, so concurrent commands never mix their output.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def get(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return self.stream if buffer is None else buffer
+
+    def set(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, data):
+        return self.get().write(data)
+
+    def flush(self):
+        return self.get().flush()
+
+    def read(self, *args):
+        return self.get().read(*args)
+
+    def readline(self, *args):
+        return self.get().readline(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class VirtDaemon(object):
+    """
+    Serves VirtAPI methods and whole CLI commands. Only config reload and connection setup are serialized,
+    calls and commands run concurrently on the shared VirtAPI( connections and caches are thread safe);
+    configs are reloaded when their files change on disk.
+
+    GET  /status                    daemon counters
+    POST /cli                       {"argv": [...]} -> {"output", "error", "code"}
+    POST /api/<object>/<method>     {"args": [...], "kwargs": {...}} -> {"result"}
+
+    Only methods listed in OBJECTS are served over /api, POST bodies must be application/json.
+    """
+
+    # read only methods with JSON results, nothing running commands or returning host credentials
+    OBJECTS = {
+        'api': ('get_inventory',),
+        'host': ('get_all_domains', 'get_all_domains_long', 'get_domains_ips', 'get_host_info', 'get_host_memory_stats',
+                 'get_host_inventory', 'get_host_cpu_stats', 'get_host_creation_availability', 'get_connection_stats',
+                 'list_disks'),
+        'templates': ('get_templates', 'get_template_by_name', 'get_os_list', 'get_os_versions', 'exists'),
+        'plans': ('get_plans', 'get_plan_by_name', 'exists'),
+    }
+    CONFIG_FILES = ('TEMPLATESFILE', 'PLANSFILE', 'HOSTSFILE')
+
+    def __init__(self, virtapi, run_cli=None, token=None):
+        self.api = virtapi
+        self.run_cli = run_cli
+        self.token = token
+        self.lock = threading.Lock()
+        self.started = time()
+        self.mtimes = self._config_mtimes()
+        self.servers = []
+
+        # counters
+        self.requests = 0
+        self.errors = 0
+        self.reloads = 0
+        self.busy_time = 0.0
+
+    def _config_mtimes(self):
+        mtimes = []
+        for name in self.CONFIG_FILES:
+            try:
+                mtimes.append(os.path.getmtime(SETTINGS[name]))
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def check_config(self):
+        """
+        Reloads configs if any config file changed since last request( e.g. local vatool host connect).
+        """
+        mtimes = self._config_mtimes()
+        if mtimes != self.mtimes:
+            self.mtimes = mtimes
+            self.api.reload()
+            self.reloads += 1
+            logging.info('Daemon configuration reloaded.')
+
+    def get_object(self, name):
+        if name not in self.OBJECTS:
+            raise DaemonError('Unknown object {}.'.format(name))
+        if name == 'api':
+            return self.api
+        return getattr(self.api, {'host': 'VirtHost', 'templates': 'Templates', 'plans': 'Plans'}[name])
+
+    def prepare(self, connect=False):
+        """
+        Reloads changed configs and sets up VirtHost( and its connection) before a call or command runs.
+        """
+        with self.lock:
+            self.check_config()
+            if connect:
+                self.api.VirtHost.connect()
+
+    def call(self, name, method, args=None, kwargs=None):
+        if method not in self.OBJECTS.get(name, ()):
+            raise DaemonError('Unknown method {}.{}.'.format(name, method))
+        self.prepare(connect=name == 'host')
+        target = self.get_object(name)
+        result = getattr(target, method)(*(args or []), **(kwargs or {}))
+        # controllers often return JSON strings already
+        if isinstance(result, str):
+            try:
+                return json.loads(result)
+            except ValueError:
+                pass
+        return result
+
+    def cli(self, argv):
+        """
+        Runs CLI command in the daemon with stdout/stderr captured, returns (output, error, exit code).
+        """
+        if self.run_cli is None:
+            raise DaemonError('CLI commands are not served by this daemon.')
+        self.prepare(connect=True)
+        streams = self.install_streams()
+        stdin, stdout, stderr = StringIO(), StringIO(), StringIO()
+        for stream, buffer in zip(streams, (stdin, stdout, stderr)):
+            stream.set(buffer)
+        code = 0
+        try:
+            self.run_cli(argv)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            if not isinstance(e.code, int) and e.code is not None:
+                sys.stderr.write('{}\n'.format(e.code))
+        except EOFError:
+            sys.stderr.write('[-] Command needs interactive input, run it with VATOOL_NO_DAEMON=1. [-]\n')
+            code = 1
+        except Exception as e:
+            logging.exception('Daemon CLI command {} failed.'.format(argv))
+            sys.stderr.write('{}\n'.format(e))
+            code = 1
+        finally:
+            output, error = stdout.getvalue(), stderr.getvalue()
+            for stream in streams:
+                stream.set(None)
+        return output, error, code
+
+    def install_streams(self):
+        """
+        Installs per thread sys.stdin/stdout/stderr once, returns them.
+        """
+        with self.lock:
+            if not isinstance(sys.stdout, ThreadStream):
+                sys.stdin, sys.stdout, sys.stderr = ThreadStream(sys.stdin), ThreadStream(sys.stdout), ThreadStream(sys.stderr)
+            return sys.stdin, sys.stdout, sys.stderr
+
+    def get_status(self):
+        return {'pid': os.getpid(), 'uptime': time() - self.started, 'requests': self.requests,
+                'errors': self.errors, 'reloads': self.reloads, 'busy_time': self.busy_time,
+                'host': (self.api.host or {}).get('name')}
+
+    def authorized(self, token):
+        return self.token is not None and token is not None and hmac.compare_digest(str(token), str(self.token))
+
+    def handle(self, method, path, payload, token=None):
+        """
+        Dispatches one request, returns (HTTP status, response dict).
+        """
+        started = time()
+        self.requests += 1
+        if not self.authorized(token):
+            self.errors += 1
+            return 401, {'error': 'Missing or invalid daemon token.'}
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        try:
+            if method == 'GET' and parts == ['status']:
+                return 200, self.get_status()
+            if method == 'POST' and parts == ['cli']:
+                output, error, code = self.cli(payload.get('argv') or [])
+                return 200, {'output': output, 'error': error, 'code': code}
+            if method == 'POST' and len(parts) == 3 and parts[0] == 'api':
+                return 200, {'result': self.call(parts[1], parts[2], payload.get('args'), payload.get('kwargs'))}
+            return 404, {'error': 'Unknown endpoint {} {}.'.format(method, path)}
+        except DaemonError as e:
+            self.errors += 1
+            return 400, {'error': str(e)}
+        except Exception as e:
+            self.errors += 1
+            logging.exception('Daemon request {} {} failed.'.format(method, path))
+            return 500, {'error': str(e)}
+        finally:
+            self.busy_time += time() - started
+
+    def serve(self, socket_path=None, port=None, bind=None):
+        """
+        Serves on Unix socket( default) and/or TCP port until interrupted.
+        """
+        if socket_path is None and port is None:
+            socket_path = SETTINGS['DAEMON_SOCKET']
+        if socket_path is not None and os.path.exists(socket_path):
+            if daemon_running(socket_path):
+                raise DaemonError('Daemon already listens on {}.'.format(socket_path))
+            os.remove(socket_path)
+        if self.token is None:
+            self.token = write_token()
+
+        handler = make_handler(self)
+        if socket_path is not None:
+            server = ThreadingUnixHTTPServer(socket_path, handler)
+            os.chmod(socket_path, 0o600)
+            self.servers.append(server)
+        if port is not None:
+            self.servers.append(ThreadingHTTPServer((bind or SETTINGS['DAEMON_BIND'], port), handler))
+
+        threads = []
+        for server in self.servers[1:]:
+            thread = threading.Thread(target=server.serve_forever, name='virtapi-daemon')
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            self.servers[0].serve_forever()
+        finally:
+            self.shutdown(socket_path)
+
+    def shutdown(self, socket_path=None):
+        for server in self.servers:
+            server.server_close()
+        self.servers = []
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+        if read_token() == self.token:
+            os.remove(SETTINGS['DAEMON_TOKEN_FILE'])
+
+
+def make_handler(daemon):
+
+    class VirtDaemonHandler(BaseHTTPRequestHandler):
+
+        def _respond(self, status, response):
+            body = json.dumps(response, default=str).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _payload(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if not length:
+                return {}
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+
+        def do_GET(self):
+            self._respond(*daemon.handle('GET', self.path, {}, token=self.headers.get(TOKEN_HEADER)))
+
+        def do_POST(self):
+            # browsers send text/plain or form bodies cross-site without preflight, those are never accepted
+            if (self.headers.get('Content-Type') or '').split(';')[0].strip().lower() != 'application/json':
+                self._respond(415, {'error': 'Content-Type must be application/json.'})
+                return
+            try:
+                payload = self._payload()
+            except ValueError as e:
+                self._respond(400, {'error': 'Invalid JSON: {}.'.format(e)})
+                return
+            self._respond(*daemon.handle('POST', self.path, payload, token=self.headers.get(TOKEN_HEADER)))
+
+        def address_string(self):
+            # Unix socket clients have no address
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def log_message(self, format, *args):
+            logging.debug('Daemon: ' + format % args)
+
+    return VirtDaemonHandler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+def request(path, payload=None, socket_path=None, url=None, timeout=None):
+    """
+    Sends request to the daemon, returns decoded JSON response. Raises DaemonError on error response.
+    """
+    if url is not None:
+        host, _, port = url.replace('http://', '').rstrip('/').partition(':')
+        conn = httplib.HTTPConnection(host, int(port or 80), timeout=timeout)
+    else:
+        conn = UnixHTTPConnection(socket_path or SETTINGS['DAEMON_SOCKET'], timeout=timeout)
+    headers = {TOKEN_HEADER: read_token() or ''}
+    try:
+        if payload is None:
+            conn.request('GET', path, headers=headers)
+        else:
+            headers['Content-Type'] = 'application/json'
+            conn.request('POST', path, json.dumps(payload), headers)
+        response = conn.getresponse()
+        data = json.loads(response.read().decode('utf-8'))
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise DaemonError(data.get('error'))
+    return data
+
+
+def daemon_running(socket_path=None):
+    """
+    Returns True if daemon answers on the Unix socket, even when it rejects our token.
+    """
+    socket_path = socket_path or SETTINGS['DAEMON_SOCKET']
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        request('/status', socket_path=socket_path, timeout=SETTINGS['DAEMON_CONNECT_TIMEOUT'])
+        return True
+    except DaemonError:
+        return True
+    except (socket.error, ValueError, httplib.HTTPException):
+        return False
+
+
+def call(obj, method, *args, **kwargs):
+    """
+    Calls VirtAPI method in the daemon, e.g. call('host', 'get_all_domains').
+    """
+    return request('/api/{}/{}'.format(obj, method), {'args': list(args), 'kwargs': kwargs})['result']
+
+
+def run_remote(argv, socket_path=None):
+    """
+    Runs CLI command in the daemon, writes its output and returns exit code. Returns None when daemon
+    is not reachable, so caller can run the command itself.
+    """
+    socket_path = socket_path or SETTINGS['DAEMON_SOCKET']
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        response = request('/cli', {'argv': argv}, socket_path=socket_path)
+    except (socket.error, httplib.HTTPException) as e:
+        logging.debug('Daemon not reachable on {}: {}.'.format(socket_path, e))
+        return None
+    except DaemonError as e:
+        logging.warning('Daemon on {} refused command, running it locally: {}'.format(socket_path, e))
+        return None
+    sys.stdout.write(response['output'])
+    sys.stderr.write(response['error'])
+    return response['code']
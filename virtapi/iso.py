@@ -0,0 +1,139 @@
+"""
+Minimal ISO9660 image builder with Joliet names, enough for cloud-init NoCloud seeds.
+Builds single directory images in memory, output is deterministic for the same files.
+__author__ = Strahinja Piperac <spiperac@denkei.org>
+"""
+
+import re
+import struct
+
+SECTOR = 2048
+
+# fixed timestamps keep images reproducible, so equal seeds hash equally
+_RECORD_DATE = struct.pack('7B', 70, 1, 1, 0, 0, 0, 0)
+_VOLUME_DATE = b'1970010100000000\x00'
+_NO_DATE = b'0000000000000000\x00'
+
+
+def _both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _sectors(size):
+    return (size + SECTOR - 1) // SECTOR
+
+
+def _pad(data, size, fill=b' '):
+    return data[:size] + fill * (size - len(data[:size]))
+
+
+def _joliet(text, size):
+    data = text.encode('utf-16-be')[:size - size % 2]
+    data += b'\x00 ' * ((size - len(data)) // 2)
+    return data + b'\x00' * (size - len(data))
+
+
+def _record(name, extent, size, directory=False):
+    length = 33 + len(name) + (1 - len(name) % 2)
+    return (struct.pack('BB', length, 0) + _both32(extent) + _both32(size) + _RECORD_DATE +
+            struct.pack('BBB', 2 if directory else 0, 0, 0) + _both16(1) + struct.pack('B', len(name)) +
+            name + b'\x00' * (1 - len(name) % 2))
+
+
+def _iso_name(name, used):
+    """
+    Returns unique ISO9660 level 1 name( 8.3, d-characters) for the file name.
+    """
+    base, _, ext = name.upper().rpartition('.') if '.' in name else (name.upper(), '', '')
+    base = re.sub('[^A-Z0-9_]', '_', base)[:8] or '_'
+    ext = re.sub('[^A-Z0-9_]', '_', ext)[:3]
+    candidate = base
+    counter = 0
+    while '{}.{}'.format(candidate, ext) in used:
+        counter += 1
+        suffix = str(counter)
+        candidate = base[:8 - len(suffix)] + suffix
+    used.add('{}.{}'.format(candidate, ext))
+    return '{}.{};1'.format(candidate, ext).encode('ascii')
+
+
+def _directory(root_extent, entries):
+    data = _record(b'\x00', root_extent, SECTOR, directory=True)
+    data += _record(b'\x01', root_extent, SECTOR, directory=True)
+    for name, extent, size in sorted(entries):
+        data += _record(name, extent, size)
+    if len(data) > SECTOR:
+        raise ValueError('Too many files for single sector ISO directory.')
+    return _pad(data, SECTOR, b'\x00')
+
+
+def _path_table(extent, big_endian=False):
+    location = struct.pack('>I' if big_endian else '<I', extent)
+    parent = struct.pack('>H' if big_endian else '<H', 1)
+    return struct.pack('BB', 1, 0) + location + parent + b'\x00\x00'
+
+
+def _descriptor(kind, volume_id, sectors, path_table_size, l_table, m_table, root_extent, joliet=False):
+    if joliet:
+        text = lambda value, size: _joliet(value, size)
+        escapes = _pad(b'%/E', 32, b'\x00')
+    else:
+        text = lambda value, size: _pad(value.upper().encode('ascii'), size)
+        escapes = b'\x00' * 32
+
+    data = struct.pack('B', kind) + b'CD001' + struct.pack('BB', 1, 0)
+    data += text('LINUX', 32)
+    data += (_joliet(volume_id, 32) if joliet else _pad(volume_id.encode('ascii'), 32))
+    data += b'\x00' * 8 + _both32(sectors) + escapes
+    data += _both16(1) + _both16(1) + _both16(SECTOR) + _both32(path_table_size)
+    data += struct.pack('<I', l_table) + b'\x00' * 4 + struct.pack('>I', m_table) + b'\x00' * 4
+    data += _record(b'\x00', root_extent, SECTOR, directory=True)
+    data += text('', 128) * 3 + text('VIRTAPI', 128)
+    data += text('', 37) * 3
+    data += _VOLUME_DATE * 2 + _NO_DATE * 2
+    data += b'\x01\x00'
+    return _pad(data, SECTOR, b'\x00')
+
+
+def build_iso(files, volume_id='cidata'):
+    """
+    Builds ISO image from {filename: bytes} and returns it as bytes.
+    Files are readable with their real names through Joliet, ISO9660 names are 8.3 fallbacks.
+    """
+    names = sorted(files)
+    # system area, primary, joliet, terminator, 4 path tables, 2 root directories
+    primary_l, primary_m, joliet_l, joliet_m = 19, 20, 21, 22
+    primary_root, joliet_root = 23, 24
+    extent = 25
+
+    used = set()
+    primary_entries = []
+    joliet_entries = []
+    extents = []
+    for name in names:
+        data = files[name]
+        primary_entries.append((_iso_name(name, used), extent, len(data)))
+        joliet_entries.append((name.encode('utf-16-be'), extent, len(data)))
+        extents.append(data)
+        extent += _sectors(len(data))
+
+    sectors = extent
+    table_size = len(_path_table(0))
+
+    image = [b'\x00' * SECTOR * 16]
+    image.append(_descriptor(1, volume_id, sectors, table_size, primary_l, primary_m, primary_root))
+    image.append(_descriptor(2, volume_id, sectors, table_size, joliet_l, joliet_m, joliet_root, joliet=True))
+    image.append(_pad(b'\xffCD001\x01', SECTOR, b'\x00'))
+    image.append(_pad(_path_table(primary_root), SECTOR, b'\x00'))
+    image.append(_pad(_path_table(primary_root, big_endian=True), SECTOR, b'\x00'))
+    image.append(_pad(_path_table(joliet_root), SECTOR, b'\x00'))
+    image.append(_pad(_path_table(joliet_root, big_endian=True), SECTOR, b'\x00'))
+    image.append(_directory(primary_root, primary_entries))
+    image.append(_directory(joliet_root, joliet_entries))
+    for data in extents:
+        image.append(_pad(data, _sectors(len(data)) * SECTOR, b'\x00'))
+    return b''.join(image)
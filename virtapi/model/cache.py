@@ -0,0 +1,295 @@
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from virtapi.settings import SETTINGS
+from virtapi.utilities import download, probe, parse_checksum, mkdir_p
+
+
+class TemplateCache(object):
+    '''
+    Local template image cache. Images are stored under content key( checksum from templates.yml, or
+    hash of url + ETag/Last-Modified when there is no checksum), so same filenames from different urls
+    never collide. Index keeps size and last use of every image, least recently used images are
+    evicted once cache grows over the byte budget. Index is changed only under exclusive lock on index.json.lock,
+    re-read before every change and replaced atomically, so concurrent vatool processes do not lose updates.
+    '''
+
+    def __init__(self, directory=None, budget=None):
+        self.directory = directory or SETTINGS['IMAGE_CACHE_DIR']
+        self.budget = budget if budget is not None else SETTINGS['TEMPLATE_CACHE_BUDGET']
+        self.index_file = os.path.join(self.directory, 'index.json')
+        self.lock = threading.RLock()
+        self.locked = 0
+        self.entries = {}
+        self.load_index()
+
+    def load_index(self):
+        '''
+        Loads cache index, entries without image file are dropped.
+        '''
+        with self.lock:
+            entries = {}
+            if os.path.exists(self.index_file):
+                try:
+                    with open(self.index_file) as f:
+                        entries = json.load(f)
+                except ValueError as e:
+                    logging.error('Template cache index is broken, starting empty: {}.'.format(e))
+            self.entries = dict((key, entry) for key, entry in entries.items()
+                                if os.path.exists(os.path.join(self.directory, entry['file'])))
+
+    def save_index(self):
+        with self.lock:
+            mkdir_p(self.directory)
+            tmp = '{}.{}.tmp'.format(self.index_file, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.index_file)
+
+    @contextmanager
+    def locked_index(self):
+        '''
+        Reloads index under exclusive file lock, yields entries to be changed and saves them. Nested use
+        in the same process reuses the held lock.
+        '''
+        with self.lock:
+            if self.locked:
+                yield self.entries
+                return
+            mkdir_p(self.directory)
+            with open(self.index_file + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.locked += 1
+                try:
+                    self.load_index()
+                    yield self.entries
+                    self.save_index()
+                finally:
+                    self.locked -= 1
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_key(self, url, checksum=None, remote=None):
+        '''
+        Returns cache key of the image: checksum digest, or hash of url and remote version.
+        '''
+        algorithm, digest = parse_checksum(checksum)
+        if digest:
+            return '{}-{}'.format(algorithm, digest)
+        version = ''
+        if remote is not None:
+            version = remote.get('etag') or remote.get('modified') or ''
+        return 'url-{}'.format(hashlib.sha256('{}\n{}'.format(url, version).encode('utf-8')).hexdigest())
+
+    def _find_url(self, url):
+        entries = [entry for entry in self.entries.values() if entry['url'] == url]
+        if not entries:
+            return None
+        return max(entries, key=lambda entry: entry['created'])
+
+    def lookup(self, url, checksum=None):
+        '''
+        Returns cache entry for the image or None. Without checksum remote version is checked with HEAD
+        request, when remote is unreachable latest cached copy of the url is used.
+        '''
+        remote = None
+        if not parse_checksum(checksum)[1]:
+            try:
+                remote = probe(url)
+            except Exception as e:
+                logging.warning('Remote {} not reachable, using cached copy: {}.'.format(url, e))
+                with self.locked_index():
+                    return self.touch(self._find_url(url))
+
+        key = self.get_key(url, checksum=checksum, remote=remote)
+        with self.locked_index() as entries:
+            return self.touch(entries.get(key))
+
+    def touch(self, entry):
+        if entry is not None:
+            with self.locked_index() as entries:
+                entry = entries.get(entry['key'])
+                if entry is not None:
+                    entry['last_used'] = time()
+                    entry['hits'] = entry.get('hits', 0) + 1
+        return entry
+
+    def fetch(self, url, checksum=None):
+        '''
+        Returns cache entry for the image, downloading it on miss.
+        '''
+        remote = None
+        if not parse_checksum(checksum)[1]:
+            try:
+                remote = probe(url)
+            except Exception:
+                with self.locked_index():
+                    entry = self.touch(self._find_url(url))
+                if entry is None:
+                    raise
+                logging.warning('Remote {} not reachable, using cached copy.'.format(url))
+                return entry
+
+        key = self.get_key(url, checksum=checksum, remote=remote)
+        with self.locked_index() as entries:
+            entry = self.touch(entries.get(key))
+        if entry is not None:
+            return entry
+
+        filename = '{}-{}'.format(key, os.path.basename(url))
+        with self.download_lock(filename):
+            # another process could have downloaded it while we waited for the lock
+            with self.locked_index() as entries:
+                entry = self.touch(entries.get(key))
+            if entry is not None:
+                return entry
+            download(url, self.directory, checksum=checksum, filename=filename, remote=remote)
+            return self._add(key, url, filename, checksum, remote)
+
+    @contextmanager
+    def download_lock(self, filename):
+        '''
+        Exclusive lock of one cached file, held while it is downloaded or installed, so concurrent
+        processes never write the same partial download.
+        '''
+        mkdir_p(self.directory)
+        with open(os.path.join(self.directory, filename + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _add(self, key, url, filename, checksum=None, remote=None):
+        now = time()
+        entry = {'key': key, 'url': url, 'file': filename, 'checksum': checksum,
+                 'etag': remote.get('etag') if remote else None,
+                 'size': os.path.getsize(os.path.join(self.directory, filename)),
+                 'created': now, 'last_used': now, 'hits': 0}
+
+        with self.locked_index() as entries:
+            entries[key] = entry
+            self.evict(keep=[key])
+        return entry
+
+    def prepare(self, url, checksum=None):
+        '''
+        Returns target for filling the cache from a stream: {'key', 'url', 'checksum', 'remote', 'filename', 'path'}.
+        Stream is written to path( partial file) and added to the cache with add_stream once complete.
+        '''
+        remote = None
+        if not parse_checksum(checksum)[1]:
+            remote = probe(url)
+        key = self.get_key(url, checksum=checksum, remote=remote)
+        filename = '{}-{}'.format(key, os.path.basename(url))
+        mkdir_p(self.directory)
+        return {'key': key, 'url': url, 'checksum': checksum, 'remote': remote, 'filename': filename,
+                'path': os.path.join(self.directory, '{}.{}.stream'.format(filename, os.getpid()))}
+
+    def add_stream(self, target):
+        '''
+        Adds completely streamed( and verified) file of prepare target to the cache, returns entry.
+        '''
+        with self.download_lock(target['filename']):
+            os.rename(target['path'], os.path.join(self.directory, target['filename']))
+            return self._add(target['key'], target['url'], target['filename'], target['checksum'], target['remote'])
+
+    def discard(self, target):
+        if os.path.exists(target['path']):
+            os.remove(target['path'])
+
+    def get_path(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def get_size(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def list(self):
+        '''
+        Returns cache entries, most recently used first.
+        '''
+        with self.lock:
+            self.load_index()
+            return sorted(self.entries.values(), key=lambda entry: entry['last_used'], reverse=True)
+
+    def remove(self, key):
+        with self.locked_index() as entries:
+            entry = entries.pop(key, None)
+            if entry is None:
+                return None
+            try:
+                os.remove(self.get_path(entry))
+            except OSError as e:
+                logging.warning('Cached image {} not removed: {}.'.format(entry['file'], e))
+            logging.info('Evicted {} from template cache.'.format(entry['file']))
+            return entry
+
+    def evict(self, budget=None, keep=None):
+        '''
+        Removes least recently used images until cache fits into budget, returns removed entries.
+        '''
+        budget = budget if budget is not None else self.budget
+        keep = keep or []
+        removed = []
+        with self.locked_index():
+            total = self.get_size()
+            for entry in sorted(self.entries.values(), key=lambda entry: entry['last_used']):
+                if total <= budget:
+                    break
+                if entry['key'] in keep:
+                    continue
+                self.remove(entry['key'])
+                total -= entry['size']
+                removed.append(entry)
+        return removed
+
+    def prune(self, budget=None, max_age=None):
+        '''
+        Removes images unused for max_age seconds and evicts down to budget. Leftover partial downloads
+        are kept, they resume on next fetch.
+        '''
+        removed = []
+        with self.locked_index() as entries:
+            if max_age is not None:
+                now = time()
+                for entry in list(entries.values()):
+                    if now - entry['last_used'] > max_age:
+                        removed.append(self.remove(entry['key']))
+            removed.extend(self.evict(budget=budget))
+        return removed
+
+    def prefetch(self, templates, workers=None):
+        '''
+        Warms cache with list of templates in parallel, returns {name: entry or error string}.
+        '''
+        workers = workers or SETTINGS['TEMPLATE_CACHE_WORKERS']
+
+        def fetch(template):
+            try:
+                return template['name'], self.fetch(template['iso'], checksum=template.get('checksum'))
+            except Exception as e:
+                logging.error('Prefetch of template {} failed: {}.'.format(template['name'], e))
+                return template['name'], str(e)
+
+        unique = {}
+        for template in templates:
+            unique.setdefault((template['iso'], template.get('checksum')), template)
+        templates = list(unique.values())
+
+        if not templates:
+            return {}
+        pool = ThreadPool(max(1, min(workers, len(templates))))
+        try:
+            return dict(pool.map(fetch, templates))
+        finally:
+            pool.close()
+            pool.join()
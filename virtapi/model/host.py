@@ -1,51 +1,54 @@
-import yaml
 import os.path
-import paramiko
-from paramiko.ssh_exception import *
+import socket
 from virtapi.settings import *
+from virtapi.model.store import ConfigStore
 from virtapi.utilities import ssh_copy_id, ssh_copy_id_new_key,  generate_ssh_key, get_public_key
 
 class Hosts(object):
 
     def __init__(self):
-        self.hosts = None
+        self.store = None
         self.load_hosts()
 
+    @property
+    def hosts(self):
+        return self.store.get_entries()
+
     def load_hosts(self):
         '''
         Loads hosts from configuration hosts file.
         '''
-        with open(SETTINGS['HOSTSFILE'], 'r') as stream:
-            try:
-                self.hosts = yaml.load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        if self.store is None:
+            self.store = ConfigStore(SETTINGS['HOSTSFILE'])
+        else:
+            self.store.load(force=True)
 
     def add_host(self, host):
-        self.hosts.append(host)
-        self.save_hosts()
+        self.store.add(host)
 
     def delete_host(self, host):
-        if self.exists(host):
-            self.hosts.remove(self.get_host_by_name(host))
-            self.save_hosts()
+        self.store.delete(host)
 
-    def ssh_exec(self, cmd):
+    def ssh_exec(self, cmd, host=None, timeout=None):
         """
-        Execute shell command on the host.
+        Execute shell command on the host( active one by default) over pooled SSH session.
+        Returns {'command', 'status', 'stdout', 'stderr', 'time', 'error'}.
         """
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        host = self.get_active()
-        if host['key'] == SETTINGS['DEFAULTKEYFILE']:
-            client.connect(host['connection'], username=host['username'], key_filename=host['key'], allow_agent=False)
-        else:
-            key_password = raw_input('Enter SSH key password: ')
-            client.connect(host['connection'], username=host['username'], key_filename=host['key'], password=key_password)
-        stdin, stdout, stderr = client.exec_command(cmd)
-        return stdout
+        from virtapi.controller.ssh_ctrl import ssh_pool
+        host = self.get_host_by_name(host) if host is not None else self.get_active()
+        return ssh_pool.exec_command(host, cmd, timeout=timeout)
+
+    def ssh_exec_many(self, cmd, names=None, workers=None, timeout=None):
+        """
+        Execute shell command( or ordered list of commands) on many hosts( all by default) in parallel.
+        Returns {host name: result}.
+        """
+        from virtapi.controller.ssh_ctrl import ssh_pool
+        hosts = [host for host in self.hosts if names is None or host['name'] in names]
+        return ssh_pool.run_many(hosts, cmd, workers=workers, timeout=timeout)
     
     def add_key(self, key):
+        from paramiko.ssh_exception import BadHostKeyException, AuthenticationException, SSHException
         if key == 'default':
             try:
                 host = self.get_active()
@@ -59,27 +62,20 @@ class Hosts(object):
         '''
         Save hosts from hosts object.
         '''
-        with open(SETTINGS['HOSTSFILE'], 'w') as stream:
-            try:
-                yaml.dump(self.hosts, stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        self.store.save()
 
     def get_hosts(self):
         return self.hosts
 
     def set_active(self, name, add_key=False, key_path=None):
-        pub_key = get_public_key()
+        host = self.get_host_by_name(name)
+        if host is not None and host['protocol'] == 'ssh' and add_key==True:
+            ssh_copy_id(get_public_key(), host['connection'], host['username'], host['password'])
 
-        for host in self.hosts:
-            if host['name'] == name:
-                host['active'] = True
-                if host['protocol'] == 'ssh':
-                    if add_key==True:
-                        ssh_copy_id(pub_key, host['connection'], host['username'], host['password'])
-            else:
-                host['active'] = False
-        self.save_hosts()
+        def change(hosts):
+            for host in hosts:
+                host['active'] = host['name'] == name
+        self.store.update(change)
     
     def get_active(self):
         for host in self.hosts:
@@ -87,23 +83,12 @@ class Hosts(object):
                 return host
 
     def is_active(self, name):
-        for host in self.hosts:
-            if host['name'] == name:
-                if host['active']:
-                    return True
-                else:
-                    return False
+        host = self.get_host_by_name(name)
+        if host is not None:
+            return bool(host['active'])
 
     def get_host_by_name(self, name):
-        exists = False
-        for host in self.hosts:
-            if host['name'] == name:
-                return host
-        return None
+        return self.store.get(name)
 
     def exists(self, name):
-        exists = False
-        for host in self.hosts:
-            if host['name'] == name:
-                exists = True
-        return exists
+        return self.store.exists(name)
@@ -1,56 +1,44 @@
-import yaml
-import os.path
 from virtapi.settings import SETTINGS
+from virtapi.model.store import ConfigStore
 
 class Plans(object):
     
     def __init__(self):
         
         #loading plans
-        self.plans = None
+        self.store = None
         self.load_plans()
 
+    @property
+    def plans(self):
+        return self.store.get_entries()
+
     def load_plans(self):
         '''
         Loads plans from configuration plans file.
         '''
-        with open(SETTINGS['PLANSFILE'], 'r') as stream:
-            try:
-                self.plans = yaml.load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        if self.store is None:
+            self.store = ConfigStore(SETTINGS['PLANSFILE'])
+        else:
+            self.store.load(force=True)
 
     def save_plans(self):
         '''
         Save plans in configuration plans file.
         '''
-        with open(SETTINGS['PLANSFILE'], 'w') as stream:
-            try:
-                self.plans = yaml.dump(self.plans, stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        self.store.save()
  
     def get_plans(self):
         return self.plans
 
     def get_plan_by_name(self, name):
-        for plan in self.plans:
-            if plan['name'] == name:
-                return plan
+        return self.store.get(name)
 
     def add_plan(self, plan):
-        self.plans.append(plan)
-        self.save_plans()
+        self.store.add(plan)
 
     def delete_plan(self, name):
-        if self.exists(name):
-            self.plans.remove(self.get_plan_by_name(name))
-            self.save_plans()
+        self.store.delete(name)
 
     def exists(self, name):
-        exists = False
-        for plan in self.plans:
-            if plan['name'] == name:
-                exists = True
-        return exists
-
+        return self.store.exists(name)
@@ -0,0 +1,267 @@
+import os
+import re
+import uuid
+import fcntl
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from virtapi.settings import SETTINGS
+from virtapi.utilities import mkdir_p
+from virtapi.controller.domain_ctrl import VirtDomain
+
+
+class WarmPool(object):
+    '''
+    Keeps size pre-provisioned, booted domains of a (template, plan) pair ready for hand over.
+    Spares are parked paused( resume is instant) or managed-saved( no host memory held, restored on start).
+    They are recognized by labels in domain metadata, so spares made by another process are used as well.
+    Spares are claimed under a per pool lock file with labels re-read from libvirt, so two processes never
+    hand over the same spare.
+    '''
+
+    MODES = ('paused', 'managedsave')
+
+    def __init__(self, virthost, template, plan, size=None, mode=None, reseed=None, timeout=None):
+        self.virthost = virthost
+        self.template = template
+        self.plan = plan
+        self.size = size if size is not None else SETTINGS['WARM_POOL_SIZE']
+        self.mode = mode or SETTINGS['WARM_POOL_MODE']
+        if self.mode not in self.MODES:
+            raise ValueError('Unknown warm pool mode {}.'.format(self.mode))
+        self.reseed = reseed
+        self.timeout = timeout
+        self.key = '{}:{}'.format(template, plan['name'])
+        self.lock_file = os.path.join(SETTINGS['WARM_POOL_LOCK_DIR'], 'warm-{}.lock'.format(re.sub(r'[^A-Za-z0-9_.-]', '_', self.key)))
+
+        self.lock = threading.Lock()
+        self.provisioning = 0
+        self.refill = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.handover_time = 0.0
+
+    def matches(self, template, params):
+        '''
+        Returns True if domain params( ram, vcpu, diskSize) fit the plan of this pool.
+        '''
+        if template != self.template:
+            return False
+        for key in ('ram', 'vcpu', 'diskSize'):
+            if params.get(key) is not None and str(params.get(key)) != str(self.plan.get(key)):
+                return False
+        return True
+
+    def get_spares(self):
+        '''
+        Returns domain objects of spares ready for hand over.
+        '''
+        spares = []
+        for domain in self.virthost.conn.listAllDomains(0):
+            labels = VirtDomain(domain=domain).get_labels()
+            if labels.get('warm_pool') == self.key and labels.get('warm_state') == 'spare':
+                spares.append(domain)
+        return spares
+
+    @contextmanager
+    def claim_lock(self):
+        '''
+        Exclusive lock of the pool shared by all processes on this machine.
+        '''
+        with self.lock:
+            mkdir_p(SETTINGS['WARM_POOL_LOCK_DIR'])
+            with open(self.lock_file, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def provision(self):
+        '''
+        Creates one spare, waits until it is booted and parks it. Returns domain object or None,
+        spares which did not boot in time are deleted.
+        '''
+        name = 'warm-{}-{}'.format(self.template, uuid.uuid4().hex[:8])
+        params = {'name': name, 'ram': self.plan.get('ram'), 'vcpu': self.plan.get('vcpu'),
+                  'diskSize': self.plan.get('diskSize')}
+        vm = self.virthost.create_domain_from_template(self.template, params, start=False, warm=False)
+        if vm is None:
+            return None
+
+        try:
+            virtdomain = VirtDomain(domain=vm)
+            virtdomain.set_labels({'warm_pool': self.key, 'warm_state': 'provisioning'})
+            if self.virthost._start_and_wait(vm, self.timeout) is None:
+                raise Exception('Spare {} did not boot in time.'.format(name))
+            vm.setAutostart(0)
+            if self.mode == 'paused':
+                vm.suspend()
+            else:
+                vm.managedSave(0)
+            virtdomain.set_labels({'warm_state': 'spare'})
+        except Exception:
+            if vm.hasManagedSaveImage(0):
+                vm.managedSaveRemove(0)
+            self.virthost.delete_domain(name)
+            raise
+
+        with self.lock:
+            self.created += 1
+        logging.info('Warm spare {} for {} ready.'.format(name, self.key))
+        return vm
+
+    def _provision(self, index):
+        try:
+            return self.provision()
+        except Exception as e:
+            logging.error('Warm spare for {} failed: {}.'.format(self.key, e))
+            return None
+        finally:
+            with self.lock:
+                self.provisioning -= 1
+
+    def fill(self):
+        '''
+        Provisions missing spares( at most WARM_POOL_CONCURRENCY at once), returns number of created spares.
+        '''
+        with self.lock:
+            missing = self.size - len(self.get_spares()) - self.provisioning
+            if missing <= 0:
+                return 0
+            self.provisioning += missing
+
+        pool = ThreadPool(max(1, min(missing, SETTINGS['WARM_POOL_CONCURRENCY'])))
+        try:
+            results = pool.map(self._provision, range(missing))
+        finally:
+            pool.close()
+            pool.join()
+        return len([vm for vm in results if vm is not None])
+
+    def acquire(self, name=None, seed=None, labels=None, timeout=None):
+        '''
+        Hands over a spare: claims it, resumes it, tags it with name( title and warm_name label) and labels
+        and runs reseed hook( reseed(domain, name, seed)). With timeout it also waits until the domain is
+        reachable. Returns domain object, or None when no spare is ready or it could not be resumed.
+        '''
+        from virtapi.controller.event_ctrl import wait_for_domains
+
+        started = time()
+        vm = None
+        with self.claim_lock():
+            for spare in self.get_spares():
+                # labels in cached XML may be stale, another process could have claimed the spare
+                virtdomain = VirtDomain(domain=spare)
+                virtdomain.refresh()
+                if virtdomain.get_labels().get('warm_state') == 'spare':
+                    virtdomain.set_labels({'warm_state': 'claimed'})
+                    vm = spare
+                    break
+        if vm is None:
+            with self.lock:
+                self.misses += 1
+            self.refill.set()
+            return None
+
+        try:
+            if self.mode == 'paused':
+                vm.resume()
+            else:
+                vm.create()
+            vm.setAutostart(1)
+        except Exception as e:
+            # claimed spare would never be handed over again, drop it and let caller create a domain
+            logging.error('Warm spare {} could not be resumed: {}.'.format(vm.name(), e))
+            self.discard(vm)
+            with self.lock:
+                self.misses += 1
+            self.refill.set()
+            return None
+
+        if name is not None:
+            virtdomain.set_title(name)
+        assigned = dict(labels or {})
+        assigned.update({'warm_state': 'assigned', 'warm_name': name})
+        virtdomain.set_labels(assigned)
+        if self.reseed is not None:
+            self.reseed(vm, name, seed or {})
+        if timeout is not None and wait_for_domains(self.virthost.conn, [vm], timeout=timeout)[vm.name()] is None:
+            logging.warning('Warm spare {} handed over as {} is not reachable after {}s.'.format(vm.name(), name, timeout))
+
+        elapsed = time() - started
+        with self.lock:
+            self.hits += 1
+            self.handover_time += elapsed
+        self.refill.set()
+        logging.info('Warm spare {} handed over as {} in {:.3f}s.'.format(vm.name(), name, elapsed))
+        return vm
+
+    def discard(self, vm):
+        '''
+        Deletes a spare which can not be handed over, it is marked failed first so it is never claimed
+        again even if delete fails.
+        '''
+        name = vm.name()
+        try:
+            VirtDomain(domain=vm).set_labels({'warm_state': 'failed'})
+            if vm.hasManagedSaveImage(0):
+                vm.managedSaveRemove(0)
+            self.virthost.delete_domain(name)
+        except Exception as e:
+            logging.error('Warm spare {} could not be deleted: {}.'.format(name, e))
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.refill.clear()
+            self.fill()
+            self.refill.wait(SETTINGS['WARM_POOL_CHECK_INTERVAL'])
+
+    def start(self):
+        '''
+        Starts background refill thread.
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='virtapi-warm-{}'.format(self.key))
+            self.thread.daemon = True
+            self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        self.refill.set()
+
+    def drain(self):
+        '''
+        Deletes all spares of the pool, returns their names.
+        '''
+        names = []
+        with self.claim_lock():
+            for vm in self.get_spares():
+                if vm.hasManagedSaveImage(0):
+                    vm.managedSaveRemove(0)
+                names.append(vm.name())
+                self.virthost.delete_domain(vm.name())
+        return names
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'key': self.key,
+                'mode': self.mode,
+                'size': self.size,
+                'spares': len(self.get_spares()),
+                'provisioning': self.provisioning,
+                'created': self.created,
+                'hits': self.hits,
+                'misses': self.misses,
+                'avg_handover_time': self.handover_time / self.hits if self.hits else 0.0,
+            }
@@ -0,0 +1,67 @@
+import os
+from virtapi.settings import SETTINGS
+from virtapi.model.store import ConfigStore
+
+class Snapshots(object):
+    '''
+    Index of external disk-only snapshots made by virtapi. Entries are keyed by '<domain uuid>/<snapshot name>'
+    and keep frozen base image and overlay created on top of it for every snapshotted disk:
+    {'id', 'name', 'domain', 'uuid', 'created', 'description', 'quiesced', 'duration', 'disks': {dev: {'base', 'overlay'}}}
+    '''
+
+    def __init__(self):
+        self.store = None
+        self.load_snapshots()
+
+    @property
+    def snapshots(self):
+        return self.store.get_entries()
+
+    def load_snapshots(self):
+        '''
+        Loads snapshots from snapshots index file, file is created if it does not exist yet.
+        '''
+        if self.store is None:
+            if not os.path.exists(SETTINGS['SNAPSHOTSFILE']):
+                if not os.path.isdir(os.path.dirname(SETTINGS['SNAPSHOTSFILE'])):
+                    os.makedirs(os.path.dirname(SETTINGS['SNAPSHOTSFILE']))
+                open(SETTINGS['SNAPSHOTSFILE'], 'a').close()
+            self.store = ConfigStore(SETTINGS['SNAPSHOTSFILE'], key='id')
+        else:
+            self.store.load(force=True)
+
+    def get_id(self, uuid, name):
+        return '{}/{}'.format(uuid, name)
+
+    def get_snapshot(self, uuid, name):
+        return self.store.get(self.get_id(uuid, name))
+
+    def get_domain_snapshots(self, uuid):
+        '''
+        Returns snapshots of the domain, oldest first.
+        '''
+        return sorted([snapshot for snapshot in self.snapshots if snapshot.get('uuid') == uuid],
+                      key=lambda snapshot: snapshot['created'])
+
+    def add_snapshot(self, snapshot):
+        snapshot['id'] = self.get_id(snapshot['uuid'], snapshot['name'])
+        self.store.add(snapshot)
+
+    def delete_snapshot(self, uuid, name):
+        return self.store.delete(self.get_id(uuid, name))
+
+    def update_snapshots(self, change):
+        '''
+        Applies change( function taking list of all snapshots and changing it in place) atomically.
+        '''
+        return self.store.update(change)
+
+    def delete_domain_snapshots(self, uuid):
+        '''
+        Removes all snapshots of the domain from the index, returns removed entries.
+        '''
+        def change(snapshots):
+            removed = [snapshot for snapshot in snapshots if snapshot.get('uuid') == uuid]
+            snapshots[:] = [snapshot for snapshot in snapshots if snapshot.get('uuid') != uuid]
+            return removed
+        return self.update_snapshots(change)
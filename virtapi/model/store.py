@@ -0,0 +1,170 @@
+import os
+import copy
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+
+import yaml
+
+# C LibYAML is several times faster, pure python loader is used when PyYAML is built without it
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class ConfigError(Exception):
+    pass
+
+
+class ConfigStore(object):
+    '''
+    YAML file with a list of named entries( templates, plans, hosts) and index by name.
+    Parsed files are cached per path while their mtime and size do not change, so reloading an unchanged
+    file costs one stat. Every change is made under exclusive lock on <file>.lock: file is re-read,
+    change applied and written to temporary file which is renamed over the original, so concurrent
+    vatool processes never see half written file or lose each others changes. File which does not parse is
+    never written: reads keep working with last good entries( or none), changes raise ConfigError.
+    '''
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, path, key='name'):
+        self.path = path
+        self.key = key
+        self.lock = threading.RLock()
+        self.entries = []
+        self.index = {}
+        self.stamp = None
+        self.broken = None
+        self.load()
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def _parse(self, stamp):
+        with ConfigStore._cache_lock:
+            cached = ConfigStore._cache.get(self.path)
+        if cached is not None and cached[0] == stamp:
+            return copy.deepcopy(cached[1])
+
+        with open(self.path, 'r') as stream:
+            try:
+                entries = yaml.load(stream, Loader=Loader) or []
+            except yaml.YAMLError as exc:
+                raise ConfigError('Config file {} is broken: {}'.format(self.path, exc))
+        if not isinstance(entries, list):
+            raise ConfigError('Config file {} must contain a list of entries.'.format(self.path))
+        with ConfigStore._cache_lock:
+            ConfigStore._cache[self.path] = (stamp, copy.deepcopy(entries))
+        return entries
+
+    def _set_entries(self, entries, stamp):
+        self.entries = entries
+        self.index = dict((entry[self.key], entry) for entry in entries if self.key in entry)
+        self.stamp = stamp
+
+    def load(self, force=False):
+        '''
+        Loads entries, parse is skipped if file did not change since last load.
+        '''
+        with self.lock:
+            stamp = self._stat()
+            if force or stamp != self.stamp:
+                try:
+                    self._set_entries(self._parse(stamp), stamp)
+                    self.broken = None
+                except ConfigError as e:
+                    # keep last good entries, file is not parsed again until it changes
+                    logging.error(str(e))
+                    self.broken = str(e)
+                    self.stamp = stamp
+            return self.entries
+
+    def refresh(self):
+        '''
+        Reloads entries if file was changed, e.g. by another vatool process.
+        '''
+        try:
+            return self.load()
+        except OSError as e:
+            logging.warning('Config file {} not readable: {}.'.format(self.path, e))
+            return self.entries
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, entries):
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as stream:
+                yaml.dump(entries, stream, Dumper=Dumper)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.rename(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        stamp = self._stat()
+        with ConfigStore._cache_lock:
+            ConfigStore._cache[self.path] = (stamp, copy.deepcopy(entries))
+        self._set_entries(entries, stamp)
+
+    def update(self, change):
+        '''
+        Applies change( function taking list of entries and changing it in place) to the latest file
+        content and saves it atomically. Returns what change returned. Raises ConfigError if file is broken.
+        '''
+        with self.locked():
+            entries = self._parse(self._stat())
+            result = change(entries)
+            self._write(entries)
+            return result
+
+    def save(self):
+        '''
+        Writes current entries as they are. Raises ConfigError if file is broken or was broken when entries
+        were loaded.
+        '''
+        with self.locked():
+            self._parse(self._stat())
+            if self.broken:
+                raise ConfigError(self.broken)
+            self._write(self.entries)
+
+    def get_entries(self):
+        return self.refresh()
+
+    def get(self, name):
+        self.refresh()
+        return self.index.get(name)
+
+    def exists(self, name):
+        return self.get(name) is not None
+
+    def add(self, entry):
+        '''
+        Adds entry, entry with the same name is replaced.
+        '''
+        def change(entries):
+            entries[:] = [item for item in entries if item.get(self.key) != entry[self.key]]
+            entries.append(entry)
+        self.update(change)
+
+    def delete(self, name):
+        '''
+        Deletes entry by name, returns True if it existed.
+        '''
+        def change(entries):
+            count = len(entries)
+            entries[:] = [item for item in entries if item.get(self.key) != name]
+            return len(entries) != count
+        return self.update(change)
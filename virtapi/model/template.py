@@ -1,47 +1,43 @@
-import yaml
-import os.path
 from virtapi.settings import SETTINGS
-from virtapi.utilities import download
+from virtapi.model.cache import TemplateCache
+from virtapi.model.store import ConfigStore
 
 class Templates(object):
 
     def __init__(self):
         # loading templates
-        self.templates = None
+        self.store = None
+        self.cache = TemplateCache()
         self.load_templates()
 
         #loading operating systems
         self.operating_systems = []
         self.load_operating_systems()
 
+    @property
+    def templates(self):
+        return self.store.get_entries()
+
     def load_templates(self):
         '''
         Loads templates from configuration templates file.
         '''
-        with open(SETTINGS['TEMPLATESFILE'], 'r') as stream:
-            try:
-                self.templates = yaml.load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        if self.store is None:
+            self.store = ConfigStore(SETTINGS['TEMPLATESFILE'])
+        else:
+            self.store.load(force=True)
     
     def save_templates(self):
         '''
         Save templates from templates object.
         '''
-        with open(SETTINGS['TEMPLATESFILE'], 'w') as stream:
-            try:
-                yaml.dump(self.templates, stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        self.store.save()
     
     def add_template(self, template):
-        self.templates.append(template)
-        self.save_templates()
+        self.store.add(template)
 
     def delete_template(self, template):
-        if self.exists(template):
-            self.templates.remove(self.get_template_by_name(template))
-            self.save_templates()
+        self.store.delete(template)
 
     def get_templates(self):
         return self.templates
@@ -50,16 +46,13 @@ class Templates(object):
         '''
         Loading operating systems from templates.
         '''
-        if self.templates == None:
-            pass
-        else:
-            for template in self.templates:
-                self.operating_systems.append(str(template['os']))
+        self.operating_systems = [str(template['os']) for template in self.templates]
 
     def get_os_list(self):
         '''
-        Returns just loaded list of operating systems.
+        Returns list of operating systems, reloaded when templates file changed.
         '''
+        self.load_operating_systems()
         return self.operating_systems
 
     def get_os_versions(self, os):
@@ -83,40 +76,33 @@ class Templates(object):
         return iso_link
 
     def get_template_by_name(self, name):
+        return self.store.get(name)
+
+    def get_template_by_os(self, os_name, version):
         for template in self.templates:
-            if template['name'] == name:
+            if template['os'] == os_name and str(template['version']) == str(version):
                 return template
 
-    def fetch_template(self, os, version):
+    def fetch_template(self, os_name, version):
         '''
-        Checks if template exist and if not, download and save it in the standard templates path.
+        Returns cached image filename of the template, downloading it into template cache on miss.
+        Optional checksum( 'sha256:<digest>') from templates.yml is verified during download.
         '''
-        link = self.get_iso_link(os, version)
-        save_path = SETTINGS['TEMPLATESPATH']
-        
-        if self.check_exists(link):
-            print("Template already exists.")
-            return os.path.basename(link)
+        template = self.get_template_by_os(os_name, version)
 
         try:
-            filename = download(link, save_path)
-            return filename
+            entry = self.cache.fetch(template['iso'], checksum=template.get('checksum'))
+            return entry['file']
 
         except Exception as e:
             print("Download of the template failed.")
             raise(e)
     
     def exists(self, name):
-        exists = False
-        for template in self.templates:
-            if template['name'] == name:
-                exists = True
-        return exists
+        return self.store.exists(name)
 
-    def check_exists(self, template_iso):
+    def check_exists(self, template_iso, checksum=None):
         '''
-        Check if template exists.
+        Check if template image is in template cache.
         '''
-        template_file = "{}/{}".format(SETTINGS['TEMPLATESPATH'], os.path.basename(template_iso))
-        exists = os.path.exists(template_file)
-        return exists
+        return self.cache.lookup(template_iso, checksum=checksum) is not None
@@ -1,4 +1,3 @@
-import yaml
 import os 
 from os.path import expanduser
 
@@ -15,6 +14,7 @@ SETTINGS['TEMPLATESPATH'] = '/var/lib/libvirt/images/'
 SETTINGS['TEMPLATESFILE'] = '{}/templates.yml'.format(SETTINGS['RESOURCESDIR'])
 SETTINGS['PLANSFILE'] = '{}/plans.yml'.format(SETTINGS['RESOURCESDIR'])
 SETTINGS['HOSTSFILE'] = '{}/hosts.yml'.format(SETTINGS['RESOURCESDIR'])
+SETTINGS['SNAPSHOTSFILE'] = '{}/snapshots.yml'.format(SETTINGS['RESOURCESDIR'])
 SETTINGS['DEFAULTKEYFILE'] = '{}/keys/private.key'.format(SETTINGS['RESOURCESDIR'])
 
 # TEMPLATE CONFIG FILES
@@ -23,18 +23,118 @@ SETTINGS['TEMPLATE_HOSTS_FILE'] = '{}/resources/config/hosts.yml'.format(dir_pat
 SETTINGS['TEMPLATE_TEMPLATES_FILE'] = '{}/resources/config/templates.yml'.format(dir_path)
 SETTINGS['TEMPLATE_PLANS_FILE'] = '{}/resources/config/plans.yml'.format(dir_path)
 
+# CLOUD INIT DEFAULTS
+
+SETTINGS['CLOUDINIT_CONFIG_DIR'] = '{}/resources/cloudinit-config'.format(dir_path)
+SETTINGS['CLOUDINIT_HOSTNAME'] = 'virtualship-cloud'
+SETTINGS['SEED_VOLUME_PREFIX'] = 'seed-'
+
+# WARM POOL DEFAULTS
+
+SETTINGS['METADATA_NS'] = 'http://denkei.org/virtapi/metadata/1.0'
+SETTINGS['WARM_POOL_SIZE'] = 2
+SETTINGS['WARM_POOL_MODE'] = 'paused'
+SETTINGS['WARM_POOL_CONCURRENCY'] = 2
+SETTINGS['WARM_POOL_CHECK_INTERVAL'] = 60
+SETTINGS['WARM_POOL_LOCK_DIR'] = '{}/locks'.format(SETTINGS['RESOURCESDIR'])
+
+# BACKING CHAIN DEFAULTS
+
+SETTINGS['MAX_CHAIN_DEPTH'] = 2
+SETTINGS['MAX_CHAIN_WALK'] = 64
+SETTINGS['BLOCK_JOB_BANDWIDTH'] = 64
+SETTINGS['AUTO_FLATTEN'] = True
+SETTINGS['BLOCK_JOB_POLL_INTERVAL'] = 1
+
+# SNAPSHOT DEFAULTS
+
+SETTINGS['SNAPSHOT_QUIESCE'] = False
+SETTINGS['SNAPSHOT_FORMAT'] = 'qcow2'
+
+# PLACEMENT DEFAULTS
+
+SETTINGS['PLACEMENT_POLICY'] = 'pack'
+SETTINGS['CPU_OVERCOMMIT'] = 4.0
+SETTINGS['RAM_OVERCOMMIT'] = 1.0
+SETTINGS['MAX_MEMORY_USAGE'] = 90
+SETTINGS['PLACEMENT_SNAPSHOT_TTL'] = 60
+SETTINGS['PLACEMENT_RESERVATION_TTL'] = 300
+
+# SAMPLER DEFAULTS
+
+SETTINGS['SAMPLER_INTERVAL'] = 5
+SETTINGS['SAMPLER_HISTORY'] = 720
+
+# SSH DEFAULTS
+
+SETTINGS['SSH_KEEPALIVE_INTERVAL'] = 30
+SETTINGS['SSH_CONNECT_TIMEOUT'] = 10
+SETTINGS['SSH_COMMAND_TIMEOUT'] = 300
+SETTINGS['SSH_WORKERS'] = 8
+
+# DAEMON DEFAULTS
+
+SETTINGS['DAEMON_SOCKET'] = '{}/vatool.sock'.format(SETTINGS['RESOURCESDIR'])
+SETTINGS['DAEMON_TOKEN_FILE'] = '{}/daemon.token'.format(SETTINGS['RESOURCESDIR'])
+SETTINGS['DAEMON_BIND'] = '127.0.0.1'
+SETTINGS['DAEMON_CONNECT_TIMEOUT'] = 0.5
+
 # HW DEFAULTS
 
 SETTINGS['DEFAULT_RAM'] = 1
 SETTINGS['DEFAULT_VCPU'] = 1
 SETTINGS['DEFAULT_DISKSIZE'] = 10
 
+# CONNECTION DEFAULTS
+
+SETTINGS['KEEPALIVE_INTERVAL'] = 5
+SETTINGS['KEEPALIVE_COUNT'] = 3
+SETTINGS['INVENTORY_WORKERS'] = 8
+SETTINGS['DOMAIN_WAIT_TIMEOUT'] = 300
+SETTINGS['DOMAIN_WAIT_MIN_INTERVAL'] = 0.25
+SETTINGS['DOMAIN_WAIT_MAX_INTERVAL'] = 2
+SETTINGS['BATCH_CONCURRENCY'] = 8
+SETTINGS['BULK_CONCURRENCY'] = 8
+SETTINGS['ASYNC_WORKERS'] = 16
+SETTINGS['ASYNC_HOST_CONCURRENCY'] = 8
+SETTINGS['ASYNC_EVENT_QUEUE'] = 1000
+
+# CACHE DEFAULTS
+
+SETTINGS['LEASE_CACHE_TTL'] = 30
+SETTINGS['LEASE_CACHE_MISS_INTERVAL'] = 1
+SETTINGS['VOLUME_INDEX_TTL'] = 300
+
+# DOWNLOAD DEFAULTS
+
+SETTINGS['IMAGE_CACHE_DIR'] = '{}/images'.format(SETTINGS['RESOURCESDIR'])
+SETTINGS['DOWNLOAD_SEGMENTS'] = 4
+SETTINGS['DOWNLOAD_MIN_SEGMENT_SIZE'] = 64 * 1024 * 1024
+SETTINGS['DOWNLOAD_CHUNK_SIZE'] = 1024 * 1024
+SETTINGS['DOWNLOAD_STATE_INTERVAL'] = 16 * 1024 * 1024
+SETTINGS['DOWNLOAD_TIMEOUT'] = 60
+SETTINGS['STREAM_QUEUE_SIZE'] = 16
+SETTINGS['TEMPLATE_CACHE_BUDGET'] = 20 * 1024 * 1024 * 1024
+SETTINGS['TEMPLATE_CACHE_WORKERS'] = 4
+SETTINGS['TEMPLATE_CACHE_FILL'] = True
+
 # VIRT Defs
 
 VIRT_CONN_SSH = 'qemu+ssh'
 VIRT_CONN_LIBSSH2 = 'qemu+libssh2'
 VIRT_CONN_TCP = 'qemu+tcp'
 
+DOMAIN_STATES = {
+    0: 'No state',
+    1: 'Running',
+    2: 'Blocked',
+    3: 'Paused',
+    4: 'Shutting down',
+    5: 'Stopped',
+    6: 'Crashed',
+    7: 'Suspended',
+}
+
 
 # Misc
 
@@ -1,26 +1,19 @@
 import sys
 from shutil import copy2
 
-if sys.version_info[0] < 3:
-	import urllib2
-else:
-	import urllib.request
 import os, json, socket
 import logging
-import requests
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
-from tqdm import tqdm
-from getpass import getpass
-import paramiko
 import errno
 from os import chmod
-from distutils.spawn import find_executable
+from string import Template
 from virtapi.settings import dir_path, SETTINGS
+from virtapi.iso import build_iso
 
-# crypto
-from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
+# requests, tqdm, paramiko and cryptography are imported where used, so importing utilities stays cheap
 
 def mkdir_p(path):
     try:
@@ -31,20 +24,256 @@ def mkdir_p(path):
         else:
             raise
 
-def download(url, path):
-    filename = os.path.basename(url)
-    response = requests.get(url, stream=True)
-    chunkSize = 1024
-
-    print("Fetching %s" % filename)
-    with open("/tmp/%s" % (filename), 'wb') as f:
-        pbar = tqdm( unit="B", total=int( response.headers['Content-Length'] ) )
-        for chunk in response.iter_content(chunk_size=chunkSize): 
-            if chunk: # filter out keep-alive new chunks
-                pbar.update (len(chunk))
+class ChecksumError(Exception):
+    pass
+
+
+def parse_checksum(checksum):
+    """
+    Parses 'algorithm:hexdigest' checksum from templates.yml, bare digest is treated as sha256.
+    """
+    if not checksum:
+        return None, None
+    if ':' in checksum:
+        algorithm, digest = checksum.split(':', 1)
+    else:
+        algorithm, digest = 'sha256', checksum
+    return algorithm.strip().lower(), digest.strip().lower()
+
+
+def probe(url):
+    """
+    Returns remote file metadata( size, range support, ETag, Last-Modified) from HEAD request.
+    """
+    import requests
+    response = requests.head(url, allow_redirects=True, timeout=SETTINGS['DOWNLOAD_TIMEOUT'])
+    size = response.headers.get('Content-Length')
+    return {
+        'url': response.url,
+        'size': int(size) if size is not None and response.ok else None,
+        'ranges': response.headers.get('Accept-Ranges', '').lower() == 'bytes',
+        'etag': response.headers.get('ETag'),
+        'modified': response.headers.get('Last-Modified'),
+    }
+
+
+class SegmentedDownload(object):
+    """
+    Downloads url into directory. Large files from servers accepting ranges are split into concurrent
+    HTTP Range segments, progress is kept in a state file next to the partial file so interrupted
+    downloads resume. Checksum is computed while downloading over the completed prefix of the file,
+    file gets its final name only after verification.
+    """
+
+    def __init__(self, url, path, checksum=None, segments=None, filename=None, remote=None):
+        self.url = url
+        self.filename = filename or os.path.basename(url)
+        self.remote = remote
+        self.target = os.path.join(path, self.filename)
+        self.part = self.target + '.part'
+        self.statefile = self.target + '.state'
+        self.segments = segments or SETTINGS['DOWNLOAD_SEGMENTS']
+        self.chunk_size = SETTINGS['DOWNLOAD_CHUNK_SIZE']
+        self.algorithm, self.digest = parse_checksum(checksum)
+        self.hasher = hashlib.new(self.algorithm) if self.algorithm else None
+        self.hashed = 0
+        self.lock = threading.Lock()
+        self.hash_lock = threading.Lock()
+        self.state = None
+        self.saved = 0
+        self.pbar = None
+
+    def _load_state(self, remote):
+        if not os.path.exists(self.part) or not os.path.exists(self.statefile):
+            return None
+        try:
+            with open(self.statefile) as f:
+                state = json.load(f)
+        except ValueError:
+            return None
+        if state.get('url') != self.url or state.get('size') != remote['size'] or state.get('etag') != remote['etag']:
+            logging.info('Remote file {} changed, download starts from scratch.'.format(self.filename))
+            return None
+        return state
+
+    def _save_state(self):
+        tmp = self.statefile + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp, self.statefile)
+
+    def _new_state(self, remote):
+        size = remote['size']
+        segments = []
+        if remote['ranges'] and size:
+            count = max(1, min(self.segments, size // SETTINGS['DOWNLOAD_MIN_SEGMENT_SIZE']))
+            step = size // count
+            for i in range(count):
+                start = i * step
+                end = size - 1 if i == count - 1 else start + step - 1
+                segments.append([start, end, 0])
+
+        with open(self.part, 'wb') as f:
+            if segments:
+                f.truncate(size)
+        return {'url': self.url, 'size': size, 'etag': remote['etag'], 'ranges': remote['ranges'],
+                'segments': segments}
+
+    def _done(self):
+        return sum(segment[2] for segment in self.state['segments'])
+
+    def _prefix(self):
+        """
+        Returns number of bytes downloaded without gaps from start of the file.
+        """
+        prefix = 0
+        for start, end, done in self.state['segments']:
+            prefix = start + done
+            if start + done <= end:
+                break
+        return prefix
+
+    def _advance_hash(self, prefix):
+        if self.hasher is None or not self.hash_lock.acquire(False):
+            return
+        try:
+            if prefix <= self.hashed:
+                return
+            with open(self.part, 'rb') as f:
+                f.seek(self.hashed)
+                while self.hashed < prefix:
+                    data = f.read(min(self.chunk_size, prefix - self.hashed))
+                    if not data:
+                        break
+                    self.hasher.update(data)
+                    self.hashed += len(data)
+        finally:
+            self.hash_lock.release()
+
+    def _progress(self, segment, length):
+        with self.lock:
+            segment[2] += length
+            if self.pbar is not None:
+                self.pbar.update(length)
+            done = self._done()
+            if done - self.saved >= SETTINGS['DOWNLOAD_STATE_INTERVAL']:
+                self.saved = done
+                self._save_state()
+            prefix = self._prefix()
+        self._advance_hash(prefix)
+
+    def _fetch_segment(self, segment):
+        start, end, done = segment
+        if start + done > end:
+            return
+        import requests
+        headers = {'Range': 'bytes={}-{}'.format(start + done, end)}
+        response = requests.get(self.url, headers=headers, stream=True, timeout=SETTINGS['DOWNLOAD_TIMEOUT'])
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError('Server ignored range request for {}.'.format(self.filename))
+
+        with open(self.part, 'r+b') as f:
+            f.seek(start + done)
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if not chunk:
+                    continue
+                chunk = chunk[:end + 1 - start - segment[2]]
                 f.write(chunk)
+                f.flush()
+                self._progress(segment, len(chunk))
+
+    def _fetch_stream(self):
+        """
+        Single connection download, used when size is unknown or ranges are not supported.
+        Resumes from partial file when server accepts ranges.
+        """
+        import requests
+        offset = os.path.getsize(self.part) if self.state['ranges'] else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        response = requests.get(self.url, headers=headers, stream=True, timeout=SETTINGS['DOWNLOAD_TIMEOUT'])
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            offset = 0
 
-        return filename
+        mode = 'ab' if offset else 'wb'
+        if offset:
+            self._advance_stream_hash(offset)
+        elif self.hasher is not None:
+            self.hasher = hashlib.new(self.algorithm)
+            self.hashed = 0
+
+        with open(self.part, mode) as f:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if not chunk:
+                    continue
+                f.write(chunk)
+                if self.hasher is not None:
+                    self.hasher.update(chunk)
+                    self.hashed += len(chunk)
+                if self.pbar is not None:
+                    self.pbar.update(len(chunk))
+
+    def _advance_stream_hash(self, offset):
+        with self.lock:
+            self._advance_hash(offset)
+
+    def verify(self):
+        if self.hasher is None:
+            return True
+        return self.hasher.hexdigest() == self.digest
+
+    def run(self):
+        if os.path.exists(self.target):
+            return self.filename
+
+        mkdir_p(os.path.dirname(self.target))
+        remote = self.remote or probe(self.url)
+        self.state = self._load_state(remote) or self._new_state(remote)
+        self._save_state()
+        segmented = bool(self.state['segments'])
+
+        initial = self._done() if segmented else (os.path.getsize(self.part) if self.state['ranges'] else 0)
+        self.saved = initial
+        from tqdm import tqdm
+        print("Fetching %s" % self.filename)
+        self.pbar = tqdm(unit="B", unit_scale=True, total=self.state['size'], initial=initial)
+        try:
+            if segmented:
+                pending = [segment for segment in self.state['segments'] if segment[0] + segment[2] <= segment[1]]
+                if pending:
+                    pool = ThreadPool(len(pending))
+                    try:
+                        pool.map(self._fetch_segment, pending)
+                    finally:
+                        pool.close()
+                        pool.join()
+                        with self.lock:
+                            self._save_state()
+                self._advance_hash(self.state['size'])
+            else:
+                self._fetch_stream()
+        finally:
+            self.pbar.close()
+
+        if not self.verify():
+            os.remove(self.part)
+            os.remove(self.statefile)
+            raise ChecksumError('Checksum mismatch for {}, expected {}:{} got {}.'.format(
+                self.filename, self.algorithm, self.digest, self.hasher.hexdigest()))
+
+        os.rename(self.part, self.target)
+        os.remove(self.statefile)
+        logging.info('Downloaded {} into {}.'.format(self.url, self.target))
+        return self.filename
+
+
+def download(url, path=None, checksum=None, segments=None, filename=None, remote=None):
+    """
+    Downloads url into path( image cache directory by default), returns filename.
+    """
+    return SegmentedDownload(url, path or SETTINGS['IMAGE_CACHE_DIR'], checksum=checksum, segments=segments,
+                             filename=filename, remote=remote).run()
 
 def create_config():
    mkdir_p(SETTINGS['RESOURCESDIR'])
@@ -60,15 +289,31 @@ def get_free_port():
     s.close()
     return port
 
-def cloudinit(name):
-    logging.info('Creating CLOUD INIT iso for a new domain.')
+def cloudinit_seed(context=None):
+    """
+    Builds cloud init NoCloud seed ISO in memory and returns it as bytes.
+    user-data, meta-data and network-config templates are filled from context( $hostname, $instance_id, ...).
+    """
+    logging.info('Creating CLOUD INIT seed for a new domain.')
+
+    values = {'hostname': SETTINGS['CLOUDINIT_HOSTNAME']}
+    values.update(context or {})
+    values.setdefault('instance_id', values['hostname'])
 
-    isocmd = 'mkisofs'
-    if find_executable('genisoimage') is not None:
-        isocmd = 'genisoimage'
-    os.system("{} --quiet -o /tmp/{} --volid cidata --joliet --rock {}/resources/cloudinit-config/user-data {}/resources/cloudinit-config/meta-data".format(isocmd, name, dir_path, dir_path))
+    files = {}
+    for name in ('user-data', 'meta-data', 'network-config'):
+        path = '{}/{}'.format(SETTINGS['CLOUDINIT_CONFIG_DIR'], name)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            files[name] = Template(f.read()).safe_substitute(values).encode('utf-8')
+    return build_iso(files, volume_id='cidata')
 
 def generate_ssh_key():
+    from cryptography.hazmat.primitives import serialization as crypto_serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.backends import default_backend as crypto_default_backend
+
     logging.info('NOTICE! Generating a new private/public key combination, be AWARE!')
 
     key = rsa.generate_private_key(
@@ -101,51 +346,41 @@ def check_public_key_exists(public_key, auth_keys):
     else:
         return False
 
-def ssh_copy_id(key, server, username, password):
-    logging.info('Adding a virtapi public key to the remote host hypervisor.')
+def _install_public_key(host, key):
+    import paramiko
+    from virtapi.controller.ssh_ctrl import ssh_pool
 
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(server, username=username, password=password)
+    # bootstrap session authenticates with password or another key, it is not kept in the pool
+    try:
+        result = ssh_pool.exec_command(host, 'mkdir -p ~/.ssh/ && touch ~/.ssh/authorized_keys && cat ~/.ssh/authorized_keys')
+        if result['status'] is None:
+            # connection or authentication failed, callers fall back to another key on SSHException
+            raise paramiko.SSHException('Connecting to {} failed: {}'.format(host['connection'], result['error']))
+        if result['status'] != 0:
+            raise IOError('Reading authorized keys on {} failed: {}'.format(host['connection'], result['stderr']))
+        if check_public_key_exists(key.strip(), result['stdout']):
+            print("SSH Key exists. Connected.")
+            return None
+        results = ssh_pool.run_batch(host, ['echo "{}" >> ~/.ssh/authorized_keys'.format(key.strip()),
+                                            'chmod 644 ~/.ssh/authorized_keys',
+                                            'chmod 700 ~/.ssh/'])
+        if results[-1]['status'] is None:
+            raise paramiko.SSHException('Adding public key on {} failed: {}'.format(host['connection'], results[-1]['error']))
+        if results[-1]['status'] != 0:
+            raise IOError('Adding public key on {} failed: {}'.format(host['connection'], results[-1]['stderr']))
+        return results
+    finally:
+        ssh_pool.release(host)
 
-    client.exec_command('mkdir -p ~/.ssh/')
-    stdin, stdout, ssh_stderr = client.exec_command("cat ~/.ssh/authorized_keys")
-    auth_keys = stdout.readlines()
-    if check_public_key_exists(key, auth_keys[0]):
-        print("SSH Key exists. Connected.")
-        return None
-    client.exec_command('echo "%s" >> ~/.ssh/authorized_keys' % key)
-    client.exec_command('chmod 644 ~/.ssh/authorized_keys')
-    client.exec_command('chmod 700 ~/.ssh/')
+def ssh_copy_id(key, server, username, password):
+    logging.info('Adding a virtapi public key to the remote host hypervisor.')
+    host = {'connection': server, 'username': username, 'password': password, 'key': None}
+    return _install_public_key(host, key)
 
 def ssh_copy_id_new_key(key, server, username, password, target_key, key_pass=None):
     logging.info('Adding a virtapi public key to the remote host hypervisor (NEW KEY).')
-    
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    new_key = target_key
-
-    try:
-        paramiko_key = paramiko.RSAKey.from_private_key_file(key)
-        client.connect(server, username=username, pkey=paramiko_key)
-    except (paramiko.ssh_exception.PasswordRequiredException) as e:
-        print("[-] Your key is encrypted, password is needed:")
-        if key_pass is None:
-            kpass = getpass()
-        else:
-            kpass = key_pass
-        paramiko_key = paramiko.RSAKey.from_private_key_file(key, password=kpass)
-        client.connect(server, username=username, pkey=paramiko_key)
-
-    client.exec_command('mkdir -p ~/.ssh/')
-    stdin, stdout, ssh_stderr = client.exec_command("cat ~/.ssh/authorized_keys")
-    auth_keys = stdout.readlines()
-    if check_public_key_exists(new_key, auth_keys[0]):
-        print("SSH Key exists. Connected.")
-        return None
-    client.exec_command('echo "{}" >> ~/.ssh/authorized_keys'.format(new_key))
-    client.exec_command('chmod 644 ~/.ssh/authorized_keys')
-    client.exec_command('chmod 700 ~/.ssh/')
+    host = {'connection': server, 'username': username, 'key': key, 'key_password': key_pass}
+    return _install_public_key(host, target_key)
 
 def get_public_key():
     key = None